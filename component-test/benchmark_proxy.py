@@ -0,0 +1,491 @@
+
+# Copyright (C) 2013-2016 Pelagicore AB  <joakim.gross@pelagicore.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+# Boston, MA  02110-1301, USA.
+#
+# For further information see LICENSE
+
+
+import pytest
+
+import dbus
+import gobject
+
+import json
+import os
+from multiprocessing import Process, cpu_count
+from time import sleep, time
+
+import service_stubs as stubs
+from dbus_proxy_rules import RuleSet
+
+
+"""
+    Benchmarks of dbus-proxy. They use the same fixtures as the component
+    tests but are not collected by default, run them explicitly with:
+
+        py.test -v -s benchmark_proxy.py
+
+    The results are printed, nothing is asserted about the numbers.
+"""
+
+
+CALLS = 2000
+
+
+def call_method(address, calls, message="My unique key"):
+    """ Call TestService1.Method1 'calls' times over one connection and
+        return the elapsed wall clock time in seconds.
+    """
+    bus = dbus.bus.BusConnection(address)
+    remote_object = bus.get_object(stubs.BUS_NAME, stubs.OPATH_1, introspect=False)
+    method = remote_object.get_dbus_method(stubs.METHOD_1, stubs.TestInterface1_1)
+
+    start = time()
+    for _x in range(0, calls):
+        method(message)
+    elapsed = time() - start
+
+    bus.close()
+    return elapsed
+
+
+def call_method_concurrently(address, clients, calls):
+    """ Call TestService1.Method1 'calls' times from each of 'clients'
+        processes in parallel and return the elapsed wall clock time in
+        seconds for all of them to finish.
+    """
+    processes = [Process(target=call_method, args=(address, calls))
+                 for _x in range(0, clients)]
+
+    start = time()
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    return time() - start
+
+
+def report(name, calls, elapsed, reference=None):
+    line = "{name}: {calls} calls in {elapsed:.3f} s, {rate:.0f} calls/s".format(**{
+        "name": name,
+        "calls": calls,
+        "elapsed": elapsed,
+        "rate": calls / elapsed
+    })
+    if reference is not None:
+        line += ", overhead {overhead:.1f}%".format(
+            overhead=(elapsed - reference) / reference * 100)
+    print line
+
+
+class TestPassThroughOverhead(object):
+
+    CONF_ALLOW_ALL = """
+    {
+        "dbus-gateway-config-session": [{
+            "direction": "*",
+            "interface": "*",
+            "object-path": "*",
+            "method": "*"
+        }],
+        "dbus-gateway-config-system": []
+    }
+    """
+
+    """ Allows the same calls as CONF_ALLOW_ALL for the benchmark, but the
+        rules have to be evaluated for each message.
+    """
+    CONF_FILTERED = """
+    {{
+        "dbus-gateway-config-session": [{{
+            "direction": "outgoing",
+            "interface": "{iface}.*",
+            "object-path": "{opath}",
+            "method": ["{method_2}", "{method_1}"]
+        }},
+        {{
+            "direction": "incoming",
+            "interface": "*",
+            "object-path": "*",
+            "method": "*"
+        }}],
+        "dbus-gateway-config-system": []
+    }}
+    """.format(**{
+        "iface": stubs.IFACE_1,
+        "opath": stubs.OPATH_1,
+        "method_1": stubs.METHOD_1,
+        "method_2": stubs.METHOD_2
+    })
+
+    @pytest.mark.parametrize("config", [CONF_ALLOW_ALL, CONF_FILTERED])
+    def test_overhead_relative_to_direct_connection(self,
+                                                    session_bus,
+                                                    service_on_outside,
+                                                    dbus_proxy,
+                                                    config):
+        """ Compare method call throughput through the proxy against calling
+            the service directly on the outside bus.
+        """
+        dbus_proxy.set_config(config)
+
+        direct = call_method(dbus_proxy.OUTSIDE_SOCKET, CALLS)
+        proxied = call_method(dbus_proxy.INSIDE_SOCKET, CALLS)
+
+        print
+        report("direct", CALLS, direct)
+        report("proxied", CALLS, proxied, reference=direct)
+
+
+class TestLargePayloads(object):
+
+    CALLS = 50
+
+    PAYLOAD = "x" * (1024 * 1024)
+
+    CONF_FILTERED = TestPassThroughOverhead.CONF_FILTERED
+
+    @pytest.mark.parametrize("config", [CONF_FILTERED])
+    def test_large_payload_overhead(self,
+                                    session_bus,
+                                    service_on_outside,
+                                    dbus_proxy,
+                                    config):
+        """ Compare throughput of calls with 1 MiB payloads, and replies of
+            the same size, through a filtering proxy against calling the
+            service directly on the outside bus.
+
+            The proxy only reads the header fields of the messages, so the
+            overhead should be dominated by the extra copy through the proxy
+            socket rather than by the filtering.
+        """
+        dbus_proxy.set_config(config)
+
+        direct = call_method(dbus_proxy.OUTSIDE_SOCKET,
+                             TestLargePayloads.CALLS,
+                             TestLargePayloads.PAYLOAD)
+        proxied = call_method(dbus_proxy.INSIDE_SOCKET,
+                              TestLargePayloads.CALLS,
+                              TestLargePayloads.PAYLOAD)
+
+        print
+        report("direct, 1 MiB", TestLargePayloads.CALLS, direct)
+        report("proxied, 1 MiB", TestLargePayloads.CALLS, proxied, reference=direct)
+
+
+class TestMultiCoreScaling(object):
+
+    CALLS = 1000
+
+    CONF_FILTERED = TestPassThroughOverhead.CONF_FILTERED
+
+    @pytest.mark.parametrize("config", [CONF_FILTERED])
+    def test_throughput_scales_with_clients(self,
+                                            session_bus,
+                                            service_on_outside,
+                                            dbus_proxy,
+                                            config):
+        """ Report aggregate throughput with an increasing number of
+            concurrent clients, up to the number of cores.
+
+            Each client connection is served by its own dbus-proxy process,
+            so throughput should grow with the number of clients until the
+            cores, the outside service or the bus daemon are saturated.
+        """
+        dbus_proxy.set_config(config)
+
+        clients = 1
+        print
+        while True:
+            elapsed = call_method_concurrently(dbus_proxy.INSIDE_SOCKET,
+                                               clients,
+                                               TestMultiCoreScaling.CALLS)
+            report("{0} clients".format(clients),
+                   clients * TestMultiCoreScaling.CALLS,
+                   elapsed)
+
+            if clients >= cpu_count():
+                break
+            clients = min(clients * 2, cpu_count())
+
+
+class TestRuleEngineThroughput(object):
+
+    RULES = 300
+
+    MESSAGES = 100000
+
+    def test_verdicts_in_process(self):
+        """ Report how many verdicts per second the rule engine gives in
+            process, one call per message and in batches, with the matching
+            rule after 300 that do not match.
+
+            No bus or proxy is involved, so this is the cost of the rules
+            alone.
+        """
+        rules = [{
+            "direction": "outgoing",
+            "interface": "{0}.n{1}".format(stubs.IFACE_1, i),
+            "object-path": "/a/path/{0}/*".format(i),
+            "method": "*"
+        } for i in range(0, TestRuleEngineThroughput.RULES)]
+        rules.append({
+            "direction": "*",
+            "interface": "*",
+            "object-path": "*",
+            "method": "*"
+        })
+        rule_set = RuleSet(json.dumps({
+            "dbus-gateway-config-session": rules,
+            "dbus-gateway-config-system": []
+        }))
+
+        # Some values repeat, like on a real bus
+        messages = [("outgoing",
+                     stubs.IFACE_1 + "." + stubs.EXT_1,
+                     "/a/path/{0}/object".format(i % 500),
+                     "Method{0}".format(i % 20))
+                    for i in range(0, TestRuleEngineThroughput.MESSAGES)]
+
+        start = time()
+        for message in messages:
+            rule_set.match(*message)
+        single = time() - start
+
+        start = time()
+        rule_set.match_batch(messages)
+        batch = time() - start
+
+        print
+        report("one call per message", len(messages), single)
+        report("batch", len(messages), batch)
+
+
+def percentile(values, fraction):
+    """ Return the smallest of 'values' that 'fraction' of them are at or
+        below.
+    """
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class TestSignalStorm(object):
+
+    CALLS = 500
+
+    """ Broadcast signals the service emits each time its main loop is
+        idle, and their payload in bytes.
+    """
+    BURST = 20
+    PAYLOAD = 1024
+
+    """ Seconds the client spends between calls, first not reading at all
+        and then handling the signals it has read.
+    """
+    PAUSE = 0.005
+
+    CONF_ALLOW_ALL = TestPassThroughOverhead.CONF_ALLOW_ALL
+
+    def call_during_storm(self, dbus_proxy):
+        """ Call TestService1.Method1 through the proxy from a client that
+            subscribes to a storm of Broadcast signals and is slow to handle
+            them, and return the time of each call in seconds and the
+            number of signals the client handled.
+        """
+        dbus_proxy.set_config(TestSignalStorm.CONF_ALLOW_ALL)
+
+        handled = [0]
+
+        def broadcast(sequence, payload):
+            handled[0] += 1
+
+        bus = dbus.bus.BusConnection(dbus_proxy.INSIDE_SOCKET)
+        bus.add_signal_receiver(broadcast,
+                                signal_name=stubs.BROADCAST,
+                                dbus_interface=stubs.TestInterface1_1,
+                                path=stubs.OPATH_1)
+        remote_object = bus.get_object(stubs.BUS_NAME, stubs.OPATH_1, introspect=False)
+        method = remote_object.get_dbus_method(stubs.METHOD_1, stubs.TestInterface1_1)
+
+        # The storm is controlled from the outside, so the calls are not
+        # delayed by the proxy
+        outside_bus = dbus.bus.BusConnection(dbus_proxy.OUTSIDE_SOCKET)
+        outside_object = outside_bus.get_object(stubs.BUS_NAME, stubs.OPATH_1,
+                                                introspect=False)
+        outside_object.get_dbus_method(stubs.START_BROADCAST_STORM,
+                                       stubs.TestInterface1_1)(
+            dbus.UInt32(TestSignalStorm.BURST),
+            dbus.UInt32(TestSignalStorm.PAYLOAD))
+
+        context = gobject.MainLoop().get_context()
+        latencies = []
+        for _x in range(0, TestSignalStorm.CALLS):
+            # Busy elsewhere, the signals queue up in the proxy
+            sleep(TestSignalStorm.PAUSE)
+
+            start = time()
+            method("key")
+            latencies.append(time() - start)
+
+            # Handle the signals read while waiting for the reply, for as
+            # long again
+            deadline = time() + TestSignalStorm.PAUSE
+            while context.pending() and time() < deadline:
+                context.iteration(False)
+
+        outside_object.get_dbus_method(stubs.STOP_BROADCAST_STORM,
+                                       stubs.TestInterface1_1)()
+        bus.close()
+        outside_bus.close()
+
+        return latencies, handled[0]
+
+    def report(self, name, latencies, handled):
+        print "{name}: {calls} calls, p50 {p50:.2f} ms, p99 {p99:.2f} ms, " \
+              "max {max:.2f} ms, {handled} signals handled".format(**{
+                  "name": name,
+                  "calls": len(latencies),
+                  "p50": percentile(latencies, 0.5) * 1000,
+                  "p99": percentile(latencies, 0.99) * 1000,
+                  "max": max(latencies) * 1000,
+                  "handled": handled
+              })
+
+    def test_call_latency_in_one_queue(self,
+                                       session_bus,
+                                       service_on_outside,
+                                       dbus_proxy):
+        """ Report the latency of method calls during a signal storm, with
+            replies queued behind the signals for the client.
+        """
+        latencies, handled = self.call_during_storm(dbus_proxy)
+
+        print
+        self.report("one queue", latencies, handled)
+
+    def test_call_latency_in_priority_lanes(self,
+                                            session_bus,
+                                            service_on_outside,
+                                            dbus_proxy_lanes):
+        """ Report the latency of method calls during a signal storm, with
+            replies sent to the client ahead of the signals. Compare with
+            test_call_latency_in_one_queue.
+        """
+        latencies, handled = self.call_during_storm(dbus_proxy_lanes)
+
+        print
+        self.report("priority lanes", latencies, handled)
+
+
+def child_pids(pid):
+    """ Return the pids of the child processes of 'pid'.
+    """
+    children = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/{0}/stat".format(entry)) as stat:
+                # The command may contain spaces, the fields after it do not
+                fields = stat.read().rsplit(")", 1)[1].split()
+        except IOError:
+            continue
+        if int(fields[1]) == pid:
+            children.append(int(entry))
+    return children
+
+
+def private_rss(pid):
+    """ Return the private resident memory of a process in KiB, i.e. the
+        pages it does not share with its parent or any other process.
+    """
+    private = 0
+    with open("/proc/{0}/smaps".format(pid)) as smaps:
+        for line in smaps:
+            if line.startswith("Private_Clean:") or line.startswith("Private_Dirty:"):
+                private += int(line.split()[1])
+    return private
+
+
+class TestMemoryFootprint(object):
+
+    RULES = 300
+
+    CLIENTS = 20
+
+    RULE = """{{
+        "direction": "outgoing",
+        "interface": "{iface}.{index}",
+        "object-path": "/a/path/to/a/service/{index}/*",
+        "method": ["Get{index}", "Set{index}", "Notify{index}"]
+    }}"""
+
+    CONF_TEMPLATE = """
+    {{
+        "dbus-gateway-config-session": [{rules},
+        {{
+            "direction": "*",
+            "interface": "*",
+            "object-path": "*",
+            "method": "*"
+        }}],
+        "dbus-gateway-config-system": []
+    }}
+    """
+
+    def test_private_rss_per_child(self,
+                                   session_bus,
+                                   service_on_outside,
+                                   dbus_proxy):
+        """ Report the private resident memory of each proxy process serving
+            a client, with a config of 300 rules.
+
+            Every client is served by a process forked from dbus-proxy, which
+            shares the pages of the parent until it writes to them. Run this
+            against two builds to compare their footprint.
+        """
+        rules = ",".join(TestMemoryFootprint.RULE.format(iface=stubs.IFACE_1, index=i)
+                         for i in range(0, TestMemoryFootprint.RULES))
+        dbus_proxy.set_config(TestMemoryFootprint.CONF_TEMPLATE.format(rules=rules))
+
+        clients = []
+        for _x in range(0, TestMemoryFootprint.CLIENTS):
+            bus = dbus.bus.BusConnection(dbus_proxy.INSIDE_SOCKET)
+            remote_object = bus.get_object(stubs.BUS_NAME, stubs.OPATH_1,
+                                           introspect=False)
+            remote_object.get_dbus_method(stubs.METHOD_1, stubs.TestInterface1_1)("key")
+            clients.append(bus)
+
+        # Allow the last proxy processes to settle
+        sleep(0.3)
+
+        children = child_pids(dbus_proxy.PID)
+        sizes = sorted(private_rss(pid) for pid in children)
+
+        print
+        print "parent: {0} KiB private".format(private_rss(dbus_proxy.PID))
+        print "{count} children: min {min} KiB, median {median} KiB, " \
+              "max {max} KiB private".format(**{
+                  "count": len(sizes),
+                  "min": sizes[0],
+                  "median": sizes[len(sizes) // 2],
+                  "max": sizes[-1]
+              })
+
+        for bus in clients:
+            bus.close()
@@ -24,7 +24,9 @@ import pytest
 import os
 from os import environ
 import sys
+import json
 import tempfile
+from select import select
 from time import sleep
 from subprocess import Popen, call, PIPE
 
@@ -41,6 +43,11 @@ from subprocess import Popen, call, PIPE
 
 OUTSIDE_SOCKET = "/tmp/dbus_proxy_outside_socket"
 INSIDE_SOCKET = "/tmp/dbus_proxy_inside_socket"
+INSIDE_SOCKET_2 = "/tmp/dbus_proxy_inside_socket_2"
+AUDIT_LOG = "/tmp/dbus_proxy_audit.log"
+CHILD_REGISTRY = "/tmp/dbus_proxy_children.json"
+CAPTURE = "/tmp/dbus_proxy_capture.bin"
+LATENCY_LOG = "/tmp/dbus_proxy_latency.log"
 
 
 # Setup an environment for the fixtures to share so the bus address is the same for all
@@ -125,13 +132,134 @@ def dbus_proxy(request):
         The dbus-proxy is torn down at the end of the test.
     """
     # TODO: Make bus type parametrized so we can use the system bus as well.
+
+    return start_dbus_proxy(request, [INSIDE_SOCKET])
+
+
+@pytest.fixture(scope="function")
+def dbus_proxy_two_sockets(request):
+    """ Start one dbus-proxy that listens on two inside sockets.
+
+        Both sockets are proxies for the session bus, the helper has the
+        second socket as INSIDE_SOCKET_2. The dbus-proxy is torn down at the
+        end of the test.
+    """
+    return start_dbus_proxy(request, [INSIDE_SOCKET, INSIDE_SOCKET_2])
+
+
+@pytest.fixture(scope="function")
+def dbus_proxy_audited(request):
+    """ Start dbus-proxy with an audit log that records every verdict. The
+        log is available as AUDIT_LOG on the returned helper.
+    """
+    remove_on_teardown(request, AUDIT_LOG)
+
+    return start_dbus_proxy(request, [INSIDE_SOCKET],
+                            ["--audit-log=" + AUDIT_LOG])
+
+
+@pytest.fixture(scope="function")
+def dbus_proxy_captured(request):
+    """ Start dbus-proxy capturing whole messages. The capture is available
+        as CAPTURE on the returned helper.
+    """
+    remove_on_teardown(request, CAPTURE)
+
+    return start_dbus_proxy(request, [INSIDE_SOCKET],
+                            ["--capture=" + CAPTURE, "--capture-messages"])
+
+
+@pytest.fixture(scope="function")
+def dbus_proxy_timed(request):
+    """ Start dbus-proxy timing its dispatches, with a stall watchdog. The
+        histograms are available as LATENCY_LOG on the returned helper.
+    """
+    remove_on_teardown(request, LATENCY_LOG)
+
+    return start_dbus_proxy(request, [INSIDE_SOCKET],
+                            ["--latency-log=" + LATENCY_LOG,
+                             "--stall-threshold=1000"])
+
+
+@pytest.fixture(scope="function")
+def dbus_proxy_lanes(request):
+    """ Start dbus-proxy sending replies to clients that are behind before
+        method calls and signals.
+    """
+    return start_dbus_proxy(request, [INSIDE_SOCKET], ["--priority-lanes"])
+
+
+@pytest.fixture(scope="function")
+def dbus_proxy_introspect(request):
+    """ Start dbus-proxy with introspection data cached and pruned.
+    """
+    return start_dbus_proxy(request, [INSIDE_SOCKET],
+                            ["--introspect-cache", "--introspect-prune"])
+
+
+@pytest.fixture(scope="function")
+def dbus_proxy_child_registry(request):
+    """ Start dbus-proxy writing its child registry. The file is available
+        as CHILD_REGISTRY on the returned helper.
+    """
+    remove_on_teardown(request, CHILD_REGISTRY)
+
+    return start_dbus_proxy(request, [INSIDE_SOCKET],
+                            ["--child-registry=" + CHILD_REGISTRY])
+
+
+@pytest.fixture(scope="function")
+def dbus_proxy_limited(request):
+    """ Start dbus-proxy serving one client at a time, disconnecting it after
+        two seconds without messages, and writing its child registry.
+    """
+    remove_on_teardown(request, CHILD_REGISTRY)
+
+    return start_dbus_proxy(request, [INSIDE_SOCKET],
+                            ["--child-registry=" + CHILD_REGISTRY,
+                             "--max-clients=1",
+                             "--idle-timeout=2"])
+
+
+@pytest.fixture(scope="function")
+def dbus_proxy_line_config(request):
+    """ Start dbus-proxy reading configs as single lines, without acks.
+    """
+    return start_dbus_proxy(request, [INSIDE_SOCKET], framed=False)
+
+
+def remove_on_teardown(request, path):
+    """ Remove a file the test makes dbus-proxy write, both now in case an
+        earlier run left it behind and at the end of the test.
+    """
+    def remove():
+        if os.path.exists(path):
+            os.remove(path)
+
+    remove()
+    request.addfinalizer(remove)
+
+
+def start_dbus_proxy(request, inside_sockets, options=[], framed=True):
+    """ Start dbus-proxy as a proxy for the session bus on each of the
+        inside sockets, and return a DBusProxyHelper for it.
+
+        Unless 'framed' is False configs are written as NUL terminated frames
+        and the helper waits for dbus-proxy to acknowledge them.
+    """
     # TODO: Make path to dbus-proxy parametrized.
 
     dbus_proxy = None
 
+    command = ["../build/dbus-proxy"] + options
+    if framed:
+        command += ["--framed-config"]
+    for inside_socket in inside_sockets:
+        command += [inside_socket, "session"]
+
     try:
         dbus_proxy = Popen(
-            ["../build/dbus-proxy", INSIDE_SOCKET, "session"],
+            command,
             env=environment,
             stdin=PIPE,
             stdout=PIPE,
@@ -144,11 +272,12 @@ def dbus_proxy(request):
     def teardown():
         dbus_proxy.stdin.close()
         dbus_proxy.kill()
-        os.remove(INSIDE_SOCKET)
+        for inside_socket in inside_sockets:
+            os.remove(inside_socket)
 
     request.addfinalizer(teardown)
 
-    return DBusProxyHelper(dbus_proxy)
+    return DBusProxyHelper(dbus_proxy, framed)
 
 
 class DBusProxyHelper(object):
@@ -158,21 +287,52 @@ class DBusProxyHelper(object):
         a configuration string to dbus-proxy.
     """
 
-    def __init__(self, proxy_process):
+    ACK_TIMEOUT = 5
+
+    def __init__(self, proxy_process, framed=True):
         self.__proxy = proxy_process
+        self.__framed = framed
         # Tests should get the socket paths from here
         self.INSIDE_SOCKET = "unix:path=" + INSIDE_SOCKET
+        self.INSIDE_SOCKET_2 = "unix:path=" + INSIDE_SOCKET_2
         self.OUTSIDE_SOCKET = "unix:path=" + OUTSIDE_SOCKET
+        self.AUDIT_LOG = AUDIT_LOG
+        self.CHILD_REGISTRY = CHILD_REGISTRY
+        self.CAPTURE = CAPTURE
+        self.LATENCY_LOG = LATENCY_LOG
+        self.PID = proxy_process.pid
 
     def set_config(self, config):
-        """ Write json config to dbus-proxy
+        """ Write json config to dbus-proxy.
+
+            With framed configs this returns the ack from dbus-proxy as a
+            dict, once the rules are used for new connections.
         """
+        if self.__framed:
+            self.__proxy.stdin.write(config + "\0")
+            self.__proxy.stdin.flush()
+            return self.read_ack()
+
         # The way dbus-proxy expects data means that we can't have any newlines
         # in the config at any place except last, it has to be one non line broken
         # string ending in one newline.
         stripped_config = config.replace("\n", " ")
         self.__proxy.stdin.write(stripped_config + "\n")
+        self.__proxy.stdin.flush()
 
         # Allow some time for the proxy to be setup before tests start using the
         # "inside" socket.
         sleep(0.3)
+
+    def read_ack(self):
+        """ Read one NUL terminated ack frame from the stdout of dbus-proxy.
+        """
+        stdout = self.__proxy.stdout.fileno()
+        ack = ""
+        while not ack.endswith("\0"):
+            readable = select([stdout], [], [], DBusProxyHelper.ACK_TIMEOUT)[0]
+            assert readable, "dbus-proxy did not acknowledge the config"
+            data = os.read(stdout, 4096)
+            assert data, "dbus-proxy closed stdout before acknowledging the config"
+            ack += data
+        return json.loads(ack[:-1])
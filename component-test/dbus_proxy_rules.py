@@ -0,0 +1,132 @@
+
+# Copyright (C) 2013-2016 Pelagicore AB  <joakim.gross@pelagicore.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+# Boston, MA  02110-1301, USA.
+#
+
+
+import os
+from ctypes import CDLL, POINTER, c_char_p, c_int, c_size_t, c_uint, c_void_p, \
+    create_string_buffer
+
+
+""" Python binding of the rule engine of dbus-proxy.
+
+    Loads the rule engine from the shared library built next to dbus-proxy,
+    i.e. "../build/libdbus-proxy-rules.so", or from the path given in the
+    DBUS_PROXY_RULES_LIB environment variable. Rules are evaluated in
+    process, with no bus, service or proxy process involved.
+"""
+
+
+LIBRARY = os.environ.get("DBUS_PROXY_RULES_LIB", "../build/libdbus-proxy-rules.so")
+
+_library = None
+
+
+def _load():
+    global _library
+
+    if _library is None:
+        _library = CDLL(LIBRARY)
+
+        _library.dbus_proxy_rules_new.restype = c_void_p
+        _library.dbus_proxy_rules_new.argtypes = [c_char_p, c_char_p, c_char_p, c_size_t]
+        _library.dbus_proxy_rules_free.restype = None
+        _library.dbus_proxy_rules_free.argtypes = [c_void_p]
+        _library.dbus_proxy_rules_size.restype = c_uint
+        _library.dbus_proxy_rules_size.argtypes = [c_void_p]
+        _library.dbus_proxy_rules_match.restype = c_int
+        _library.dbus_proxy_rules_match.argtypes = [c_void_p, c_char_p, c_char_p,
+                                                    c_char_p, c_char_p]
+        _library.dbus_proxy_rules_match_batch.restype = c_size_t
+        _library.dbus_proxy_rules_match_batch.argtypes = [c_void_p, POINTER(c_char_p),
+                                                          c_size_t, POINTER(c_int)]
+        _library.dbus_proxy_rules_reorder.restype = c_int
+        _library.dbus_proxy_rules_reorder.argtypes = [c_void_p]
+        _library.dbus_proxy_rules_order.restype = None
+        _library.dbus_proxy_rules_order.argtypes = [c_void_p, POINTER(c_uint)]
+        _library.dbus_proxy_rules_silence_log.restype = None
+        _library.dbus_proxy_rules_silence_log()
+
+    return _library
+
+
+class ConfigError(Exception):
+    pass
+
+
+class RuleSet(object):
+    """ The compiled rules of one section of a config.
+
+        A message is a (direction, interface, path, member) tuple, where a
+        field that is None is missing from the message.
+    """
+
+    ERROR_SIZE = 256
+
+    def __init__(self, config, bus="session"):
+        self.__library = _load()
+        error = create_string_buffer(RuleSet.ERROR_SIZE)
+        self.__rules = self.__library.dbus_proxy_rules_new(
+            config, "dbus-gateway-config-" + bus, error, RuleSet.ERROR_SIZE)
+        if not self.__rules:
+            raise ConfigError(error.value)
+
+    def __del__(self):
+        if getattr(self, "_RuleSet__rules", None):
+            self.__library.dbus_proxy_rules_free(self.__rules)
+
+    def __len__(self):
+        return self.__library.dbus_proxy_rules_size(self.__rules)
+
+    def match(self, direction, interface, path, member):
+        """ Return the index of the first rule that allows the message, or
+            None if it is not allowed.
+        """
+        index = self.__library.dbus_proxy_rules_match(self.__rules, direction,
+                                                      interface, path, member)
+        return index if index >= 0 else None
+
+    def is_allowed(self, direction, interface, path, member):
+        return self.match(direction, interface, path, member) is not None
+
+    def match_batch(self, messages):
+        """ Return the index of the first rule that allows each message, or
+            None, evaluating all of them in one call.
+        """
+        fields = (c_char_p * (4 * len(messages)))()
+        for i, message in enumerate(messages):
+            fields[4 * i:4 * i + 4] = list(message)
+        results = (c_int * len(messages))()
+
+        self.__library.dbus_proxy_rules_match_batch(self.__rules, fields,
+                                                     len(messages), results)
+
+        return [index if index >= 0 else None for index in results]
+
+    def reorder(self):
+        """ Move the rules that gave the most verdicts earlier, where that
+            can not change a verdict. Return True if the order changed.
+        """
+        return self.__library.dbus_proxy_rules_reorder(self.__rules) != 0
+
+    def order(self):
+        """ Return the indices of the rules in the order they are evaluated.
+        """
+        order = (c_uint * max(len(self), 1))()
+        self.__library.dbus_proxy_rules_order(self.__rules, order)
+        return list(order)[:len(self)]
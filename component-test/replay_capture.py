@@ -0,0 +1,274 @@
+
+# Copyright (C) 2013-2016 Pelagicore AB  <joakim.gross@pelagicore.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+# Boston, MA  02110-1301, USA.
+#
+
+
+import argparse
+import struct
+import sys
+from collections import namedtuple
+from time import sleep, time
+
+
+""" Read and replay captures written by dbus-proxy --capture=FILE.
+
+    Replay the messages through the rule engine, to see what a config
+    decides on recorded traffic and how fast:
+
+        python replay_capture.py engine CAPTURE CONFIG
+
+    Replay the outgoing method calls and signals through a running proxy,
+    with service_stubs.py as the service on the outside bus:
+
+        python replay_capture.py live CAPTURE unix:path=/tmp/dbus_proxy_inside_socket
+
+    Messages are sent at the pace they were captured, or with --speed=max as
+    fast as they can be. See src/capture.h for the file format.
+"""
+
+
+MAGIC = "DBPXCAP\0"
+VERSION = struct.Struct("<I")
+
+# Length, time, pid, direction, type, flags, reserved, size and the lengths
+# of the five header strings
+RECORD = struct.Struct("<IQIBBBBI5H")
+
+FLAG_MESSAGE = 0x01
+
+DIRECTIONS = ("outgoing", "incoming")
+
+TYPE_METHOD_CALL = 1
+TYPE_SIGNAL = 4
+
+DBUS_NAME = "org.freedesktop.DBus"
+LOCAL_INTERFACE = "org.freedesktop.DBus.Local"
+
+# The header of a small method call is about this many bytes, the rest of a
+# recorded message is padding when it is replayed live
+HEADER_SIZE = 128
+
+
+Record = namedtuple("Record", ["time", "pid", "direction", "type", "size",
+                               "interface", "path", "member", "destination",
+                               "sender", "message"])
+
+
+class CaptureError(Exception):
+    pass
+
+
+def read_capture(path):
+    """ Yield the records of a capture file in the order they were written.
+        Time is in seconds and a header field that was not set is None. A
+        record cut off at the end of the file, e.g. by a proxy that is still
+        capturing, is left out.
+    """
+    with open(path, "rb") as capture:
+        if capture.read(len(MAGIC)) != MAGIC:
+            raise CaptureError("{0} is not a dbus-proxy capture".format(path))
+        version, = VERSION.unpack(capture.read(VERSION.size))
+        if version != 1:
+            raise CaptureError("Unsupported capture version {0}".format(version))
+
+        while True:
+            fixed = capture.read(RECORD.size)
+            if len(fixed) < RECORD.size:
+                return
+            fields = RECORD.unpack(fixed)
+            length, timestamp, pid, direction, message_type, flags, _reserved, size = fields[:8]
+            rest = capture.read(length - RECORD.size)
+            if len(rest) < length - RECORD.size:
+                return
+
+            strings = []
+            offset = 0
+            for string_length in fields[8:]:
+                strings.append(rest[offset:offset + string_length] or None)
+                offset += string_length
+
+            yield Record(time=timestamp / 1e6,
+                         pid=pid,
+                         direction=DIRECTIONS[direction],
+                         type=message_type,
+                         size=size,
+                         interface=strings[0],
+                         path=strings[1],
+                         member=strings[2],
+                         destination=strings[3],
+                         sender=strings[4],
+                         message=rest[offset:] if flags & FLAG_MESSAGE else None)
+
+
+def is_filtered(record):
+    """ Return False for the messages dbus-proxy answers or handles itself
+        before the rules are evaluated, i.e. Hello and Disconnected.
+    """
+    if record.interface == LOCAL_INTERFACE:
+        return False
+    return not (record.direction == "outgoing" and
+                record.destination == DBUS_NAME and
+                record.member == "Hello")
+
+
+def paced(records, speed):
+    """ Yield records, at the pace they were captured if 'speed' is
+        "original".
+    """
+    start = None
+    for record in records:
+        if speed == "original":
+            if start is None:
+                start = (time(), record.time)
+            delay = (record.time - start[1]) - (time() - start[0])
+            if delay > 0:
+                sleep(delay)
+        yield record
+
+
+def replay_engine(records, config, bus="session", speed="max"):
+    """ Decide on each record with the rules of a config, and return the
+        list of (record, rule index) pairs, where the index is None for a
+        rejected message, and the elapsed time in seconds.
+
+        At maximum speed all verdicts are given in one batch. Only the rules
+        are evaluated, caches and rate limits of the proxy are not.
+    """
+    from dbus_proxy_rules import RuleSet
+
+    rule_set = RuleSet(config, bus)
+    records = [record for record in records if is_filtered(record)]
+
+    start = time()
+    if speed == "max":
+        verdicts = rule_set.match_batch([(record.direction, record.interface,
+                                          record.path, record.member)
+                                         for record in records])
+    else:
+        verdicts = [rule_set.match(record.direction, record.interface,
+                                   record.path, record.member)
+                    for record in paced(records, speed)]
+    elapsed = time() - start
+
+    return zip(records, verdicts), elapsed
+
+
+def replay_live(records, address, destination=None, speed="original"):
+    """ Send the outgoing method calls and signals of a capture over a new
+        connection to 'address', and return the number of messages sent and
+        the elapsed time in seconds.
+
+        Method calls go to 'destination', by default the bus name of the
+        service stubs, and no replies are expected. Each message is padded
+        to about its captured size.
+    """
+    import dbus
+    import dbus.lowlevel
+
+    if destination is None:
+        import service_stubs as stubs
+        destination = stubs.BUS_NAME
+
+    records = [record for record in records
+               if record.direction == "outgoing" and is_filtered(record) and
+               record.type in (TYPE_METHOD_CALL, TYPE_SIGNAL) and
+               record.path is not None and record.member is not None]
+
+    bus = dbus.bus.BusConnection(address)
+
+    sent = 0
+    start = time()
+    for record in paced(records, speed):
+        if record.type == TYPE_METHOD_CALL:
+            message = dbus.lowlevel.MethodCallMessage(
+                destination if record.destination != DBUS_NAME else DBUS_NAME,
+                record.path, record.interface, record.member)
+            message.set_no_reply(True)
+        else:
+            message = dbus.lowlevel.SignalMessage(record.path, record.interface,
+                                                  record.member)
+        padding = record.size - HEADER_SIZE
+        if padding > 0:
+            message.append(dbus.ByteArray("\0" * padding), signature="ay")
+        bus.send_message(message)
+        sent += 1
+    bus.flush()
+    elapsed = time() - start
+
+    bus.close()
+    return sent, elapsed
+
+
+def main(argv):
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("capture")
+    common.add_argument("--speed", choices=["original", "max"], default=None,
+                        help="replay at the captured pace or as fast as "
+                             "possible (default original live, max in the "
+                             "engine)")
+
+    parser = argparse.ArgumentParser(
+        description="Replay a dbus-proxy capture through the rule engine or "
+                    "a running proxy")
+    modes = parser.add_subparsers(dest="mode")
+
+    engine = modes.add_parser("engine", parents=[common],
+                              help="decide with the rules of a config")
+    engine.add_argument("config", help="config file")
+    engine.add_argument("--bus", choices=["session", "system"], default="session")
+
+    live = modes.add_parser("live", parents=[common],
+                            help="send through a running proxy")
+    live.add_argument("address", help="D-Bus address of the proxy socket")
+    live.add_argument("--destination", default=None,
+                      help="bus name to send method calls to (default the "
+                           "service stubs)")
+
+    args = parser.parse_args(argv)
+
+    try:
+        records = list(read_capture(args.capture))
+    except (IOError, CaptureError) as error:
+        print >> sys.stderr, error
+        return 1
+
+    if args.mode == "engine":
+        with open(args.config) as config:
+            verdicts, elapsed = replay_engine(records, config.read(), args.bus,
+                                              args.speed or "max")
+        allowed = sum(1 for _record, index in verdicts if index is not None)
+        print "{count} messages, {allowed} allowed, {rejected} rejected in " \
+              "{elapsed:.3f} s, {rate:.0f} messages/s".format(**{
+                  "count": len(verdicts),
+                  "allowed": allowed,
+                  "rejected": len(verdicts) - allowed,
+                  "elapsed": elapsed,
+                  "rate": len(verdicts) / elapsed if elapsed > 0 else 0
+              })
+    else:
+        sent, elapsed = replay_live(records, args.address, args.destination,
+                                    args.speed or "original")
+        print "{sent} messages sent in {elapsed:.3f} s, {rate:.0f} " \
+              "messages/s".format(sent=sent, elapsed=elapsed,
+                                  rate=sent / elapsed if elapsed > 0 else 0)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -45,18 +45,26 @@ DBusGMainLoop(set_as_default=True)
     There are two methods on each interface.
 
     Object1 also implements GetAll and Get on the "org.freedesktop.DBus.Properties"
-    interface. Object2 implements GetAll on the same interface.
+    interface, and emits PropertiesChanged when EmitPropertiesChanged is
+    called. Object1 emits Broadcast signals in a burst or as a steady storm
+    when asked to. Object2 implements GetAll on the same interface.
 
     On the bus it all looks like this:
 
     /Object1
         com.service.TestInterface1._1
             Method1
+            EmitPropertiesChanged
+            EmitBroadcasts
+            StartBroadcastStorm
+            StopBroadcastStorm
+            Broadcast (signal)
         com.service.TestInterface1._1._2
             Method2
         com.freedesktop.DBus.Properties
             GetAll
             Get
+            PropertiesChanged (signal)
     /Object2
         com.service.TestInterface2._1
             Method1
@@ -115,6 +123,14 @@ PROP_VALUE_1 = "my_value_1."
 PROP_KEY_2 = "MyKey2."
 PROP_VALUE_2 = "my_value_2."
 
+EMIT_PROPERTIES_CHANGED = "EmitPropertiesChanged"
+CHANGE_PROPERTY = "ChangeProperty"
+
+EMIT_BROADCASTS = "EmitBroadcasts"
+START_BROADCAST_STORM = "StartBroadcastStorm"
+STOP_BROADCAST_STORM = "StopBroadcastStorm"
+BROADCAST = "Broadcast"
+
 
 class TestService1(dbus.service.Object):
     """This D-Bus service exposes multiple interfaces on one
@@ -127,6 +143,9 @@ class TestService1(dbus.service.Object):
 
         # Some nonsensical properties so there is something to return
         # from GetAll
+        self.__storm = None
+        self.__broadcasts = 0
+
         self.__properties = dict()
         ifaces = [TestInterface1_1, TestInterface1_1_2]
         for iface in ifaces:
@@ -168,6 +187,88 @@ class TestService1(dbus.service.Object):
 
         return {"error": "error"}
 
+    @dbus.service.method(TestInterface1_1,
+                         in_signature="uu", out_signature="")
+    def EmitPropertiesChanged(self, count, size):
+        """ Emit 'count' PropertiesChanged signals for TestInterface1_1.
+            Signal i changes "Counter" and "Key<i % 4>" to i, and "Payload"
+            to a string of 'size' characters.
+        """
+        debug(TestInterface1_1 + "." + EMIT_PROPERTIES_CHANGED + " " +
+              "was called with count " + str(count))
+        for i in range(0, count):
+            self.PropertiesChanged(TestInterface1_1,
+                                   {"Counter": dbus.UInt32(i),
+                                    "Key" + str(i % 4): dbus.UInt32(i),
+                                    "Payload": "x" * size},
+                                   dbus.Array([], signature="s"))
+
+    @dbus.service.method(TestInterface1_1,
+                         in_signature="sss", out_signature="")
+    def ChangeProperty(self, iface, key, value):
+        """ Change a property of 'iface' and emit PropertiesChanged for it.
+        """
+        debug(TestInterface1_1 + "." + CHANGE_PROPERTY + " " +
+              "was called with key \"" + key + "\"")
+        self.__properties[iface][key] = value
+        self.PropertiesChanged(iface, {key: value}, dbus.Array([], signature="s"))
+
+    @dbus.service.signal(dbus.PROPERTIES_IFACE, signature="sa{sv}as")
+    def PropertiesChanged(self, iface, changed, invalidated):
+        pass
+
+    @dbus.service.method(TestInterface1_1,
+                         in_signature="uu", out_signature="")
+    def EmitBroadcasts(self, count, size):
+        """ Emit 'count' Broadcast signals with a payload of 'size'
+            characters, before replying.
+        """
+        debug(TestInterface1_1 + "." + EMIT_BROADCASTS + " " +
+              "was called with count " + str(count))
+        payload = "x" * size
+        for _x in range(0, count):
+            self.__broadcast(payload)
+
+    @dbus.service.method(TestInterface1_1,
+                         in_signature="uu", out_signature="")
+    def StartBroadcastStorm(self, burst, size):
+        """ Emit 'burst' Broadcast signals with a payload of 'size'
+            characters each time the main loop is idle, until
+            StopBroadcastStorm is called. Calls are still served between the
+            bursts.
+        """
+        debug(TestInterface1_1 + "." + START_BROADCAST_STORM + " " +
+              "was called with burst " + str(burst))
+        payload = "x" * size
+
+        def emit_burst():
+            for _x in range(0, burst):
+                self.__broadcast(payload)
+            return True
+
+        if self.__storm is None:
+            self.__storm = gobject.idle_add(emit_burst)
+
+    @dbus.service.method(TestInterface1_1,
+                         in_signature="", out_signature="u")
+    def StopBroadcastStorm(self):
+        """ Stop the storm and return the number of Broadcast signals
+            emitted so far.
+        """
+        debug(TestInterface1_1 + "." + STOP_BROADCAST_STORM + " was called")
+        if self.__storm is not None:
+            gobject.source_remove(self.__storm)
+            self.__storm = None
+        return self.__broadcasts
+
+    def __broadcast(self, payload):
+        self.Broadcast(dbus.UInt32(self.__broadcasts), payload)
+        self.__broadcasts += 1
+
+    @dbus.service.signal(TestInterface1_1, signature="us")
+    def Broadcast(self, sequence, payload):
+        pass
+
 
 class TestService2(dbus.service.Object):
     """This D-Bus service exposes multiple interfaces on one
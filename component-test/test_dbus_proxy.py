@@ -22,12 +22,17 @@
 import pytest
 
 import dbus
+import gobject
+import json
+import os
+import signal
 
 from os import environ
 from subprocess import Popen, PIPE
 from time import sleep
 
 import service_stubs as stubs
+from replay_capture import read_capture, replay_engine
 
 
 """
@@ -315,8 +320,6 @@ class TestProxyRobustness(object):
         # it fails.
         dbus_proxy.set_config(TestProxyRobustness.CONF_RESTRICT_ALL)
 
-        sleep(0.3)
-
         dbus_send_process = Popen(dbus_send_command,
                                   env=environment,
                                   stdout=PIPE)
@@ -327,7 +330,36 @@ class TestProxyRobustness(object):
         # it works.
         dbus_proxy.set_config(TestProxyRobustness.CONF_ALLOW_ALL)
 
-        sleep(0.3)
+        dbus_send_process = Popen(dbus_send_command,
+                                  env=environment,
+                                  stdout=PIPE)
+        captured_stdout = dbus_send_process.communicate()[0]
+        assert "My unique key" in captured_stdout
+
+    def test_invalid_config_is_acknowledged_and_ignored(self,
+                                                        session_bus,
+                                                        service_on_outside,
+                                                        dbus_proxy):
+        """ Assert a config that can not be parsed gets an error ack, and that
+            the rules of the previous config are kept.
+        """
+        environment = environ.copy()
+
+        dbus_send_command = [
+            "dbus-send",
+            "--address=" + dbus_proxy.INSIDE_SOCKET,
+            "--print-reply",
+            "--dest=" + stubs.BUS_NAME,
+            stubs.OPATH_1,
+            stubs.IFACE_1 + "." + stubs.EXT_1 + "." + stubs.METHOD_1,
+            'string:"My unique key"']
+
+        ack = dbus_proxy.set_config(TestProxyRobustness.CONF_ALLOW_ALL)
+        assert ack == {"config": 1, "status": "ok"}
+
+        ack = dbus_proxy.set_config(TestProxyRobustness.CONF_ALLOW_ALL[:-20])
+        assert ack["config"] == 2
+        assert ack["status"] == "error"
 
         dbus_send_process = Popen(dbus_send_command,
                                   env=environment,
@@ -335,6 +367,85 @@ class TestProxyRobustness(object):
         captured_stdout = dbus_send_process.communicate()[0]
         assert "My unique key" in captured_stdout
 
+    def test_line_configs_are_read(self,
+                                   session_bus,
+                                   service_on_outside,
+                                   dbus_proxy_line_config):
+        """ Assert configs are still read one per line without
+            --framed-config.
+        """
+        dbus_proxy_line_config.set_config(TestProxyRobustness.CONF_ALLOW_ALL)
+
+        dbus_send_process = Popen([
+                "dbus-send",
+                "--address=" + dbus_proxy_line_config.INSIDE_SOCKET,
+                "--print-reply",
+                "--dest=" + stubs.BUS_NAME,
+                stubs.OPATH_1,
+                stubs.IFACE_1 + "." + stubs.EXT_1 + "." + stubs.METHOD_1,
+                'string:"My unique key"'],
+            env=environ.copy(),
+            stdout=PIPE)
+        captured_stdout = dbus_send_process.communicate()[0]
+        assert "My unique key" in captured_stdout
+
+    def test_first_match_among_many_rules(self, session_bus, service_on_outside, dbus_proxy):
+        """ Assert a matching rule is found after a large number of rules that
+            do not match.
+
+            The rules are evaluated in chunks, the number of rules is chosen so
+            the matching rule is not in the first chunk.
+        """
+        non_matching_rule = """{{
+            "direction": "outgoing",
+            "interface": "{iface}.{extension_1}",
+            "object-path": "/a/path/to/unavailable/directory/{index}",
+            "method": "*"
+        }}"""
+        matching_rule = """{{
+            "direction": "outgoing",
+            "interface": "{iface}.{extension_1}",
+            "object-path": "{opath}",
+            "method": "{method}"
+        }}""".format(**{
+            "iface": stubs.IFACE_1,
+            "extension_1": stubs.EXT_1,
+            "opath": stubs.OPATH_1,
+            "method": stubs.METHOD_1
+        })
+
+        config_rules = [non_matching_rule.format(**{
+            "iface": stubs.IFACE_1,
+            "extension_1": stubs.EXT_1,
+            "index": index
+        }) for index in range(0, 150)]
+        config_rules.append(matching_rule)
+
+        config = """
+        {{
+            "dbus-gateway-config-session": [{rules}],
+            "dbus-gateway-config-system": []
+        }}
+        """.format(rules=",".join(config_rules))
+
+        dbus_proxy.set_config(config)
+
+        dbus_send_command = [
+            "dbus-send",
+            "--address=" + dbus_proxy.INSIDE_SOCKET,
+            "--print-reply",
+            "--dest=" + stubs.BUS_NAME,
+            stubs.OPATH_1,
+            stubs.IFACE_1 + "." + stubs.EXT_1 + "." + stubs.METHOD_1,
+            'string:"My unique key"']
+
+        environment = environ.copy()
+        dbus_send_process = Popen(dbus_send_command,
+                                  env=environment,
+                                  stdout=PIPE)
+        captured_stdout = dbus_send_process.communicate()[0]
+        assert "My unique key" in captured_stdout
+
     @pytest.mark.parametrize("config", [CONF_ALLOW_ALL])
     def test_proxy_handles_many_calls(self, session_bus, service_on_outside, dbus_proxy, config):
         """ Assert dbus-proxy doesn't crash due to fd and zombie process leaks.
@@ -448,6 +559,717 @@ class TestProxyRobustness(object):
         assert "My unique key" in inside_object.get_response()[0]
 
 
+class TestMultipleSockets(object):
+
+    CONF_ALLOW_ALL = TestProxyRobustness.CONF_ALLOW_ALL
+
+    def test_all_sockets_are_proxied(self,
+                                     session_bus,
+                                     service_on_outside,
+                                     dbus_proxy_two_sockets):
+        """ Assert one dbus-proxy can listen on more than one inside socket,
+            and that the config applies to all sockets for the same bus type.
+        """
+        dbus_proxy_two_sockets.set_config(TestMultipleSockets.CONF_ALLOW_ALL)
+
+        for inside_socket in [dbus_proxy_two_sockets.INSIDE_SOCKET,
+                              dbus_proxy_two_sockets.INSIDE_SOCKET_2]:
+            dbus_send_command = [
+                "dbus-send",
+                "--address=" + inside_socket,
+                "--print-reply",
+                "--dest=" + stubs.BUS_NAME,
+                stubs.OPATH_1,
+                stubs.IFACE_1 + "." + stubs.EXT_1 + "." + stubs.METHOD_1,
+                'string:"My unique key"']
+
+            environment = environ.copy()
+            dbus_send_process = Popen(dbus_send_command,
+                                      env=environment,
+                                      stdout=PIPE)
+            captured_stdout = dbus_send_process.communicate()[0]
+            assert "My unique key" in captured_stdout
+
+
+class TestAuditLog(object):
+
+    CONF_METHOD_1_ONLY = """
+    {{
+        "dbus-gateway-config-session": [{{
+            "direction": "incoming",
+            "interface": "*",
+            "object-path": "*",
+            "method": "*"
+        }},
+        {{
+            "direction": "outgoing",
+            "interface": "*",
+            "object-path": "{opath}",
+            "method": "{method_1}"
+        }}],
+        "dbus-gateway-config-system": []
+    }}
+    """.format(**{
+        "opath": stubs.OPATH_1,
+        "method_1": stubs.METHOD_1
+    })
+
+    def test_verdicts_are_audited(self,
+                                  session_bus,
+                                  service_on_outside,
+                                  dbus_proxy_audited):
+        """ Assert that accepted and rejected calls are written to the audit
+            log with the rule that matched them.
+        """
+        dbus_proxy_audited.set_config(TestAuditLog.CONF_METHOD_1_ONLY)
+
+        for method in [stubs.METHOD_1, stubs.METHOD_2]:
+            dbus_send_command = [
+                "dbus-send",
+                "--address=" + dbus_proxy_audited.INSIDE_SOCKET,
+                "--print-reply",
+                "--dest=" + stubs.BUS_NAME,
+                stubs.OPATH_1,
+                stubs.IFACE_1 + "." + stubs.EXT_1 + "." + method,
+                'string:"My unique key"']
+
+            environment = environ.copy()
+            dbus_send_process = Popen(dbus_send_command,
+                                      env=environment,
+                                      stdout=PIPE,
+                                      stderr=PIPE)
+            dbus_send_process.communicate()
+
+        # Allow the records to be flushed
+        sleep(0.3)
+
+        with open(dbus_proxy_audited.AUDIT_LOG) as audit_log:
+            records = [json.loads(line) for line in audit_log]
+
+        outgoing = [record for record in records
+                    if record.get("direction") == "outgoing"]
+        accepted = [record for record in outgoing
+                    if record["member"] == stubs.METHOD_1]
+        rejected = [record for record in outgoing
+                    if record["member"] == stubs.METHOD_2]
+
+        assert accepted[0]["verdict"] == "accept"
+        assert accepted[0]["rule"] == 1
+        assert accepted[0]["path"] == stubs.OPATH_1
+        assert rejected[0]["verdict"] == "reject"
+        assert rejected[0]["rule"] is None
+
+
+class TestCapture(object):
+
+    CONF_METHOD_1_ONLY = TestAuditLog.CONF_METHOD_1_ONLY
+
+    def test_captured_messages_replay_with_the_same_verdicts(self,
+                                                             session_bus,
+                                                             service_on_outside,
+                                                             dbus_proxy_captured):
+        """ Assert that calls and their replies are captured with their
+            header fields and whole messages, and that replaying the capture
+            through the rule engine gives the verdicts of the proxy.
+        """
+        dbus_proxy = dbus_proxy_captured
+        dbus_proxy.set_config(TestCapture.CONF_METHOD_1_ONLY)
+
+        bus = dbus.bus.BusConnection(dbus_proxy.INSIDE_SOCKET)
+        remote_object = bus.get_object(stubs.BUS_NAME, stubs.OPATH_1, introspect=False)
+        remote_object.get_dbus_method(stubs.METHOD_1, stubs.TestInterface1_1)("key")
+        with pytest.raises(dbus.exceptions.DBusException):
+            remote_object.get_dbus_method(stubs.METHOD_2, stubs.TestInterface1_1_2)("key")
+        bus.close()
+
+        # Allow the records to be flushed
+        sleep(0.3)
+
+        records = list(read_capture(dbus_proxy.CAPTURE))
+        calls = [record for record in records
+                 if record.direction == "outgoing" and
+                 record.path == stubs.OPATH_1]
+        assert [record.member for record in calls] == [stubs.METHOD_1, stubs.METHOD_2]
+        for record in calls:
+            assert record.destination == stubs.BUS_NAME
+            assert record.size > 0
+            assert len(record.message) == record.size
+        assert any(record.direction == "incoming" for record in records)
+
+        verdicts, _elapsed = replay_engine(calls, TestCapture.CONF_METHOD_1_ONLY)
+        assert [index is not None for _record, index in verdicts] == [True, False]
+
+
+class TestLatency(object):
+
+    CONF_METHOD_1_ONLY = TestAuditLog.CONF_METHOD_1_ONLY
+
+    CALLS = 20
+
+    def test_dispatch_times_are_logged(self,
+                                       session_bus,
+                                       service_on_outside,
+                                       dbus_proxy_timed):
+        """ Assert that the process serving a client writes histograms of
+            the times it took to filter messages in both directions when it
+            exits.
+        """
+        dbus_proxy = dbus_proxy_timed
+        dbus_proxy.set_config(TestLatency.CONF_METHOD_1_ONLY)
+
+        bus = dbus.bus.BusConnection(dbus_proxy.INSIDE_SOCKET)
+        remote_object = bus.get_object(stubs.BUS_NAME, stubs.OPATH_1, introspect=False)
+        method = remote_object.get_dbus_method(stubs.METHOD_1, stubs.TestInterface1_1)
+        for _x in range(0, TestLatency.CALLS):
+            method("key")
+        bus.close()
+
+        # Allow the child to exit
+        sleep(0.5)
+
+        with open(dbus_proxy.LATENCY_LOG) as latency_log:
+            histograms = dict((line["point"], line)
+                              for line in (json.loads(text) for text in latency_log)
+                              if line["pid"] != dbus_proxy.PID)
+
+        assert histograms["outgoing"]["count"] >= TestLatency.CALLS
+        assert histograms["incoming"]["count"] >= TestLatency.CALLS
+        for histogram in histograms.values():
+            assert histogram["stalls"] == 0
+            assert histogram["p50_us"] <= histogram["p99_us"] <= histogram["max_us"]
+            assert sum(count for _value, count in histogram["buckets_ns"]) == \
+                histogram["count"]
+
+
+class TestCoalescing(object):
+
+    CONF_COALESCE = """
+    {{
+        "dbus-gateway-config-session": [{{
+            "direction": "outgoing",
+            "interface": "*",
+            "object-path": "*",
+            "method": "*"
+        }},
+        {{
+            "direction": "incoming",
+            "interface": "{properties}",
+            "object-path": "{opath}",
+            "method": "PropertiesChanged",
+            "coalesce": true
+        }}],
+        "dbus-gateway-config-system": []
+    }}
+    """.format(**{
+        "properties": dbus.PROPERTIES_IFACE,
+        "opath": stubs.OPATH_1
+    })
+
+    SIGNALS = 2000
+
+    PAYLOAD = 1024
+
+    def test_slow_client_gets_the_latest_state(self,
+                                               session_bus,
+                                               service_on_outside,
+                                               dbus_proxy):
+        """ Assert that a client that does not read while a service emits
+            many PropertiesChanged signals gets fewer of them, in order, and
+            that the properties it ends up with are the latest ones.
+        """
+        dbus_proxy.set_config(TestCoalescing.CONF_COALESCE)
+
+        counters = []
+        state = {}
+
+        def properties_changed(iface, changed, invalidated):
+            counters.append(changed["Counter"])
+            state.update(changed)
+
+        bus = dbus.bus.BusConnection(dbus_proxy.INSIDE_SOCKET)
+        bus.add_signal_receiver(properties_changed,
+                                signal_name="PropertiesChanged",
+                                dbus_interface=dbus.PROPERTIES_IFACE,
+                                path=stubs.OPATH_1)
+        remote_object = bus.get_object(stubs.BUS_NAME, stubs.OPATH_1, introspect=False)
+        emit = remote_object.get_dbus_method(stubs.EMIT_PROPERTIES_CHANGED,
+                                             stubs.TestInterface1_1)
+
+        # Nothing is read from the proxy until the main loop runs
+        emit(dbus.UInt32(TestCoalescing.SIGNALS),
+             dbus.UInt32(TestCoalescing.PAYLOAD),
+             ignore_reply=True)
+        sleep(2)
+
+        loop = gobject.MainLoop()
+        gobject.timeout_add(3000, loop.quit)
+        loop.run()
+        bus.close()
+
+        expected = {"Counter": TestCoalescing.SIGNALS - 1,
+                    "Payload": "x" * TestCoalescing.PAYLOAD}
+        for i in range(0, TestCoalescing.SIGNALS):
+            expected["Key" + str(i % 4)] = i
+
+        assert len(counters) < TestCoalescing.SIGNALS
+        assert counters == sorted(counters)
+        assert state == expected
+
+
+class TestPriorityLanes(object):
+
+    CONF_ALLOW_ALL = """
+    {
+        "dbus-gateway-config-session": [{
+            "direction": "*",
+            "interface": "*",
+            "object-path": "*",
+            "method": "*"
+        }],
+        "dbus-gateway-config-system": []
+    }
+    """
+
+    SIGNALS = 2000
+
+    PAYLOAD = 1024
+
+    def test_reply_overtakes_signals(self,
+                                     session_bus,
+                                     service_on_outside,
+                                     dbus_proxy_lanes):
+        """ Assert that the reply to a call of a client that is behind on
+            signals reaches it before most of the signals sent before it,
+            and that the signals still arrive, all of them and in order.
+        """
+        dbus_proxy = dbus_proxy_lanes
+        dbus_proxy.set_config(TestPriorityLanes.CONF_ALLOW_ALL)
+
+        sequences = []
+        replies = []
+
+        def broadcast(sequence, payload):
+            sequences.append(sequence)
+
+        def reply(message):
+            replies.append(len(sequences))
+
+        bus = dbus.bus.BusConnection(dbus_proxy.INSIDE_SOCKET)
+        bus.add_signal_receiver(broadcast,
+                                signal_name=stubs.BROADCAST,
+                                dbus_interface=stubs.TestInterface1_1,
+                                path=stubs.OPATH_1)
+        remote_object = bus.get_object(stubs.BUS_NAME, stubs.OPATH_1, introspect=False)
+
+        outside_bus = dbus.bus.BusConnection(dbus_proxy.OUTSIDE_SOCKET)
+        outside_object = outside_bus.get_object(stubs.BUS_NAME, stubs.OPATH_1,
+                                                introspect=False)
+
+        # Nothing is read from the proxy until the main loop runs
+        outside_object.get_dbus_method(stubs.EMIT_BROADCASTS, stubs.TestInterface1_1)(
+            dbus.UInt32(TestPriorityLanes.SIGNALS),
+            dbus.UInt32(TestPriorityLanes.PAYLOAD))
+        remote_object.get_dbus_method(stubs.METHOD_1, stubs.TestInterface1_1)(
+            "key", reply_handler=reply, error_handler=replies.append)
+        sleep(1)
+
+        loop = gobject.MainLoop()
+        gobject.timeout_add(3000, loop.quit)
+        loop.run()
+        bus.close()
+        outside_bus.close()
+
+        assert len(replies) == 1
+        assert replies[0] < TestPriorityLanes.SIGNALS
+        assert sequences == range(0, TestPriorityLanes.SIGNALS)
+
+
+class TestRateLimits(object):
+
+    CONF_RULE_LIMIT = """
+    {
+        "dbus-gateway-config-session": [{
+            "direction": "outgoing",
+            "interface": "*",
+            "object-path": "*",
+            "method": "*",
+            "rate-limit": {
+                "messages-per-second": 1
+            }
+        },
+        {
+            "direction": "incoming",
+            "interface": "*",
+            "object-path": "*",
+            "method": "*"
+        }],
+        "dbus-gateway-config-system": []
+    }
+    """
+
+    CONF_CONNECTION_LIMIT = """
+    {
+        "dbus-gateway-config-session": [{
+            "direction": "*",
+            "interface": "*",
+            "object-path": "*",
+            "method": "*"
+        }],
+        "dbus-gateway-rate-limit-session": {
+            "messages-per-second": 1,
+            "error": "org.example.Error.TooManyCalls"
+        },
+        "dbus-gateway-config-system": []
+    }
+    """
+
+    @pytest.mark.parametrize("config, error_name", [
+        (CONF_RULE_LIMIT, "org.freedesktop.DBus.Error.LimitsExceeded"),
+        (CONF_CONNECTION_LIMIT, "org.example.Error.TooManyCalls")
+    ])
+    def test_calls_over_limit_get_error(self,
+                                        session_bus,
+                                        service_on_outside,
+                                        dbus_proxy,
+                                        config,
+                                        error_name):
+        """ Assert that a call within the limit is forwarded, and that a call
+            right after it is replied to with the error of the limit.
+        """
+        dbus_proxy.set_config(config)
+
+        bus = dbus.bus.BusConnection(dbus_proxy.INSIDE_SOCKET)
+        remote_object = bus.get_object(stubs.BUS_NAME, stubs.OPATH_1, introspect=False)
+        method = remote_object.get_dbus_method(stubs.METHOD_1, stubs.TestInterface1_1)
+
+        assert "My unique key" in method("My unique key")
+
+        with pytest.raises(dbus.exceptions.DBusException) as exception:
+            method("My unique key")
+        assert exception.value.get_dbus_name() == error_name
+
+        bus.close()
+
+
+class TestNameQueries(object):
+
+    CONF_FILTERED = """
+    {
+        "dbus-gateway-config-session": [{
+            "direction": "outgoing",
+            "interface": "org.freedesktop.DBus",
+            "object-path": "/org/freedesktop/DBus",
+            "method": "*"
+        },
+        {
+            "direction": "incoming",
+            "interface": "*",
+            "object-path": "*",
+            "method": "*"
+        }],
+        "dbus-gateway-config-system": []
+    }
+    """
+
+    def test_name_queries_match_the_bus(self,
+                                        session_bus,
+                                        service_on_outside,
+                                        dbus_proxy):
+        """ Assert that queries about names, which the proxy answers from its
+            cache, give the same answers as the bus itself.
+        """
+        dbus_proxy.set_config(TestNameQueries.CONF_FILTERED)
+
+        outside_bus = dbus.bus.BusConnection(dbus_proxy.OUTSIDE_SOCKET)
+        inside_bus = dbus.bus.BusConnection(dbus_proxy.INSIDE_SOCKET)
+
+        # Allow the proxy to fill its cache
+        sleep(0.3)
+
+        assert inside_bus.name_has_owner(stubs.BUS_NAME)
+        assert not inside_bus.name_has_owner("org.example.NoSuchName")
+        assert inside_bus.get_name_owner(stubs.BUS_NAME) == \
+            outside_bus.get_name_owner(stubs.BUS_NAME)
+        # The second query is answered with the owner learned from the first
+        assert inside_bus.get_name_owner(stubs.BUS_NAME) == \
+            outside_bus.get_name_owner(stubs.BUS_NAME)
+        assert stubs.BUS_NAME in inside_bus.list_names()
+        assert inside_bus.get_unique_name() in inside_bus.list_names()
+
+        with pytest.raises(dbus.exceptions.DBusException) as exception:
+            inside_bus.get_name_owner("org.example.NoSuchName")
+        assert exception.value.get_dbus_name() == \
+            "org.freedesktop.DBus.Error.NameHasNoOwner"
+
+        inside_bus.close()
+        outside_bus.close()
+
+
+class TestIntrospection(object):
+
+    CONF_METHOD_1_ONLY = """
+    {{
+        "dbus-gateway-config-session": [{{
+            "direction": "outgoing",
+            "interface": "org.freedesktop.DBus.Introspectable",
+            "object-path": "{opath}",
+            "method": "Introspect"
+        }},
+        {{
+            "direction": "outgoing",
+            "interface": "{iface}",
+            "object-path": "{opath}",
+            "method": "{method_1}"
+        }},
+        {{
+            "direction": "incoming",
+            "interface": "*",
+            "object-path": "*",
+            "method": "*"
+        }}],
+        "dbus-gateway-config-system": []
+    }}
+    """.format(**{
+        "iface": stubs.TestInterface1_1,
+        "opath": stubs.OPATH_1,
+        "method_1": stubs.METHOD_1
+    })
+
+    def test_introspection_is_pruned_and_cached(self,
+                                                session_bus,
+                                                service_on_outside,
+                                                dbus_proxy_introspect):
+        """ Assert that introspection data through the proxy only has the
+            interfaces with methods the rules allow, and that a repeated call
+            gets the same data.
+        """
+        dbus_proxy_introspect.set_config(TestIntrospection.CONF_METHOD_1_ONLY)
+
+        bus = dbus.bus.BusConnection(dbus_proxy_introspect.INSIDE_SOCKET)
+        remote_object = bus.get_object(stubs.BUS_NAME, stubs.OPATH_1, introspect=False)
+
+        xml = remote_object.Introspect(dbus_interface=dbus.INTROSPECTABLE_IFACE)
+
+        assert '"' + stubs.TestInterface1_1 + '"' in xml
+        assert stubs.METHOD_1 in xml
+        assert '"' + stubs.TestInterface1_1_2 + '"' not in xml
+        assert dbus.PROPERTIES_IFACE not in xml
+
+        assert remote_object.Introspect(dbus_interface=dbus.INTROSPECTABLE_IFACE) == xml
+
+        bus.close()
+
+
+class TestChildRegistry(object):
+
+    CONF_ALLOW_ALL = TestProxyRobustness.CONF_ALLOW_ALL
+
+    def read_registry(self, dbus_proxy):
+        with open(dbus_proxy.CHILD_REGISTRY) as registry:
+            return json.load(registry)
+
+    def test_children_are_registered_and_reaped(self,
+                                                session_bus,
+                                                service_on_outside,
+                                                dbus_proxy_child_registry):
+        """ Assert that the process serving a client is in the registry with
+            the credentials of the client, and that it is gone once the
+            client disconnects.
+        """
+        dbus_proxy = dbus_proxy_child_registry
+        dbus_proxy.set_config(TestChildRegistry.CONF_ALLOW_ALL)
+
+        bus = dbus.bus.BusConnection(dbus_proxy.INSIDE_SOCKET)
+        remote_object = bus.get_object(stubs.BUS_NAME, stubs.OPATH_1, introspect=False)
+        remote_object.get_dbus_method(stubs.METHOD_1, stubs.TestInterface1_1)("key")
+
+        # The registry is written on request
+        os.kill(dbus_proxy.PID, signal.SIGUSR1)
+        sleep(0.3)
+
+        registry = self.read_registry(dbus_proxy)
+        assert registry["pid"] == dbus_proxy.PID
+        assert registry["forked"] == 1
+        assert len(registry["children"]) == 1
+        child = registry["children"][0]
+        assert child["client-pid"] == os.getpid()
+        assert child["client-uid"] == os.getuid()
+        assert child["bus"] == "session"
+        assert child["idle"] < 1
+
+        bus.close()
+
+        # The registry is written again a second after the child exited
+        sleep(1.5)
+
+        registry = self.read_registry(dbus_proxy)
+        assert registry["exited"] == 1
+        assert registry["children"] == []
+
+    def test_clients_over_the_limit_are_refused(self,
+                                                session_bus,
+                                                service_on_outside,
+                                                dbus_proxy_limited):
+        """ Assert that a second client is refused while one is served, and
+            that the refusal is counted.
+        """
+        dbus_proxy = dbus_proxy_limited
+        dbus_proxy.set_config(TestChildRegistry.CONF_ALLOW_ALL)
+
+        bus = dbus.bus.BusConnection(dbus_proxy.INSIDE_SOCKET)
+
+        with pytest.raises(dbus.exceptions.DBusException):
+            dbus.bus.BusConnection(dbus_proxy.INSIDE_SOCKET)
+
+        os.kill(dbus_proxy.PID, signal.SIGUSR1)
+        sleep(0.3)
+
+        registry = self.read_registry(dbus_proxy)
+        assert registry["refused"] == 1
+        assert len(registry["children"]) == 1
+
+        bus.close()
+
+    def test_idle_clients_are_disconnected(self,
+                                           session_bus,
+                                           service_on_outside,
+                                           dbus_proxy_limited):
+        """ Assert that a client without messages for longer than the idle
+            timeout is disconnected, and that it is counted.
+        """
+        dbus_proxy = dbus_proxy_limited
+        dbus_proxy.set_config(TestChildRegistry.CONF_ALLOW_ALL)
+
+        bus = dbus.bus.BusConnection(dbus_proxy.INSIDE_SOCKET)
+        remote_object = bus.get_object(stubs.BUS_NAME, stubs.OPATH_1, introspect=False)
+        method = remote_object.get_dbus_method(stubs.METHOD_1, stubs.TestInterface1_1)
+        method("key")
+
+        # The limit is checked every second, and the registry is written a
+        # second after the child exited
+        sleep(4.5)
+
+        with pytest.raises(dbus.exceptions.DBusException):
+            method("key")
+
+        registry = self.read_registry(dbus_proxy)
+        assert registry["idle-reaped"] == 1
+        assert registry["children"] == []
+
+
+class TestRuleEngine(object):
+
+    def test_compiled_rules_agree_with_reference(self):
+        """ Assert that the compiled rules give the same verdicts, and find
+            the same first matching rule, as the reference implementation for
+            random configs and messages. The throughput of both is printed.
+        """
+        differential_process = Popen(["../build/rules-differential",
+                                      "--configs=1000",
+                                      "--messages=200"],
+                                     stdout=PIPE,
+                                     stderr=PIPE)
+        captured_stdout, captured_stderr = differential_process.communicate()
+        print captured_stdout
+
+        assert differential_process.returncode == 0, captured_stderr
+        assert " 0 mismatches" in captured_stdout
+
+
+class TestCheckConfig(object):
+
+    CONF_VALID = """
+    {
+        "dbus-gateway-config-session": [{
+            "direction": "outgoing",
+            "interface": "com.example.*",
+            "object-path": "/com/example",
+            "method": ["Get", "Set"]
+        }],
+        "dbus-gateway-config-system": []
+    }
+    """
+
+    CONF_SHADOWED_AND_BROKEN = """
+    {
+        "dbus-gateway-config-session": [{
+            "direction": "*",
+            "interface": "com.example.*",
+            "object-path": "*",
+            "method": "*"
+        },
+        {
+            "direction": "outgoing",
+            "interface": "com.example.Foo",
+            "object-path": "/com/example",
+            "method": "Get"
+        },
+        {
+            "direction": "outgoing",
+            "interface": "com.example.Foo",
+            "method": "Get"
+        }],
+        "dbus-gateway-config-system": []
+    }
+    """
+
+    def check_config(self, config, options=[]):
+        check_process = Popen(["../build/dbus-proxy", "--check-config"] + options,
+                              stdin=PIPE,
+                              stdout=PIPE)
+        captured_stdout = check_process.communicate(config)[0]
+        return check_process.returncode, captured_stdout
+
+    def test_valid_config(self):
+        """ Assert that a valid config passes and its cost is reported.
+        """
+        returncode, report = self.check_config(TestCheckConfig.CONF_VALID)
+
+        assert returncode == 0
+        assert "1 glob matches" in report
+        assert "Config OK" in report
+
+    def test_shadowed_and_broken_rules_are_reported(self):
+        """ Assert that a rule missing a field fails the check, and that a
+            rule made redundant by an earlier one is reported.
+        """
+        returncode, report = self.check_config(
+            TestCheckConfig.CONF_SHADOWED_AND_BROKEN)
+
+        assert returncode == 1
+        assert "rule 1: warning: shadowed by rule 0" in report
+        assert "rule 2: error: 'object-path' is missing" in report
+
+    def test_expensive_config_is_rejected(self):
+        """ Assert that a config needing more glob matches per message than
+            allowed fails the check.
+        """
+        returncode, report = self.check_config(TestCheckConfig.CONF_VALID,
+                                               ["--max-cost=0"])
+        assert returncode == 0
+
+        returncode, report = self.check_config(
+            TestCheckConfig.CONF_SHADOWED_AND_BROKEN.replace(
+                '"method": "*"', '"method": "G*"'),
+            ["--max-cost=1"])
+        assert returncode == 1
+        assert "exceed the maximum of 1" in report
+
+    def test_invalid_error_name_is_rejected(self):
+        """ Assert that a rate limit replying with an error name libdbus
+            would refuse fails the check.
+        """
+        config = TestCheckConfig.CONF_VALID.replace(
+            '"method": ["Get", "Set"]',
+            '"method": ["Get", "Set"], '
+            '"rate-limit": {"messages-per-second": 1, "error": "slow down"}')
+        returncode, report = self.check_config(config)
+
+        assert returncode == 1
+        assert "rule 0: error: 'rate-limit' has an 'error' that is not a " \
+               "valid D-Bus error name" in report
+
+
 class TestProxyFiltersInterface(object):
     """ TODO: Parametrize the tests for testing allowed/disallowed?
     """
@@ -1010,6 +1832,118 @@ class TestProxyBehaviorForOrgFreedesktopPropertiesIface(object):
 
         assert "my_value_2" not in captured_stdout
 
+    CONF_CACHED_PROPERTIES = """
+    {{
+        "dbus-gateway-config-session": [{{
+            "direction": "outgoing",
+            "interface": "org.freedesktop.DBus.Properties",
+            "object-path": "{opath}",
+            "method": ["Get", "GetAll"],
+            "property-cache": {{
+                "ttl": 10
+            }}
+        }},
+        {{
+            "direction": "incoming",
+            "interface": "*",
+            "object-path": "*",
+            "method": "*"
+        }}],
+        "dbus-gateway-config-system": []
+    }}
+    """.format(**{
+        "opath": stubs.OPATH_1
+    })
+
+    def test_cached_getall_replies_are_the_same(self,
+                                                session_bus,
+                                                service_on_outside,
+                                                dbus_proxy):
+        """ Assert that a repeated GetAll on a rule with a property cache,
+            which is answered by the proxy, gives the same properties as the
+            first one answered by the service.
+        """
+        dbus_proxy.set_config(
+            TestProxyBehaviorForOrgFreedesktopPropertiesIface.CONF_CACHED_PROPERTIES)
+
+        bus = dbus.bus.BusConnection(dbus_proxy.INSIDE_SOCKET)
+        remote_object = bus.get_object(stubs.BUS_NAME, stubs.OPATH_1, introspect=False)
+
+        first = remote_object.GetAll(stubs.TestInterface1_1,
+                                     dbus_interface=dbus.PROPERTIES_IFACE)
+        second = remote_object.GetAll(stubs.TestInterface1_1,
+                                      dbus_interface=dbus.PROPERTIES_IFACE)
+
+        assert first[stubs.PROP_KEY_1 + stubs.TestInterface1_1] == \
+            stubs.PROP_VALUE_1 + stubs.TestInterface1_1
+        assert second == first
+
+        # Another interface is another entry of the cache
+        other = remote_object.GetAll(stubs.TestInterface1_1_2,
+                                     dbus_interface=dbus.PROPERTIES_IFACE)
+        assert stubs.PROP_KEY_1 + stubs.TestInterface1_1_2 in other
+
+        bus.close()
+
+    CONF_CACHED_PROPERTIES_CHANGED = """
+    {{
+        "dbus-gateway-config-session": [{{
+            "direction": "outgoing",
+            "interface": "org.freedesktop.DBus.Properties",
+            "object-path": "{opath}",
+            "method": ["Get", "GetAll"],
+            "property-cache": {{
+                "ttl": 10
+            }}
+        }},
+        {{
+            "direction": "outgoing",
+            "interface": "{iface}",
+            "object-path": "{opath}",
+            "method": "{change}"
+        }},
+        {{
+            "direction": "incoming",
+            "interface": "*",
+            "object-path": "*",
+            "method": "*"
+        }}],
+        "dbus-gateway-config-system": []
+    }}
+    """.format(**{
+        "opath": stubs.OPATH_1,
+        "iface": stubs.TestInterface1_1,
+        "change": stubs.CHANGE_PROPERTY
+    })
+
+    def test_cached_replies_are_dropped_without_a_match_rule(self,
+                                                             session_bus,
+                                                             service_on_outside,
+                                                             dbus_proxy):
+        """ Assert that a client polling GetAll, which never subscribed to
+            PropertiesChanged, gets the new value once the service changed a
+            property, rather than the cached reply until the ttl runs out.
+        """
+        dbus_proxy.set_config(
+            TestProxyBehaviorForOrgFreedesktopPropertiesIface.CONF_CACHED_PROPERTIES_CHANGED)
+
+        bus = dbus.bus.BusConnection(dbus_proxy.INSIDE_SOCKET)
+        remote_object = bus.get_object(stubs.BUS_NAME, stubs.OPATH_1, introspect=False)
+        key = stubs.PROP_KEY_1 + stubs.TestInterface1_1
+
+        first = remote_object.GetAll(stubs.TestInterface1_1,
+                                     dbus_interface=dbus.PROPERTIES_IFACE)
+        assert first[key] == stubs.PROP_VALUE_1 + stubs.TestInterface1_1
+
+        remote_object.get_dbus_method(stubs.CHANGE_PROPERTY, stubs.TestInterface1_1)(
+            stubs.TestInterface1_1, key, "changed")
+
+        second = remote_object.GetAll(stubs.TestInterface1_1,
+                                      dbus_interface=dbus.PROPERTIES_IFACE)
+        assert second[key] == "changed"
+
+        bus.close()
+
 
 class DBusRemoteObjectHelper(object):
     """ Helper class representing an app running on the inside of the proxy.
@@ -0,0 +1,263 @@
+
+# Copyright (C) 2013-2016 Pelagicore AB  <joakim.gross@pelagicore.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+# Boston, MA  02110-1301, USA.
+#
+
+
+import pytest
+
+import json
+import os
+import sys
+from subprocess import check_output
+from time import time
+
+from dbus_proxy_rules import RuleSet, ConfigError
+
+
+"""
+    Tests of the verdicts of the rule engine, evaluated in process through
+    the Python binding. These need no bus, service or proxy process, the
+    tests in test_dbus_proxy.py cover the behavior on the sockets.
+
+    Each case is a list of rules and a list of (message, expected first
+    matching rule) pairs, where a message is a (direction, interface, path,
+    member) tuple.
+"""
+
+
+IFACE = "com.example.Service"
+OPATH = "/com/example/Service"
+
+
+def rule(direction="*", interface="*", path="*", method="*", **extra):
+    entry = {
+        "direction": direction,
+        "interface": interface,
+        "object-path": path,
+        "method": method
+    }
+    entry.update(extra)
+    return entry
+
+
+def config(rules, bus="session"):
+    return json.dumps({
+        "dbus-gateway-config-" + bus: rules,
+        "dbus-gateway-config-system" if bus == "session" else
+        "dbus-gateway-config-session": []
+    })
+
+
+CASES = {
+    "first match wins": (
+        [rule(direction="outgoing", interface=IFACE), rule()],
+        [(("outgoing", IFACE, OPATH, "Get"), 0),
+         (("incoming", IFACE, OPATH, "Get"), 1)]),
+
+    "direction must match": (
+        [rule(direction="outgoing")],
+        [(("outgoing", IFACE, OPATH, "Get"), 0),
+         (("incoming", IFACE, OPATH, "Get"), None)]),
+
+    "wildcards": (
+        [rule(interface="com.example.*", path="/com/*/Service", method="Get?")],
+        [(("outgoing", IFACE, OPATH, "GetX"), 0),
+         (("outgoing", IFACE, OPATH, "Get"), None),
+         (("outgoing", "org.example.Service", OPATH, "GetX"), None),
+         (("outgoing", IFACE, "/com/example/Other", "GetX"), None)]),
+
+    "literal patterns match whole values": (
+        [rule(interface=IFACE, path=OPATH, method="Get")],
+        [(("outgoing", IFACE, OPATH, "Get"), 0),
+         (("outgoing", IFACE + ".Sub", OPATH, "Get"), None),
+         (("outgoing", IFACE, OPATH + "/child", "Get"), None),
+         (("outgoing", IFACE, OPATH, "GetAll"), None)]),
+
+    "empty strings never match": (
+        [rule(interface=""), rule(method=""), rule(method=["", "Set"])],
+        [(("outgoing", IFACE, OPATH, "Get"), None),
+         (("outgoing", IFACE, OPATH, "Set"), 2)]),
+
+    "missing fields never match": (
+        [{"direction": "*", "interface": "*", "method": "*"}, rule(method="Set")],
+        [(("outgoing", IFACE, OPATH, "Get"), None),
+         (("outgoing", IFACE, OPATH, "Set"), 1)]),
+
+    "fields that are not strings never match": (
+        [rule(interface=42), rule(path=None), rule(method={"name": "Get"})],
+        [(("outgoing", IFACE, OPATH, "Get"), None)]),
+
+    "method arrays stop at an entry that is not a string": (
+        [rule(method=["Get", 42, "Set"])],
+        [(("outgoing", IFACE, OPATH, "Get"), 0),
+         (("outgoing", IFACE, OPATH, "Set"), None)]),
+
+    "rules stop at an entry that is not an object": (
+        [rule(method="Get"), "not a rule", rule()],
+        [(("outgoing", IFACE, OPATH, "Get"), 0),
+         (("outgoing", IFACE, OPATH, "Set"), None)]),
+
+    "messages with missing fields are not allowed": (
+        [rule()],
+        [(("outgoing", None, OPATH, "Get"), None),
+         (("outgoing", IFACE, None, "Get"), None),
+         (("outgoing", IFACE, OPATH, None), None)]),
+
+    "limits and caches do not change the verdict": (
+        [rule(method="Get", **{"rate-limit": {"messages-per-second": 1},
+                               "property-cache": {"ttl": 5}}),
+         rule(method="Set")],
+        [(("outgoing", IFACE, OPATH, "Get"), 0),
+         (("outgoing", IFACE, OPATH, "Set"), 1)]),
+
+    "coalescing does not change the verdict": (
+        [rule(direction="incoming", method="Changed", coalesce=True),
+         rule(direction="incoming")],
+        [(("incoming", IFACE, OPATH, "Changed"), 0),
+         (("incoming", IFACE, OPATH, "Other"), 1)]),
+
+    "lanes do not change the verdict": (
+        [rule(direction="incoming", method="Changed", lane="call"),
+         rule(direction="incoming")],
+        [(("incoming", IFACE, OPATH, "Changed"), 0),
+         (("incoming", IFACE, OPATH, "Other"), 1)]),
+}
+
+
+class TestRuleVerdicts(object):
+
+    @pytest.mark.parametrize("name", sorted(CASES.keys()))
+    def test_verdicts(self, name):
+        """ Assert each message of a case is allowed by the expected rule, or
+            not allowed.
+        """
+        rules, messages = CASES[name]
+        rule_set = RuleSet(config(rules))
+
+        for message, expected in messages:
+            assert rule_set.match(*message) == expected, message
+
+    @pytest.mark.parametrize("name", sorted(CASES.keys()))
+    def test_batches_agree_with_single_messages(self, name):
+        rules, messages = CASES[name]
+        rule_set = RuleSet(config(rules))
+
+        assert rule_set.match_batch([message for message, _x in messages]) == \
+            [expected for _x, expected in messages]
+
+    def test_sections_are_separate(self):
+        """ Assert the rules of the system bus are not used for the session
+            bus.
+        """
+        text = json.dumps({
+            "dbus-gateway-config-session": [],
+            "dbus-gateway-config-system": [rule()]
+        })
+
+        assert not RuleSet(text, "session").is_allowed("outgoing", IFACE, OPATH, "Get")
+        assert RuleSet(text, "system").is_allowed("outgoing", IFACE, OPATH, "Get")
+
+    def test_wildcard_directions_in_a_fresh_process(self):
+        """ Assert rules that only use '*' as direction allow messages in both
+            directions in a process where no rule named a direction before.
+        """
+        script = ("from dbus_proxy_rules import RuleSet\n"
+                  "import json\n"
+                  "rule_set = RuleSet(json.dumps({'dbus-gateway-config-session':"
+                  " [{'direction': '*', 'interface': '*',"
+                  " 'object-path': '*', 'method': '*'}]}))\n"
+                  "print rule_set.match('outgoing', 'a.b', '/a', 'C'), "
+                  "rule_set.match('incoming', 'a.b', '/a', 'C')\n")
+
+        output = check_output([sys.executable, "-c", script],
+                              cwd=os.path.dirname(os.path.abspath(__file__)))
+
+        assert output.split() == ["0", "0"]
+
+    def test_invalid_configs_are_rejected(self):
+        with pytest.raises(ConfigError):
+            RuleSet("{ not json")
+
+        with pytest.raises(ConfigError):
+            RuleSet(json.dumps({"dbus-gateway-config-session": {}}))
+
+    def test_many_rules_are_evaluated_quickly(self):
+        """ Assert thousands of verdicts take milliseconds, with the matching
+            rule after a few hundred that do not match.
+        """
+        rules = [rule(direction="outgoing", interface="{0}.n{1}".format(IFACE, i))
+                 for i in range(0, 300)]
+        rules.append(rule(direction="outgoing", interface=IFACE))
+        rule_set = RuleSet(config(rules))
+
+        messages = [("outgoing", IFACE, OPATH, "Method{0}".format(i % 10))
+                    for i in range(0, 10000)]
+
+        start = time()
+        results = rule_set.match_batch(messages)
+        elapsed = time() - start
+
+        assert results == [300] * len(messages)
+        assert elapsed < 1
+
+
+class TestRuleReordering(object):
+
+    def test_hot_rule_is_moved_before_disjoint_rules(self):
+        """ Assert a rule that decides most messages is evaluated first when
+            no message matches both it and the rules before it, and that it
+            still decides the same messages.
+        """
+        rules = [rule(direction="outgoing", interface="{0}.n{1}".format(IFACE, i))
+                 for i in range(0, 3)]
+        rules.append(rule(direction="outgoing", interface=IFACE))
+        rule_set = RuleSet(config(rules))
+
+        rule_set.match_batch([("outgoing", IFACE, OPATH, "Get")] * 100)
+
+        assert rule_set.reorder()
+        assert rule_set.order() == [3, 0, 1, 2]
+        assert rule_set.match("outgoing", IFACE, OPATH, "Get") == 3
+        assert rule_set.match("outgoing", IFACE + ".n1", OPATH, "Get") == 1
+        assert rule_set.match("incoming", IFACE, OPATH, "Get") is None
+
+    def test_rule_is_not_moved_before_a_rule_that_decides_differently(self):
+        """ Assert a rule is not evaluated before an overlapping rule with a
+            rate limit, which would charge messages against another limit.
+        """
+        rules = [rule(method="Get", **{"rate-limit": {"messages-per-second": 1}}),
+                 rule()]
+        rule_set = RuleSet(config(rules))
+
+        rule_set.match_batch([("outgoing", IFACE, OPATH, "Set")] * 100)
+
+        assert not rule_set.reorder()
+        assert rule_set.order() == [0, 1]
+        assert rule_set.match("outgoing", IFACE, OPATH, "Get") == 0
+
+    def test_rules_that_decide_the_same_may_swap(self):
+        """ Assert overlapping rules without limits or caches are reordered,
+            after which either may be reported for a message both match.
+        """
+        rule_set = RuleSet(config([rule(method="Get"), rule()]))
+
+        rule_set.match_batch([("outgoing", IFACE, OPATH, "Set")] * 100)
+
+        assert rule_set.reorder()
+        assert rule_set.order() == [1, 0]
+        assert rule_set.match("outgoing", IFACE, OPATH, "Get") == 1
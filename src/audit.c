@@ -0,0 +1,238 @@
+/*
+ * Copyright (C) 2013-2016, Pelagicore AB   <joakim.gross@pelagicore.com>
+ *
+ * This library is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU Lesser General Public
+ * License as published by the Free Software Foundation; either
+ * version 2.1 of the License, or (at your option) any later version.
+ *
+ * This library is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ * Lesser General Public License for more details.
+ *
+ * You should have received a copy of the GNU Lesser General Public
+ * License along with this library; if not, write to the
+ * Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+ * Boston, MA  02110-1301, USA.
+ *
+ * For further information see LICENSE
+ */
+
+
+#include "audit.h"
+#include "output.h"
+
+#include <stdlib.h>
+#include <string.h>
+#include <unistd.h>
+
+#include <jansson.h>
+
+
+/*! Records buffered between two flushes */
+#define AUDIT_RING_SIZE 1024
+
+/*! Time from the first buffered record to the flush of the ring buffer */
+#define AUDIT_FLUSH_INTERVAL_MS 100
+
+/*! Longest path or bus name kept in a record, D-Bus names are at most 255 */
+#define AUDIT_NAME_MAX 256
+
+
+/*! A verdict on one message. The direction is a quark, the names in the
+    message are copied since they are not all interned. */
+typedef struct {
+    gint64   time;
+    GQuark   direction;
+    gint     rule_index;
+    gboolean allowed;
+    gchar    interface[AUDIT_NAME_MAX];
+    gchar    member[AUDIT_NAME_MAX];
+    gchar    path[AUDIT_NAME_MAX];
+    gchar    destination[AUDIT_NAME_MAX];
+} AuditRecord;
+
+/*! The audit log, -1 when not auditing */
+static int          audit_fd = -1;
+
+/*! Ring buffer of records not yet written. All proxy processes are single
+    threaded and the ring is only written and flushed from the main loop, so
+    no locking is needed. */
+static AuditRecord *ring      = NULL;
+static guint        ring_head = 0;
+static guint        ring_tail = 0;
+
+static guint        sample_rate      = 1;
+static guint        accepted_count   = 0;
+
+static guint        reject_rate      = 0;
+static gint64       reject_window    = 0;
+static guint        rejects_in_window = 0;
+
+/*! Records lost since the last flush, because the ring was full or the
+    rejection rate limit was hit */
+static guint64      dropped_count    = 0;
+static guint64      suppressed_count = 0;
+
+static OutputBatch  batch = { audit_flush, AUDIT_FLUSH_INTERVAL_MS, 0 };
+
+
+gboolean audit_open (const char *path, guint sample, guint rejects)
+{
+    audit_fd = output_open (path, "audit log");
+    if (audit_fd < 0) {
+        return FALSE;
+    }
+
+    ring        = g_new0 (AuditRecord, AUDIT_RING_SIZE);
+    sample_rate = sample;
+    reject_rate = rejects;
+    output_batch_register (&batch);
+
+    return TRUE;
+}
+
+gboolean audit_enabled (void)
+{
+    return audit_fd >= 0;
+}
+
+void audit_verdict (GQuark               direction,
+                    const MessageHeader *header,
+                    gboolean             allowed,
+                    gint                 rule_index)
+{
+    AuditRecord *record;
+    gint64       now;
+
+    if (audit_fd < 0) {
+        return;
+    }
+
+    if (allowed) {
+        if (sample_rate == 0 || accepted_count++ % sample_rate != 0) {
+            return;
+        }
+    }
+
+    /* Records, and records that are lost, are written by the next flush */
+    output_batch_schedule (&batch);
+
+    now = g_get_real_time ();
+
+    if (!allowed && reject_rate > 0) {
+        if (now - reject_window >= G_USEC_PER_SEC) {
+            reject_window     = now;
+            rejects_in_window = 0;
+        }
+        if (rejects_in_window++ >= reject_rate) {
+            suppressed_count++;
+            return;
+        }
+    }
+
+    if (ring_head - ring_tail >= AUDIT_RING_SIZE) {
+        dropped_count++;
+        return;
+    }
+
+    record = &ring[ring_head % AUDIT_RING_SIZE];
+    record->time       = now;
+    record->direction  = direction;
+    record->rule_index = rule_index;
+    record->allowed    = allowed;
+    g_strlcpy (record->interface,
+               header->interface_name != NULL ? header->interface_name : "",
+               sizeof (record->interface));
+    g_strlcpy (record->member,
+               header->member_name != NULL ? header->member_name : "",
+               sizeof (record->member));
+    g_strlcpy (record->path,
+               header->path != NULL ? header->path : "",
+               sizeof (record->path));
+    g_strlcpy (record->destination,
+               header->destination != NULL ? header->destination : "",
+               sizeof (record->destination));
+
+    ring_head++;
+}
+
+static void append_json_line (GString *lines, json_t *object)
+{
+    char *line;
+
+    line = json_dumps (object, JSON_COMPACT);
+    if (line != NULL) {
+        g_string_append (lines, line);
+        g_string_append_c (lines, '\n');
+        free (line);
+    }
+    json_decref (object);
+}
+
+static json_t *json_string_or_null (const char *string)
+{
+    return string != NULL && string[0] != '\0' ? json_string (string)
+                                               : json_null ();
+}
+
+void audit_flush (void)
+{
+    GString *lines;
+    json_t  *object;
+    pid_t    pid = getpid ();
+
+    if (audit_fd < 0 ||
+        (ring_head == ring_tail && dropped_count == 0 && suppressed_count == 0))
+    {
+        return;
+    }
+
+    lines = g_string_sized_new ((ring_head - ring_tail) * 160);
+
+    for (; ring_tail != ring_head; ring_tail++) {
+        AuditRecord *record = &ring[ring_tail % AUDIT_RING_SIZE];
+
+        object = json_object ();
+        json_object_set_new (object, "time",
+                             json_real (record->time / (double) G_USEC_PER_SEC));
+        json_object_set_new (object, "pid", json_integer (pid));
+        json_object_set_new (object, "direction",
+                             json_string (g_quark_to_string (record->direction)));
+        json_object_set_new (object, "verdict",
+                             json_string (record->allowed ? "accept" : "reject"));
+        json_object_set_new (object, "rule",
+                             record->rule_index >= 0
+                                 ? json_integer (record->rule_index)
+                                 : json_null ());
+        json_object_set_new (object, "interface",
+                             json_string_or_null (record->interface));
+        json_object_set_new (object, "path",
+                             json_string_or_null (record->path));
+        json_object_set_new (object, "member",
+                             json_string_or_null (record->member));
+        json_object_set_new (object, "destination",
+                             json_string_or_null (record->destination));
+        append_json_line (lines, object);
+    }
+
+    if (dropped_count > 0 || suppressed_count > 0) {
+        object = json_object ();
+        json_object_set_new (object, "time",
+                             json_real (g_get_real_time () / (double) G_USEC_PER_SEC));
+        json_object_set_new (object, "pid", json_integer (pid));
+        json_object_set_new (object, "dropped", json_integer (dropped_count));
+        json_object_set_new (object, "suppressed", json_integer (suppressed_count));
+        append_json_line (lines, object);
+
+        dropped_count    = 0;
+        suppressed_count = 0;
+    }
+
+    /* One write per batch, with O_APPEND the lines of different proxy
+       processes do not interleave */
+    output_write (audit_fd, lines->str, lines->len, "audit log");
+
+    g_string_free (lines, TRUE);
+}
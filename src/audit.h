@@ -0,0 +1,63 @@
+/*
+ * Copyright (C) 2013-2016, Pelagicore AB   <joakim.gross@pelagicore.com>
+ *
+ * This library is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU Lesser General Public
+ * License as published by the Free Software Foundation; either
+ * version 2.1 of the License, or (at your option) any later version.
+ *
+ * This library is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ * Lesser General Public License for more details.
+ *
+ * You should have received a copy of the GNU Lesser General Public
+ * License along with this library; if not, write to the
+ * Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+ * Boston, MA  02110-1301, USA.
+ *
+ * For further information see LICENSE
+ */
+
+#ifndef DBUS_PROXY_AUDIT_H
+#define DBUS_PROXY_AUDIT_H
+
+#include "proxy.h"
+
+/*! \brief Open the audit log
+ *
+ * Verdicts are written as JSON lines to the file, which is opened for
+ * appending and shared by all proxy processes forked after this call.
+ *
+ * \param path        The file to append to
+ * \param sample_rate Record one in this many accepted messages, 0 records
+ *                    none of them
+ * \param reject_rate Record at most this many rejected messages per second,
+ *                    0 for no limit
+ * \return FALSE if the file could not be opened
+ */
+gboolean audit_open (const char *path, guint sample_rate, guint reject_rate);
+
+/*! \brief Test if verdicts are audited */
+gboolean audit_enabled (void);
+
+/*! \brief Record the verdict on a message
+ *
+ * This is called on the message path. The record is copied into a ring
+ * buffer and written later in a batch, if the ring buffer is full the record
+ * is dropped and counted.
+ *
+ * \param direction  Direction of the message
+ * \param header     The header fields of the message
+ * \param allowed    The verdict
+ * \param rule_index The rule that allowed the message, or -1 if not known
+ */
+void audit_verdict (GQuark               direction,
+                    const MessageHeader *header,
+                    gboolean             allowed,
+                    gint                 rule_index);
+
+/*! \brief Write all buffered records to the audit log */
+void audit_flush (void);
+
+#endif /* DBUS_PROXY_AUDIT_H */
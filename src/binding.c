@@ -0,0 +1,137 @@
+/*
+ * Copyright (C) 2013-2016, Pelagicore AB   <joakim.gross@pelagicore.com>
+ *
+ * This library is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU Lesser General Public
+ * License as published by the Free Software Foundation; either
+ * version 2.1 of the License, or (at your option) any later version.
+ *
+ * This library is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ * Lesser General Public License for more details.
+ *
+ * You should have received a copy of the GNU Lesser General Public
+ * License along with this library; if not, write to the
+ * Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+ * Boston, MA  02110-1301, USA.
+ *
+ * For further information see LICENSE
+ */
+
+
+#include "binding.h"
+
+
+static void log_handler_silent (const gchar   *log_domain,
+                                GLogLevelFlags log_level,
+                                const gchar   *message,
+                                gpointer       user_data)
+{
+}
+
+void dbus_proxy_rules_silence_log (void)
+{
+    g_log_set_handler (NULL, G_LOG_LEVEL_MASK, log_handler_silent, NULL);
+}
+
+RuleSet *dbus_proxy_rules_new (const char *config,
+                               const char *section,
+                               char       *error,
+                               size_t      error_size)
+{
+    json_error_t json_error;
+    json_t      *root;
+    json_t      *rules;
+    RuleSet     *rule_set;
+
+    root = json_loads (config, 0, &json_error);
+    if (root == NULL) {
+        if (error != NULL) {
+            g_snprintf (error, error_size, "line %d: %s",
+                        json_error.line, json_error.text);
+        }
+        return NULL;
+    }
+
+    rules = json_object_get (root, section);
+    if (!json_is_array (rules)) {
+        if (error != NULL) {
+            g_snprintf (error, error_size,
+                        "%s is not present in config, or not an array",
+                        section);
+        }
+        json_decref (root);
+        return NULL;
+    }
+
+    rule_set = rule_set_new (rules);
+    json_decref (root);
+
+    return rule_set;
+}
+
+void dbus_proxy_rules_free (RuleSet *rule_set)
+{
+    rule_set_unref (rule_set);
+}
+
+unsigned int dbus_proxy_rules_size (RuleSet *rule_set)
+{
+    return rule_set_size (rule_set);
+}
+
+int dbus_proxy_rules_match (RuleSet    *rule_set,
+                            const char *direction,
+                            const char *interface,
+                            const char *path,
+                            const char *member)
+{
+    gint rule_index;
+
+    rule_set_is_allowed (rule_set,
+                         g_quark_try_string (direction),
+                         g_quark_try_string (interface),
+                         interface,
+                         path,
+                         g_quark_try_string (member),
+                         member,
+                         &rule_index);
+
+    return rule_index;
+}
+
+size_t dbus_proxy_rules_match_batch (RuleSet           *rule_set,
+                                     const char *const *fields,
+                                     size_t             n_messages,
+                                     int               *results)
+{
+    size_t allowed = 0;
+    size_t i;
+
+    for (i = 0; i < n_messages; i++) {
+        const char *const *message = &fields[4 * i];
+
+        results[i] = dbus_proxy_rules_match (rule_set, message[0], message[1],
+                                             message[2], message[3]);
+        if (results[i] >= 0) {
+            allowed++;
+        }
+    }
+
+    return allowed;
+}
+
+int dbus_proxy_rules_reorder (RuleSet *rule_set)
+{
+    return rule_set_reorder (rule_set) ? 1 : 0;
+}
+
+void dbus_proxy_rules_order (RuleSet *rule_set, unsigned int *order)
+{
+    guint i;
+
+    for (i = 0; i < rule_set_size (rule_set); i++) {
+        order[i] = rule_set_active_rule (rule_set, i);
+    }
+}
@@ -0,0 +1,110 @@
+/*
+ * Copyright (C) 2013-2016, Pelagicore AB   <joakim.gross@pelagicore.com>
+ *
+ * This library is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU Lesser General Public
+ * License as published by the Free Software Foundation; either
+ * version 2.1 of the License, or (at your option) any later version.
+ *
+ * This library is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ * Lesser General Public License for more details.
+ *
+ * You should have received a copy of the GNU Lesser General Public
+ * License along with this library; if not, write to the
+ * Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+ * Boston, MA  02110-1301, USA.
+ *
+ * For further information see LICENSE
+ */
+
+#ifndef DBUS_PROXY_BINDING_H
+#define DBUS_PROXY_BINDING_H
+
+#include "rules.h"
+
+/*
+ * Rule evaluation for other languages, built into a shared library.
+ *
+ * Only plain C types are used in the interface, so it can be called with
+ * e.g. Python ctypes. See component-test/dbus_proxy_rules.py.
+ */
+
+/*! \brief Drop the messages the rule engine logs
+ *
+ * The engine logs a message for each message that only misses on its
+ * direction, which is noise when evaluating many messages.
+ */
+void dbus_proxy_rules_silence_log (void);
+
+/*! \brief Compile the rules of one section of a config
+ *
+ * \param config     The config as JSON text, as given to dbus-proxy
+ * \param section    The section, e.g. "dbus-gateway-config-session"
+ * \param error      Set to why the config could not be used, may be NULL
+ * \param error_size Size of the error buffer
+ * \return The compiled rules, or NULL if the config could not be parsed or
+ *         the section is not an array. Free with dbus_proxy_rules_free()
+ */
+RuleSet *dbus_proxy_rules_new (const char *config,
+                               const char *section,
+                               char       *error,
+                               size_t      error_size);
+
+/*! \brief Free compiled rules */
+void dbus_proxy_rules_free (RuleSet *rule_set);
+
+/*! \brief Number of rules that take part in evaluation */
+unsigned int dbus_proxy_rules_size (RuleSet *rule_set);
+
+/*! \brief Find the rule that allows a message
+ *
+ * The field values are interned, like the header fields of the messages
+ * the proxy filters.
+ *
+ * \param direction "outgoing" or "incoming"
+ * \param interface The interface, or NULL if the message has none
+ * \param path      The object path, or NULL if the message has none
+ * \param member    The member, or NULL if the message has none
+ * \return The index of the first rule that matches, or -1 if the message is
+ *         not allowed
+ */
+int dbus_proxy_rules_match (RuleSet    *rule_set,
+                            const char *direction,
+                            const char *interface,
+                            const char *path,
+                            const char *member);
+
+/*! \brief Find the rules that allow a batch of messages
+ *
+ * Evaluates the messages in one call, so the cost of calling from another
+ * language is paid once per batch.
+ *
+ * \param fields  Direction, interface, path and member of each message,
+ *                4 * n_messages values
+ * \param results Set to the index of the matching rule of each message, or
+ *                -1, n_messages values
+ * \return The number of messages allowed
+ */
+size_t dbus_proxy_rules_match_batch (RuleSet           *rule_set,
+                                     const char *const *fields,
+                                     size_t             n_messages,
+                                     int               *results);
+
+/*! \brief Evaluate the rules that gave the most verdicts first
+ *
+ * See rule_set_reorder(), the indices of the rules do not change.
+ *
+ * \return 1 if the order changed, 0 if not
+ */
+int dbus_proxy_rules_reorder (RuleSet *rule_set);
+
+/*! \brief Get the order the rules are evaluated in
+ *
+ * \param order Set to the index of the rule evaluated at each position,
+ *              dbus_proxy_rules_size() values
+ */
+void dbus_proxy_rules_order (RuleSet *rule_set, unsigned int *order);
+
+#endif /* DBUS_PROXY_BINDING_H */
@@ -0,0 +1,180 @@
+/*
+ * Copyright (C) 2013-2016, Pelagicore AB   <joakim.gross@pelagicore.com>
+ *
+ * This library is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU Lesser General Public
+ * License as published by the Free Software Foundation; either
+ * version 2.1 of the License, or (at your option) any later version.
+ *
+ * This library is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ * Lesser General Public License for more details.
+ *
+ * You should have received a copy of the GNU Lesser General Public
+ * License along with this library; if not, write to the
+ * Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+ * Boston, MA  02110-1301, USA.
+ *
+ * For further information see LICENSE
+ */
+
+
+#include "capture.h"
+#include "output.h"
+
+#include <string.h>
+#include <unistd.h>
+#include <sys/stat.h>
+
+
+/*! Time from the first buffered record to the flush of the buffer */
+#define CAPTURE_FLUSH_INTERVAL_MS 100
+
+/*! Size of the buffer that triggers a flush on the message path */
+#define CAPTURE_FLUSH_SIZE (64 * 1024)
+
+/*! The capture file, -1 when not capturing */
+static int         capture_fd       = -1;
+static gboolean    capture_messages = FALSE;
+
+/*! Records not yet written. All proxy processes are single threaded and
+    the buffer is only used from the main loop. */
+static GByteArray *buffer = NULL;
+
+static GQuark      quark_incoming;
+
+static OutputBatch batch = { capture_flush, CAPTURE_FLUSH_INTERVAL_MS, 0 };
+
+
+gboolean capture_open (const char *path, gboolean messages)
+{
+    struct stat status;
+    guint32     version = GUINT32_TO_LE (CAPTURE_VERSION);
+
+    capture_fd = output_open (path, "capture");
+    if (capture_fd < 0) {
+        return FALSE;
+    }
+
+    if (fstat (capture_fd, &status) == 0 && status.st_size == 0) {
+        if (!output_write (capture_fd, CAPTURE_MAGIC, sizeof (CAPTURE_MAGIC), "capture") ||
+            !output_write (capture_fd, &version, sizeof (version), "capture")) {
+            close (capture_fd);
+            capture_fd = -1;
+            return FALSE;
+        }
+    }
+
+    capture_messages = messages;
+    buffer           = g_byte_array_sized_new (CAPTURE_FLUSH_SIZE);
+    quark_incoming   = g_quark_from_static_string ("incoming");
+    output_batch_register (&batch);
+
+    return TRUE;
+}
+
+gboolean capture_enabled (void)
+{
+    return capture_fd >= 0;
+}
+
+static void append_u8 (guint8 value)
+{
+    g_byte_array_append (buffer, &value, sizeof (value));
+}
+
+static void append_u16 (guint16 value)
+{
+    value = GUINT16_TO_LE (value);
+    g_byte_array_append (buffer, (const guint8 *) &value, sizeof (value));
+}
+
+static void append_u32 (guint32 value)
+{
+    value = GUINT32_TO_LE (value);
+    g_byte_array_append (buffer, (const guint8 *) &value, sizeof (value));
+}
+
+static void append_u64 (guint64 value)
+{
+    value = GUINT64_TO_LE (value);
+    g_byte_array_append (buffer, (const guint8 *) &value, sizeof (value));
+}
+
+/*! \brief Length of a header string in a record, longer strings are cut */
+static guint16 string_length (const char *string)
+{
+    return string != NULL ? MIN (strlen (string), G_MAXUINT16) : 0;
+}
+
+void capture_message (GQuark               direction,
+                      const MessageHeader *header,
+                      DBusMessage         *msg)
+{
+    const char *strings[5];
+    guint16     lengths[5];
+    char       *marshalled = NULL;
+    int         size = 0;
+    guint       start;
+    guint32     length;
+    guint       i;
+
+    if (capture_fd < 0) {
+        return;
+    }
+
+    strings[0] = header->interface_name;
+    strings[1] = header->path;
+    strings[2] = header->member_name;
+    strings[3] = header->destination;
+    strings[4] = header->sender;
+
+    /* libdbus only knows the size of a message once it is marshalled */
+    if (!dbus_message_marshal (msg, &marshalled, &size)) {
+        marshalled = NULL;
+        size       = 0;
+    }
+
+    start = buffer->len;
+    append_u32 (0);
+    append_u64 (g_get_real_time ());
+    append_u32 (getpid ());
+    append_u8  (direction == quark_incoming ? 1 : 0);
+    append_u8  (header->type);
+    append_u8  (capture_messages && marshalled != NULL ? CAPTURE_FLAG_MESSAGE : 0);
+    append_u8  (0);
+    append_u32 (size);
+    for (i = 0; i < G_N_ELEMENTS (strings); i++) {
+        lengths[i] = string_length (strings[i]);
+        append_u16 (lengths[i]);
+    }
+    for (i = 0; i < G_N_ELEMENTS (strings); i++) {
+        g_byte_array_append (buffer, (const guint8 *) strings[i], lengths[i]);
+    }
+    if (capture_messages && marshalled != NULL) {
+        g_byte_array_append (buffer, (const guint8 *) marshalled, size);
+    }
+    dbus_free (marshalled);
+
+    length = GUINT32_TO_LE (buffer->len - start);
+    memcpy (buffer->data + start, &length, sizeof (length));
+
+    if (buffer->len >= CAPTURE_FLUSH_SIZE) {
+        capture_flush ();
+    } else {
+        output_batch_schedule (&batch);
+    }
+}
+
+void capture_flush (void)
+{
+    if (capture_fd < 0 || buffer->len == 0) {
+        return;
+    }
+
+    /* One write per batch, with O_APPEND the records of different proxy
+       processes do not interleave */
+    output_write (capture_fd, buffer->data, buffer->len, "capture");
+    g_byte_array_set_size (buffer, 0);
+}
@@ -0,0 +1,83 @@
+/*
+ * Copyright (C) 2013-2016, Pelagicore AB   <joakim.gross@pelagicore.com>
+ *
+ * This library is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU Lesser General Public
+ * License as published by the Free Software Foundation; either
+ * version 2.1 of the License, or (at your option) any later version.
+ *
+ * This library is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ * Lesser General Public License for more details.
+ *
+ * You should have received a copy of the GNU Lesser General Public
+ * License along with this library; if not, write to the
+ * Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+ * Boston, MA  02110-1301, USA.
+ *
+ * For further information see LICENSE
+ */
+
+#ifndef DBUS_PROXY_CAPTURE_H
+#define DBUS_PROXY_CAPTURE_H
+
+#include "proxy.h"
+
+/*
+ * Capture file format, all integers little endian.
+ *
+ * The file starts with the 8 bytes "DBPXCAP\0" and a u32 version, 1. Each
+ * record is:
+ *
+ *   u32 length of the record in bytes, including this field
+ *   u64 time in microseconds since the epoch
+ *   u32 pid of the proxy process
+ *   u8  direction, 0 for outgoing and 1 for incoming
+ *   u8  D-Bus message type
+ *   u8  flags, CAPTURE_FLAG_MESSAGE if the marshalled message follows
+ *   u8  0
+ *   u32 size of the marshalled message in bytes
+ *   u16 lengths of the interface, path, member, destination and sender
+ *   the five strings, without terminators, empty if not set
+ *   the marshalled message, if flagged
+ */
+
+/*! Magic at the start of a capture file */
+#define CAPTURE_MAGIC   "DBPXCAP"
+#define CAPTURE_VERSION 1
+
+/*! The record is followed by the whole marshalled message */
+#define CAPTURE_FLAG_MESSAGE 0x01
+
+/*! \brief Open the capture file
+ *
+ * Messages are appended to the file, which is shared by all proxy
+ * processes forked after this call.
+ *
+ * \param path     The file to append to
+ * \param messages Capture whole messages, not only their headers
+ * \return FALSE if the file could not be opened
+ */
+gboolean capture_open (const char *path, gboolean messages);
+
+/*! \brief Test if messages are captured */
+gboolean capture_enabled (void);
+
+/*! \brief Capture a message that passed through a filter
+ *
+ * This is called on the message path. The record is added to a buffer
+ * which is written in a batch.
+ *
+ * \param direction Direction of the message
+ * \param header    The header fields of the message
+ * \param msg       The message
+ */
+void capture_message (GQuark               direction,
+                      const MessageHeader *header,
+                      DBusMessage         *msg);
+
+/*! \brief Write all buffered records to the capture file */
+void capture_flush (void);
+
+#endif /* DBUS_PROXY_CAPTURE_H */
@@ -0,0 +1,299 @@
+/*
+ * Copyright (C) 2013-2016, Pelagicore AB   <joakim.gross@pelagicore.com>
+ *
+ * This library is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU Lesser General Public
+ * License as published by the Free Software Foundation; either
+ * version 2.1 of the License, or (at your option) any later version.
+ *
+ * This library is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ * Lesser General Public License for more details.
+ *
+ * You should have received a copy of the GNU Lesser General Public
+ * License along with this library; if not, write to the
+ * Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+ * Boston, MA  02110-1301, USA.
+ *
+ * For further information see LICENSE
+ */
+
+
+#include "check.h"
+#include "rules.h"
+#include "ratelimit.h"
+
+#include <string.h>
+
+
+#define SECTION_PREFIX    "dbus-gateway-config-"
+#define RATE_LIMIT_PREFIX "dbus-gateway-rate-limit-"
+
+/*! The keys a rule may have */
+static const char *rule_keys[] = {
+    "direction",
+    "interface",
+    "object-path",
+    "method",
+    "rate-limit",
+    "property-cache",
+    "coalesce",
+    "lane",
+    NULL
+};
+
+
+static gboolean is_rule_key (const char *key)
+{
+    guint i;
+
+    for (i = 0; rule_keys[i] != NULL; i++) {
+        if (strcmp (rule_keys[i], key) == 0) {
+            return TRUE;
+        }
+    }
+    return FALSE;
+}
+
+/*! \brief Check a string field of a rule
+ *
+ * \return TRUE if the field can match something
+ */
+static gboolean check_string (const json_t *value,
+                              const char   *section,
+                              size_t        index,
+                              const char   *field,
+                              GString      *out)
+{
+    if (value == NULL) {
+        g_string_append_printf (out, "%s: rule %zu: error: '%s' is missing, "
+                                "the rule never matches\n",
+                                section, index, field);
+        return FALSE;
+    }
+
+    if (!json_is_string (value)) {
+        g_string_append_printf (out, "%s: rule %zu: error: '%s' is not a "
+                                "string, the rule never matches\n",
+                                section, index, field);
+        return FALSE;
+    }
+
+    if (json_string_value (value)[0] == '\0') {
+        g_string_append_printf (out, "%s: rule %zu: error: '%s' is empty, "
+                                "the rule never matches\n",
+                                section, index, field);
+        return FALSE;
+    }
+
+    return TRUE;
+}
+
+static gboolean check_rule (const json_t *rule,
+                            const char   *section,
+                            size_t        index,
+                            GString      *out)
+{
+    const json_t *methods;
+    const json_t *value;
+    const char   *key;
+    gboolean      valid = TRUE;
+    const json_t *ttl;
+    RateLimitSpec spec;
+    size_t        ix;
+
+    json_object_foreach ((json_t *) rule, key, value) {
+        if (!is_rule_key (key)) {
+            g_string_append_printf (out, "%s: rule %zu: warning: unknown key "
+                                    "'%s' is ignored\n",
+                                    section, index, key);
+        }
+    }
+
+    valid &= check_string (json_object_get (rule, "direction"),   section, index, "direction",   out);
+    valid &= check_string (json_object_get (rule, "interface"),   section, index, "interface",   out);
+    valid &= check_string (json_object_get (rule, "object-path"), section, index, "object-path", out);
+
+    methods = json_object_get (rule, "method");
+    if (json_is_array (methods)) {
+        if (json_array_size (methods) == 0) {
+            g_string_append_printf (out, "%s: rule %zu: error: 'method' is an "
+                                    "empty array, the rule never matches\n",
+                                    section, index);
+            valid = FALSE;
+        }
+        json_array_foreach (methods, ix, value) {
+            if (!json_is_string (value)) {
+                g_string_append_printf (out, "%s: rule %zu: error: method %zu "
+                                        "is not a string, it and the methods "
+                                        "after it never match\n",
+                                        section, index, ix);
+                valid = FALSE;
+                break;
+            }
+            if (json_string_value (value)[0] == '\0') {
+                g_string_append_printf (out, "%s: rule %zu: warning: method %zu "
+                                        "is empty and never matches\n",
+                                        section, index, ix);
+            }
+        }
+    } else {
+        valid &= check_string (methods, section, index, "method", out);
+    }
+
+    value = json_object_get (rule, "rate-limit");
+    if (value != NULL && !rate_limit_spec_parse (&spec, value)) {
+        g_string_append_printf (out, "%s: rule %zu: warning: 'rate-limit' "
+                                "does not limit anything\n",
+                                section, index);
+    }
+    if (json_is_object (value) && !rate_limit_error_is_valid (value)) {
+        g_string_append_printf (out, "%s: rule %zu: error: 'rate-limit' "
+                                "has an 'error' that is not a valid D-Bus "
+                                "error name\n",
+                                section, index);
+        valid = FALSE;
+    }
+
+    value = json_object_get (rule, "property-cache");
+    ttl   = json_object_get (value, "ttl");
+    if (value != NULL &&
+        (!json_is_object (value) ||
+         (ttl != NULL && !(json_is_number (ttl) && json_number_value (ttl) > 0))))
+    {
+        g_string_append_printf (out, "%s: rule %zu: warning: 'property-cache' "
+                                "is not an object with a positive 'ttl', it "
+                                "is ignored\n",
+                                section, index);
+    }
+
+    value = json_object_get (rule, "coalesce");
+    if (value != NULL && !json_is_boolean (value)) {
+        g_string_append_printf (out, "%s: rule %zu: warning: 'coalesce' "
+                                "is not true or false, it is ignored\n",
+                                section, index);
+    }
+
+    value = json_object_get (rule, "lane");
+    if (value != NULL &&
+        !(json_is_string (value) &&
+          (strcmp (json_string_value (value), "reply")  == 0 ||
+           strcmp (json_string_value (value), "call")   == 0 ||
+           strcmp (json_string_value (value), "signal") == 0)))
+    {
+        g_string_append_printf (out, "%s: rule %zu: warning: 'lane' "
+                                "is not \"reply\", \"call\" or \"signal\", "
+                                "it is ignored\n",
+                                section, index);
+    }
+
+    return valid;
+}
+
+static gboolean check_section (const json_t *rules,
+                               const char   *section,
+                               guint         max_cost,
+                               GString      *out)
+{
+    RuleSet     *rule_set;
+    RuleSetCost  cost;
+    gboolean     valid = TRUE;
+    size_t       size;
+    size_t       i;
+    gint         shadowing;
+
+    if (!json_is_array (rules)) {
+        g_string_append_printf (out, "%s: error: not an array\n", section);
+        return FALSE;
+    }
+
+    size = json_array_size (rules);
+    for (i = 0; i < size; i++) {
+        if (!json_is_object (json_array_get (rules, i))) {
+            g_string_append_printf (out, "%s: rule %zu: error: not an object, "
+                                    "it and the %zu rules after it are never "
+                                    "evaluated\n",
+                                    section, i, size - i - 1);
+            valid = FALSE;
+            break;
+        }
+        valid &= check_rule (json_array_get (rules, i), section, i, out);
+    }
+
+    rule_set = rule_set_new (rules);
+
+    for (i = 0; i < rule_set_size (rule_set); i++) {
+        if (!rule_set_rule_can_match (rule_set, i)) {
+            g_string_append_printf (out, "%s: rule %zu: warning: unreachable, "
+                                    "it can never match\n",
+                                    section, i);
+            continue;
+        }
+
+        shadowing = rule_set_shadowing_rule (rule_set, i);
+        if (shadowing >= 0) {
+            g_string_append_printf (out, "%s: rule %zu: warning: shadowed by "
+                                    "rule %d, which matches everything it "
+                                    "matches\n",
+                                    section, i, shadowing);
+        }
+    }
+
+    rule_set_cost (rule_set, &cost);
+    g_string_append_printf (out, "%s: worst case per message: %u glob matches, "
+                            "%u compares, %u bitset words\n",
+                            section, cost.glob_matches, cost.compares,
+                            cost.bitset_words);
+    if (max_cost > 0 && cost.glob_matches > max_cost) {
+        g_string_append_printf (out, "%s: error: %u glob matches exceed the "
+                                "maximum of %u\n",
+                                section, cost.glob_matches, max_cost);
+        valid = FALSE;
+    }
+
+    g_string_append_printf (out, "%s: ", section);
+    rule_set_describe (rule_set, out);
+
+    rule_set_unref (rule_set);
+    return valid;
+}
+
+gboolean config_check (const json_t *root, guint max_cost, GString *out)
+{
+    const json_t *value;
+    const char   *key;
+    gboolean      valid = TRUE;
+    guint         n_sections = 0;
+    RateLimitSpec spec;
+
+    if (!json_is_object (root)) {
+        g_string_append (out, "error: the config is not a JSON object\n");
+        return FALSE;
+    }
+
+    json_object_foreach ((json_t *) root, key, value) {
+        if (g_str_has_prefix (key, SECTION_PREFIX)) {
+            valid &= check_section (value, key, max_cost, out);
+            n_sections++;
+        } else if (g_str_has_prefix (key, RATE_LIMIT_PREFIX)) {
+            if (json_is_object (value) && json_object_size (value) > 0 &&
+                !rate_limit_spec_parse (&spec, value)) {
+                g_string_append_printf (out, "%s: warning: does not limit "
+                                        "anything\n", key);
+            }
+            if (json_is_object (value) && !rate_limit_error_is_valid (value)) {
+                g_string_append_printf (out, "%s: error: 'error' is not a "
+                                        "valid D-Bus error name\n", key);
+                valid = FALSE;
+            }
+        }
+    }
+
+    if (n_sections == 0) {
+        g_string_append (out, "error: no " SECTION_PREFIX "<bus> section\n");
+        valid = FALSE;
+    }
+
+    return valid;
+}
@@ -0,0 +1,43 @@
+/*
+ * Copyright (C) 2013-2016, Pelagicore AB   <joakim.gross@pelagicore.com>
+ *
+ * This library is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU Lesser General Public
+ * License as published by the Free Software Foundation; either
+ * version 2.1 of the License, or (at your option) any later version.
+ *
+ * This library is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ * Lesser General Public License for more details.
+ *
+ * You should have received a copy of the GNU Lesser General Public
+ * License along with this library; if not, write to the
+ * Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+ * Boston, MA  02110-1301, USA.
+ *
+ * For further information see LICENSE
+ */
+
+#ifndef DBUS_PROXY_CHECK_H
+#define DBUS_PROXY_CHECK_H
+
+#include <glib.h>
+#include <jansson.h>
+
+/*! \brief Validate a config and report on its rules
+ *
+ * Every "dbus-gateway-config-<bus>" section is checked for entries that are
+ * not rules, and rules with fields that can never match. Each section is
+ * compiled and its shadowed and unreachable rules, worst case cost per
+ * message and compiled layout are reported.
+ *
+ * \param root     The parsed config
+ * \param max_cost Fail if a section needs more glob matches than this for a
+ *                 message, 0 for no limit
+ * \param out      The report is appended to this string
+ * \return TRUE if the config has no errors
+ */
+gboolean config_check (const json_t *root, guint max_cost, GString *out);
+
+#endif /* DBUS_PROXY_CHECK_H */
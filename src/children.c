@@ -0,0 +1,436 @@
+/*
+ * Copyright (C) 2013-2016, Pelagicore AB   <joakim.gross@pelagicore.com>
+ *
+ * This library is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU Lesser General Public
+ * License as published by the Free Software Foundation; either
+ * version 2.1 of the License, or (at your option) any later version.
+ *
+ * This library is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ * Lesser General Public License for more details.
+ *
+ * You should have received a copy of the GNU Lesser General Public
+ * License along with this library; if not, write to the
+ * Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+ * Boston, MA  02110-1301, USA.
+ *
+ * For further information see LICENSE
+ */
+
+
+/* For struct ucred */
+#define _GNU_SOURCE
+
+#include "children.h"
+
+#include <stdio.h>
+#include <string.h>
+#include <stdlib.h>
+#include <unistd.h>
+#include <errno.h>
+#include <signal.h>
+#include <sys/mman.h>
+#include <sys/socket.h>
+#include <sys/wait.h>
+
+#include <glib-unix.h>
+#include <jansson.h>
+
+
+/*! Children that can be running at the same time with a slot for their
+    last activity, more children are still served but their activity is not
+    known */
+#define CHILDREN_MAX_SLOTS 4096
+
+/*! Seconds to wait before writing the registry after a child started or
+    exited, so a burst of connections writes it once */
+#define CHILDREN_WRITE_DELAY 1
+
+
+/*! A proxy process serving one client */
+typedef struct {
+    pid_t        pid;
+    gint         slot;
+    guint        watch_id;
+    const gchar *bus_name;
+
+    /*! Credentials of the client, -1 when not known */
+    gint64       client_pid;
+    gint64       client_uid;
+    gint64       client_gid;
+
+    /*! When the child was forked, as real and monotonic time */
+    gint64       start_time;
+    gint64       started;
+} ChildProcess;
+
+/*! Pid -> ChildProcess of the live children, NULL in a child */
+static GHashTable      *children = NULL;
+
+/*! Monotonic time of the last message of each child, in memory shared by
+    the parent and all children */
+static volatile gint64 *activity   = NULL;
+static gboolean         slot_used[CHILDREN_MAX_SLOTS];
+static guint            next_slot  = 0;
+
+/*! In a child, its own slot and the time of its last message */
+static volatile gint64 *own_activity  = NULL;
+static gint64           last_activity = 0;
+
+/*! Limits, 0 for none */
+static guint            max_clients  = 0;
+static guint            idle_timeout = 0;
+static guint64          max_memory   = 0;
+
+/*! In a child, called when it hits a limit */
+static ChildLimitFunc   limit_func   = NULL;
+
+static gchar   *registry_path    = NULL;
+static guint    signal_source_id = 0;
+static guint    write_source_id  = 0;
+
+/*! Churn since the start */
+static guint64  forked_count     = 0;
+static guint64  exited_count     = 0;
+static gint64   fork_time_total  = 0;
+static gint64   lifetime_total   = 0;
+
+/*! Clients turned away, and clients disconnected for hitting a limit */
+static guint64  refused_count       = 0;
+static guint64  idle_reaped_count   = 0;
+static guint64  memory_reaped_count = 0;
+
+
+static json_t *json_id_or_null (gint64 id)
+{
+    return id >= 0 ? json_integer (id) : json_null ();
+}
+
+static void write_registry (void)
+{
+    GHashTableIter iter;
+    ChildProcess  *child;
+    json_t        *root;
+    json_t        *list;
+    json_t        *entry;
+    char          *text;
+    GError        *error = NULL;
+    gint64         now      = g_get_monotonic_time ();
+    gint64         real_now = g_get_real_time ();
+
+    if (registry_path == NULL || children == NULL) {
+        return;
+    }
+
+    list = json_array ();
+    g_hash_table_iter_init (&iter, children);
+    while (g_hash_table_iter_next (&iter, NULL, (gpointer *) &child)) {
+        entry = json_object ();
+        json_object_set_new (entry, "pid", json_integer (child->pid));
+        json_object_set_new (entry, "bus", json_string (child->bus_name));
+        json_object_set_new (entry, "client-pid", json_id_or_null (child->client_pid));
+        json_object_set_new (entry, "client-uid", json_id_or_null (child->client_uid));
+        json_object_set_new (entry, "client-gid", json_id_or_null (child->client_gid));
+        json_object_set_new (entry, "start-time",
+                             json_real (child->start_time / (double) G_USEC_PER_SEC));
+        if (child->slot >= 0) {
+            gint64 idle = now - activity[child->slot];
+
+            json_object_set_new (entry, "last-activity",
+                                 json_real ((real_now - idle) / (double) G_USEC_PER_SEC));
+            json_object_set_new (entry, "idle",
+                                 json_real (idle / (double) G_USEC_PER_SEC));
+        } else {
+            json_object_set_new (entry, "last-activity", json_null ());
+            json_object_set_new (entry, "idle", json_null ());
+        }
+        json_array_append_new (list, entry);
+    }
+
+    root = json_object ();
+    json_object_set_new (root, "pid", json_integer (getpid ()));
+    json_object_set_new (root, "time", json_real (real_now / (double) G_USEC_PER_SEC));
+    json_object_set_new (root, "forked", json_integer (forked_count));
+    json_object_set_new (root, "exited", json_integer (exited_count));
+    json_object_set_new (root, "mean-fork-time",
+                         forked_count > 0
+                             ? json_real (fork_time_total / (double) forked_count /
+                                          G_USEC_PER_SEC)
+                             : json_null ());
+    json_object_set_new (root, "mean-lifetime",
+                         exited_count > 0
+                             ? json_real (lifetime_total / (double) exited_count /
+                                          G_USEC_PER_SEC)
+                             : json_null ());
+    json_object_set_new (root, "refused", json_integer (refused_count));
+    json_object_set_new (root, "idle-reaped", json_integer (idle_reaped_count));
+    json_object_set_new (root, "memory-reaped", json_integer (memory_reaped_count));
+    json_object_set_new (root, "children", list);
+
+    text = json_dumps (root, JSON_INDENT (4));
+    json_decref (root);
+    if (text == NULL) {
+        return;
+    }
+
+    /* Written to a temporary file and renamed, readers never see half of it */
+    if (!g_file_set_contents (registry_path, text, -1, &error)) {
+        g_message("Could not write child registry: %s\n", error->message);
+        g_clear_error (&error);
+    }
+    free (text);
+}
+
+static gboolean write_registry_timeout (gpointer data)
+{
+    write_source_id = 0;
+    write_registry ();
+    return FALSE;
+}
+
+static gboolean write_registry_signal (gpointer data)
+{
+    write_registry ();
+    return TRUE;
+}
+
+static void schedule_write (void)
+{
+    if (registry_path != NULL && write_source_id == 0) {
+        write_source_id = g_timeout_add_seconds (CHILDREN_WRITE_DELAY,
+                                                 write_registry_timeout,
+                                                 NULL);
+    }
+}
+
+void children_registry_open (const char *path)
+{
+    gpointer shared;
+
+    children = g_hash_table_new_full (g_direct_hash, g_direct_equal,
+                                      NULL, g_free);
+
+    shared = mmap (NULL, CHILDREN_MAX_SLOTS * sizeof (gint64),
+                   PROT_READ | PROT_WRITE, MAP_SHARED | MAP_ANONYMOUS, -1, 0);
+    if (shared == MAP_FAILED) {
+        g_message("Could not map activity slots: %s, activity of children "
+                  "is not known\n", strerror (errno));
+    } else {
+        activity = shared;
+    }
+
+    if (path != NULL) {
+        registry_path    = g_strdup (path);
+        signal_source_id = g_unix_signal_add (SIGUSR1, write_registry_signal, NULL);
+    }
+}
+
+void children_set_limits (guint clients, guint idle, guint64 memory)
+{
+    max_clients  = clients;
+    idle_timeout = idle;
+    max_memory   = memory;
+}
+
+gboolean children_accepting (void)
+{
+    if (max_clients == 0 || children == NULL ||
+        g_hash_table_size (children) < max_clients)
+    {
+        return TRUE;
+    }
+
+    g_message("Refusing client, %u clients are served\n", max_clients);
+    refused_count++;
+    schedule_write ();
+    return FALSE;
+}
+
+gint children_reserve_slot (void)
+{
+    guint i, slot;
+
+    if (activity == NULL) {
+        return -1;
+    }
+
+    for (i = 0; i < CHILDREN_MAX_SLOTS; i++) {
+        slot = (next_slot + i) % CHILDREN_MAX_SLOTS;
+        if (!slot_used[slot]) {
+            slot_used[slot] = TRUE;
+            activity[slot]  = g_get_monotonic_time ();
+            next_slot       = slot + 1;
+            return slot;
+        }
+    }
+
+    return -1;
+}
+
+void children_release_slot (gint slot)
+{
+    if (slot >= 0) {
+        slot_used[slot] = FALSE;
+    }
+}
+
+static void child_exited (GPid pid, gint status, gpointer data)
+{
+    ChildProcess *child;
+    gint64        lifetime;
+
+    child = g_hash_table_lookup (children, GINT_TO_POINTER (pid));
+    if (child == NULL) {
+        g_spawn_close_pid (pid);
+        return;
+    }
+
+    lifetime = g_get_monotonic_time () - child->started;
+    exited_count++;
+    lifetime_total += lifetime;
+
+    if (WIFEXITED (status) && WEXITSTATUS (status) == CHILD_EXIT_IDLE) {
+        idle_reaped_count++;
+    } else if (WIFEXITED (status) && WEXITSTATUS (status) == CHILD_EXIT_MEMORY) {
+        memory_reaped_count++;
+    }
+
+    if (WIFSIGNALED (status)) {
+        g_message("Child %d killed by signal %d after %.3f s\n",
+                  pid, WTERMSIG (status), lifetime / (double) G_USEC_PER_SEC);
+    } else {
+        g_message("Child %d exited with status %d after %.3f s\n",
+                  pid, WEXITSTATUS (status), lifetime / (double) G_USEC_PER_SEC);
+    }
+
+    children_release_slot (child->slot);
+    g_hash_table_remove (children, GINT_TO_POINTER (pid));
+    g_spawn_close_pid (pid);
+
+    schedule_write ();
+}
+
+void children_add (pid_t           pid,
+                   gint            slot,
+                   DBusConnection *client,
+                   const char     *bus_name,
+                   gint64          fork_time)
+{
+    ChildProcess *child;
+    struct ucred  credentials;
+    socklen_t     length = sizeof (credentials);
+    int           fd;
+
+    child = g_new0 (ChildProcess, 1);
+    child->pid        = pid;
+    child->slot       = slot;
+    child->bus_name   = g_intern_string (bus_name);
+    child->start_time = g_get_real_time ();
+    child->started    = g_get_monotonic_time ();
+    child->client_pid = -1;
+    child->client_uid = -1;
+    child->client_gid = -1;
+
+    /* The connection is not authenticated yet, so ask the socket */
+    if (dbus_connection_get_socket (client, &fd) &&
+        getsockopt (fd, SOL_SOCKET, SO_PEERCRED, &credentials, &length) == 0)
+    {
+        child->client_pid = credentials.pid;
+        child->client_uid = credentials.uid;
+        child->client_gid = credentials.gid;
+    }
+
+    forked_count++;
+    fork_time_total += fork_time;
+
+    child->watch_id = g_child_watch_add (pid, child_exited, NULL);
+    g_hash_table_insert (children, GINT_TO_POINTER (pid), child);
+
+    schedule_write ();
+}
+
+/*! \brief Resident memory of this process in bytes, or 0 if not known */
+static guint64 resident_memory (void)
+{
+    gchar   *statm = NULL;
+    guint64  pages = 0;
+
+    if (g_file_get_contents ("/proc/self/statm", &statm, NULL, NULL)) {
+        /* Total program size, then resident pages */
+        sscanf (statm, "%*u %" G_GUINT64_FORMAT, &pages);
+        g_free (statm);
+    }
+
+    return pages * sysconf (_SC_PAGESIZE);
+}
+
+static gboolean check_limits (gpointer data)
+{
+    gint64  idle = g_get_monotonic_time () - last_activity;
+    guint64 memory;
+
+    if (idle_timeout > 0 && idle >= idle_timeout * G_USEC_PER_SEC) {
+        g_message("Disconnecting client after %u s without messages\n",
+                  idle_timeout);
+        limit_func (CHILD_EXIT_IDLE);
+        return FALSE;
+    }
+
+    if (max_memory > 0) {
+        memory = resident_memory ();
+        if (memory > max_memory) {
+            g_message("Disconnecting client, %" G_GUINT64_FORMAT " bytes "
+                      "resident is over the limit of %" G_GUINT64_FORMAT "\n",
+                      memory, max_memory);
+            limit_func (CHILD_EXIT_MEMORY);
+            return FALSE;
+        }
+    }
+
+    return TRUE;
+}
+
+void children_enter_child (gint slot, ChildLimitFunc on_limit)
+{
+    GHashTableIter iter;
+    ChildProcess  *child;
+
+    if (children != NULL) {
+        g_hash_table_iter_init (&iter, children);
+        while (g_hash_table_iter_next (&iter, NULL, (gpointer *) &child)) {
+            g_source_remove (child->watch_id);
+        }
+        g_hash_table_destroy (children);
+        children = NULL;
+    }
+
+    if (signal_source_id != 0) {
+        g_source_remove (signal_source_id);
+        signal_source_id = 0;
+    }
+    if (write_source_id != 0) {
+        g_source_remove (write_source_id);
+        write_source_id = 0;
+    }
+    g_clear_pointer (&registry_path, g_free);
+
+    if (slot >= 0) {
+        own_activity = &activity[slot];
+    }
+
+    last_activity = g_get_monotonic_time ();
+    limit_func    = on_limit;
+    if (idle_timeout > 0 || max_memory > 0) {
+        g_timeout_add_seconds (1, check_limits, NULL);
+    }
+}
+
+void children_touch (void)
+{
+    last_activity = g_get_monotonic_time ();
+    if (own_activity != NULL) {
+        *own_activity = last_activity;
+    }
+}
@@ -0,0 +1,115 @@
+/*
+ * Copyright (C) 2013-2016, Pelagicore AB   <joakim.gross@pelagicore.com>
+ *
+ * This library is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU Lesser General Public
+ * License as published by the Free Software Foundation; either
+ * version 2.1 of the License, or (at your option) any later version.
+ *
+ * This library is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ * Lesser General Public License for more details.
+ *
+ * You should have received a copy of the GNU Lesser General Public
+ * License along with this library; if not, write to the
+ * Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+ * Boston, MA  02110-1301, USA.
+ *
+ * For further information see LICENSE
+ */
+
+#ifndef DBUS_PROXY_CHILDREN_H
+#define DBUS_PROXY_CHILDREN_H
+
+#include "proxy.h"
+
+#include <sys/types.h>
+
+/*! Exit status of a child that disconnected its client for being idle */
+#define CHILD_EXIT_IDLE   3
+
+/*! Exit status of a child that disconnected its client for using too much
+    memory */
+#define CHILD_EXIT_MEMORY 4
+
+/*! \brief Disconnect the client and exit with a status
+ *
+ * Called in a child when it hits a limit.
+ */
+typedef void (*ChildLimitFunc) (int status);
+
+/*! \brief Set up the registry of proxy processes
+ *
+ * Must be called before the first client is accepted. Exited children are
+ * reaped from the main loop with a child watch, and the registry is written
+ * to a file when a child starts or exits and on SIGUSR1.
+ *
+ * \param path The file to write the registry to as JSON, or NULL
+ */
+void children_registry_open (const char *path);
+
+/*! \brief Set the limits of the clients and the children
+ *
+ * \param max_clients  Clients served at the same time, 0 for no limit
+ * \param idle_timeout Seconds a child may go without a message, 0 for no
+ *                     limit
+ * \param max_memory   Bytes of resident memory a child may use, 0 for no
+ *                     limit
+ */
+void children_set_limits (guint max_clients, guint idle_timeout, guint64 max_memory);
+
+/*! \brief Test if one more client may be served
+ *
+ * A client that is turned away is counted.
+ *
+ * \return FALSE if the maximum number of clients is served
+ */
+gboolean children_accepting (void);
+
+/*! \brief Reserve a slot for the next child before forking it
+ *
+ * The slot is in memory shared with the children, each child keeps the time
+ * of its last message there.
+ *
+ * \return The slot, or -1 if all slots are in use
+ */
+gint children_reserve_slot (void);
+
+/*! \brief Release a slot when no child could be forked for it */
+void children_release_slot (gint slot);
+
+/*! \brief Add a forked child to the registry, and watch for it to exit
+ *
+ * \param pid       The child
+ * \param slot      The slot reserved for it
+ * \param client    The connection of the client the child serves
+ * \param bus_name  The bus the child is a proxy for
+ * \param fork_time Microseconds the parent spent forking the child
+ */
+void children_add (pid_t           pid,
+                   gint            slot,
+                   DBusConnection *client,
+                   const char     *bus_name,
+                   gint64          fork_time);
+
+/*! \brief Forget the registry in a newly forked child
+ *
+ * A child has no use for the registry of its siblings, and must not write
+ * the registry file. The idle and memory limits are checked every second
+ * from here on.
+ *
+ * \param slot     The slot reserved for the child
+ * \param on_limit Called with CHILD_EXIT_IDLE or CHILD_EXIT_MEMORY when the
+ *                 child hits a limit
+ */
+void children_enter_child (gint slot, ChildLimitFunc on_limit);
+
+/*! \brief Record that the child handled a message
+ *
+ * This is called on the message path and only stores the time in the slot
+ * of the child.
+ */
+void children_touch (void);
+
+#endif /* DBUS_PROXY_CHILDREN_H */
@@ -0,0 +1,468 @@
+/*
+ * Copyright (C) 2013-2016, Pelagicore AB   <joakim.gross@pelagicore.com>
+ *
+ * This library is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU Lesser General Public
+ * License as published by the Free Software Foundation; either
+ * version 2.1 of the License, or (at your option) any later version.
+ *
+ * This library is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ * Lesser General Public License for more details.
+ *
+ * You should have received a copy of the GNU Lesser General Public
+ * License along with this library; if not, write to the
+ * Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+ * Boston, MA  02110-1301, USA.
+ *
+ * For further information see LICENSE
+ */
+
+
+
+#include "delivery.h"
+#include "probes.h"
+
+#include <string.h>
+
+
+/*! Interval at which held messages are passed on while the client is
+    behind. It doubles each time the client has read nothing since the last
+    poll, up to the maximum, so a client that stops reading does not keep
+    its process awake. */
+#define DELIVERY_POLL_INTERVAL_MS     2
+#define DELIVERY_POLL_MAX_INTERVAL_MS 1024
+
+/*! A message held back while the client is behind */
+typedef struct {
+    /*! The key of a signal that is coalesced, or NULL */
+    gchar       *key;
+    DBusMessage *msg;
+} HeldMessage;
+
+/*! The connection to the client, set when the first message is held */
+static DBusConnection *client        = NULL;
+
+static gboolean        lanes_enabled = FALSE;
+
+/*! Held messages per lane, oldest first. Without lanes only signals that
+    are coalesced are held, all in the signal lane. */
+static GQueue          held[RULE_LANE_COUNT] = { G_QUEUE_INIT, G_QUEUE_INIT, G_QUEUE_INIT };
+static guint           held_count    = 0;
+
+/*! Key -> link of the signal in its lane */
+static GHashTable     *held_keys     = NULL;
+
+static guint           poll_source   = 0;
+static guint           poll_interval = DELIVERY_POLL_INTERVAL_MS;
+
+static guint64         coalesced_count = 0;
+static guint64         merged_count    = 0;
+
+
+static gboolean is_properties_changed (DBusMessage *msg)
+{
+    return dbus_message_is_signal (msg, DBUS_INTERFACE_PROPERTIES, "PropertiesChanged") &&
+           dbus_message_has_signature (msg, "sa{sv}as");
+}
+
+/*! \brief Get the key of a signal, signals with the same key replace each
+ *         other
+ */
+static gchar *held_key (DBusMessage *msg, const MessageHeader *header)
+{
+    DBusMessageIter  iter;
+    const char      *changed_interface = "";
+
+    /* PropertiesChanged signals of different interfaces of an object carry
+       different properties */
+    if (is_properties_changed (msg)) {
+        dbus_message_iter_init (msg, &iter);
+        dbus_message_iter_get_basic (&iter, &changed_interface);
+    }
+
+    return g_strdup_printf ("%s %s %s %s %s",
+                            header->sender != NULL ? header->sender : "",
+                            header->path,
+                            header->interface_name, header->member_name,
+                            changed_interface);
+}
+
+/*! \brief Append a copy of the value an iterator is at */
+static gboolean copy_value (DBusMessageIter *from, DBusMessageIter *to)
+{
+    DBusMessageIter  from_sub, to_sub;
+    DBusBasicValue   value;
+    char            *signature = NULL;
+    const char      *contained = NULL;
+    int              type      = dbus_message_iter_get_arg_type (from);
+    gboolean         ok        = TRUE;
+
+    if (dbus_type_is_basic (type)) {
+        dbus_message_iter_get_basic (from, &value);
+        return dbus_message_iter_append_basic (to, type, &value);
+    }
+
+    dbus_message_iter_recurse (from, &from_sub);
+
+    if (type == DBUS_TYPE_ARRAY) {
+        /* The signature of an empty array is only known from the array */
+        signature = dbus_message_iter_get_signature (from);
+        contained = signature + 1;
+    } else if (type == DBUS_TYPE_VARIANT) {
+        signature = dbus_message_iter_get_signature (&from_sub);
+        contained = signature;
+    }
+
+    if (!dbus_message_iter_open_container (to, type, contained, &to_sub)) {
+        dbus_free (signature);
+        return FALSE;
+    }
+
+    for (; ok && dbus_message_iter_get_arg_type (&from_sub) != DBUS_TYPE_INVALID;
+         dbus_message_iter_next (&from_sub)) {
+        ok = copy_value (&from_sub, &to_sub);
+    }
+
+    dbus_free (signature);
+    return dbus_message_iter_close_container (to, &to_sub) && ok;
+}
+
+/*! \brief Point an iterator at the changed properties, or with invalidated
+ *         at the invalidated ones, of a PropertiesChanged signal
+ */
+static void properties_iter_init (DBusMessage     *msg,
+                                  gboolean         invalidated,
+                                  DBusMessageIter *array)
+{
+    DBusMessageIter iter;
+
+    dbus_message_iter_init (msg, &iter);
+    dbus_message_iter_next (&iter);
+    if (invalidated) {
+        dbus_message_iter_next (&iter);
+    }
+    dbus_message_iter_recurse (&iter, array);
+}
+
+/*! \brief Get the name of the property an iterator of
+ *         properties_iter_init() is at
+ */
+static const char *properties_iter_name (DBusMessageIter *array)
+{
+    DBusMessageIter  entry;
+    const char      *name;
+
+    if (dbus_message_iter_get_arg_type (array) == DBUS_TYPE_DICT_ENTRY) {
+        dbus_message_iter_recurse (array, &entry);
+        dbus_message_iter_get_basic (&entry, &name);
+    } else {
+        dbus_message_iter_get_basic (array, &name);
+    }
+    return name;
+}
+
+/*! \brief Append the changed or invalidated properties of a
+ *         PropertiesChanged signal
+ *
+ * \param skip Names of properties to leave out, or NULL
+ */
+static gboolean copy_properties (DBusMessage     *msg,
+                                 gboolean         invalidated,
+                                 GHashTable      *skip,
+                                 DBusMessageIter *to)
+{
+    DBusMessageIter array;
+
+    properties_iter_init (msg, invalidated, &array);
+    for (; dbus_message_iter_get_arg_type (&array) != DBUS_TYPE_INVALID;
+         dbus_message_iter_next (&array)) {
+        if (skip != NULL &&
+            g_hash_table_contains (skip, properties_iter_name (&array))) {
+            continue;
+        }
+        if (!copy_value (&array, to)) {
+            return FALSE;
+        }
+    }
+    return TRUE;
+}
+
+/*! \brief Merge two PropertiesChanged signals for the same interface
+ *
+ * The merged signal has the properties of the newer signal, and the
+ * properties of the older one that the newer signal does not mention.
+ *
+ * \return The merged signal, or NULL if the signals could not be merged
+ */
+static DBusMessage *merge_properties_changed (DBusMessage *older,
+                                              DBusMessage *newer)
+{
+    DBusMessage     *merged;
+    DBusMessageIter  iter, array;
+    GHashTable      *mentioned;
+    const char      *changed_interface;
+    gboolean         ok;
+
+    if (!is_properties_changed (older)) {
+        return NULL;
+    }
+
+    merged = dbus_message_new_signal (dbus_message_get_path (newer),
+                                      dbus_message_get_interface (newer),
+                                      dbus_message_get_member (newer));
+    if (merged == NULL) {
+        return NULL;
+    }
+
+    ok = dbus_message_set_sender (merged, dbus_message_get_sender (newer)) &&
+         dbus_message_set_destination (merged, dbus_message_get_destination (newer));
+
+    /* The names point into the newer signal, which outlives the table */
+    mentioned = g_hash_table_new (g_str_hash, g_str_equal);
+    properties_iter_init (newer, FALSE, &array);
+    for (; dbus_message_iter_get_arg_type (&array) != DBUS_TYPE_INVALID;
+         dbus_message_iter_next (&array)) {
+        g_hash_table_add (mentioned, (gpointer) properties_iter_name (&array));
+    }
+    properties_iter_init (newer, TRUE, &array);
+    for (; dbus_message_iter_get_arg_type (&array) != DBUS_TYPE_INVALID;
+         dbus_message_iter_next (&array)) {
+        g_hash_table_add (mentioned, (gpointer) properties_iter_name (&array));
+    }
+
+    dbus_message_iter_init (newer, &iter);
+    dbus_message_iter_get_basic (&iter, &changed_interface);
+
+    dbus_message_iter_init_append (merged, &iter);
+    ok = ok &&
+         dbus_message_iter_append_basic (&iter, DBUS_TYPE_STRING, &changed_interface) &&
+         dbus_message_iter_open_container (&iter, DBUS_TYPE_ARRAY, "{sv}", &array);
+    if (ok) {
+        ok = copy_properties (older, FALSE, mentioned, &array) &&
+             copy_properties (newer, FALSE, NULL,      &array);
+        ok = dbus_message_iter_close_container (&iter, &array) && ok;
+    }
+    ok = ok && dbus_message_iter_open_container (&iter, DBUS_TYPE_ARRAY, "s", &array);
+    if (ok) {
+        ok = copy_properties (older, TRUE, mentioned, &array) &&
+             copy_properties (newer, TRUE, NULL,      &array);
+        ok = dbus_message_iter_close_container (&iter, &array) && ok;
+    }
+
+    g_hash_table_destroy (mentioned);
+
+    if (!ok) {
+        dbus_message_unref (merged);
+        return NULL;
+    }
+    return merged;
+}
+
+void delivery_set_lanes (gboolean enabled)
+{
+    lanes_enabled = enabled;
+}
+
+/*! \brief Get the lane a message is held in */
+static RuleLane lane_of (DBusMessage *msg, RuleLane lane)
+{
+    if (!lanes_enabled) {
+        return RULE_LANE_SIGNAL;
+    }
+    if (lane != RULE_LANE_NONE) {
+        return lane;
+    }
+
+    switch (dbus_message_get_type (msg)) {
+    case DBUS_MESSAGE_TYPE_METHOD_RETURN:
+    case DBUS_MESSAGE_TYPE_ERROR:
+        return RULE_LANE_REPLY;
+    case DBUS_MESSAGE_TYPE_METHOD_CALL:
+        return RULE_LANE_CALL;
+    default:
+        return RULE_LANE_SIGNAL;
+    }
+}
+
+/*! \brief Send the oldest held message of a lane to the client */
+static void send_oldest (RuleLane lane)
+{
+    HeldMessage *message = g_queue_pop_head (&held[lane]);
+
+    if (message->key != NULL) {
+        g_hash_table_remove (held_keys, message->key);
+    }
+    held_count--;
+    dbus_connection_send (client, message->msg, NULL);
+
+    dbus_message_unref (message->msg);
+    g_free (message->key);
+    g_free (message);
+}
+
+/*! \brief Pass held messages on while the client keeps up, the lanes in
+ *         order
+ */
+static void send_held (void)
+{
+    RuleLane lane;
+
+    for (lane = 0; lane < RULE_LANE_COUNT; lane++) {
+        while (!g_queue_is_empty (&held[lane])) {
+            if (dbus_connection_get_outgoing_size (client) >= DELIVERY_BACKLOG_BYTES) {
+                return;
+            }
+            send_oldest (lane);
+        }
+    }
+}
+
+static gboolean delivery_poll (gpointer data);
+
+/*! \brief Poll the client at an interval, replacing a poll at another one */
+static void delivery_schedule (guint interval)
+{
+    if (poll_source != 0 && interval == poll_interval) {
+        return;
+    }
+    if (poll_source != 0) {
+        g_source_remove (poll_source);
+    }
+    poll_interval = interval;
+    poll_source   = g_timeout_add (poll_interval, delivery_poll, NULL);
+}
+
+static gboolean delivery_poll (gpointer data)
+{
+    guint before = held_count;
+
+    send_held ();
+
+    if (held_count == 0) {
+        poll_source = 0;
+        return FALSE;
+    }
+
+    if (held_count < before) {
+        /* The client reads again, poll it as often as possible */
+        if (poll_interval == DELIVERY_POLL_INTERVAL_MS) {
+            return TRUE;
+        }
+        poll_interval = DELIVERY_POLL_INTERVAL_MS;
+    } else if (poll_interval < DELIVERY_POLL_MAX_INTERVAL_MS) {
+        poll_interval = MIN (poll_interval * 2, DELIVERY_POLL_MAX_INTERVAL_MS);
+    } else {
+        return TRUE;
+    }
+
+    /* The source is replaced, the current one is removed by returning */
+    poll_source = g_timeout_add (poll_interval, delivery_poll, NULL);
+    return FALSE;
+}
+
+void delivery_send (DBusConnection      *conn,
+                    DBusMessage         *msg,
+                    const MessageHeader *header,
+                    RuleLane             lane,
+                    gboolean             coalesce)
+{
+    HeldMessage *message;
+    DBusMessage *merged = NULL;
+    GList       *link;
+    gchar       *key    = NULL;
+    guint        before;
+
+    coalesce = coalesce && dbus_message_get_type (msg) == DBUS_MESSAGE_TYPE_SIGNAL;
+
+    if ((!coalesce && !lanes_enabled) ||
+        (held_count == 0 &&
+         dbus_connection_get_outgoing_size (conn) < DELIVERY_BACKLOG_BYTES))
+    {
+        dbus_connection_send (conn, msg, NULL);
+        return;
+    }
+
+    if (held_keys == NULL) {
+        held_keys = g_hash_table_new (g_str_hash, g_str_equal);
+    }
+    client = conn;
+
+    if (coalesce) {
+        key  = held_key (msg, header);
+        link = g_hash_table_lookup (held_keys, key);
+
+        if (link != NULL) {
+            message = link->data;
+            if (is_properties_changed (msg)) {
+                merged = merge_properties_changed (message->msg, msg);
+                if (merged != NULL) {
+                    merged_count++;
+                }
+            }
+            dbus_message_unref (message->msg);
+            message->msg = merged != NULL ? merged : dbus_message_ref (msg);
+            coalesced_count++;
+            PROBE2 (message__coalesced,
+                    header->interface_name, header->member_name);
+            g_free (key);
+            return;
+        }
+
+        /* Beyond the limit signals are not coalesced, and without lanes
+           they queue up in libdbus like other messages */
+        if (g_hash_table_size (held_keys) >= DELIVERY_MAX_HELD) {
+            g_free (key);
+            key = NULL;
+            if (!lanes_enabled) {
+                dbus_connection_send (conn, msg, NULL);
+                return;
+            }
+        }
+    }
+
+    lane = lane_of (msg, lane);
+
+    message      = g_new (HeldMessage, 1);
+    message->key = key;
+    message->msg = dbus_message_ref (msg);
+    g_queue_push_tail (&held[lane], message);
+    held_count++;
+    if (key != NULL) {
+        g_hash_table_insert (held_keys, key, held[lane].tail);
+    }
+
+    before = held_count;
+    send_held ();
+
+    if (held_count > 0 && (poll_source == 0 || held_count < before)) {
+        delivery_schedule (DELIVERY_POLL_INTERVAL_MS);
+    }
+}
+
+void delivery_flush (void)
+{
+    RuleLane lane;
+
+    for (lane = 0; lane < RULE_LANE_COUNT; lane++) {
+        while (!g_queue_is_empty (&held[lane])) {
+            send_oldest (lane);
+        }
+    }
+
+    if (poll_source != 0) {
+        g_source_remove (poll_source);
+        poll_source = 0;
+    }
+}
+
+void delivery_log_counters (void)
+{
+    if (coalesced_count > 0) {
+        g_message("Coalesced %" G_GUINT64_FORMAT " signals, "
+                  "%" G_GUINT64_FORMAT " of them merged\n",
+                  coalesced_count,
+                  merged_count);
+    }
+}
@@ -0,0 +1,80 @@
+/*
+ * Copyright (C) 2013-2016, Pelagicore AB   <joakim.gross@pelagicore.com>
+ *
+ * This library is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU Lesser General Public
+ * License as published by the Free Software Foundation; either
+ * version 2.1 of the License, or (at your option) any later version.
+ *
+ * This library is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ * Lesser General Public License for more details.
+ *
+ * You should have received a copy of the GNU Lesser General Public
+ * License along with this library; if not, write to the
+ * Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+ * Boston, MA  02110-1301, USA.
+ *
+ * For further information see LICENSE
+ */
+
+
+#ifndef DBUS_PROXY_DELIVERY_H
+#define DBUS_PROXY_DELIVERY_H
+
+#include "proxy.h"
+#include "rules.h"
+
+/*! Bytes queued for the client above which messages are held back */
+#define DELIVERY_BACKLOG_BYTES (64 * 1024)
+
+/*! Most signals held back at once to be coalesced */
+#define DELIVERY_MAX_HELD 1024
+
+/*! \brief Hold back all messages in lanes while a client is behind
+ *
+ * Without lanes only signals that are coalesced are held back.
+ */
+void delivery_set_lanes (gboolean enabled);
+
+/*! \brief Send a message from the bus to the client
+ *
+ * Signals the rules coalesce are held back while the client is behind, i.e.
+ * while more than DELIVERY_BACKLOG_BYTES are queued for it, and passed on in
+ * the order they arrived once it catches up. A held signal is replaced by a
+ * newer one with the same sender, path, interface and member, so a slow
+ * client gets the latest state instead of every step on the way. Newer
+ * PropertiesChanged signals for the same interface are merged with the held
+ * one, so no property that changed is lost.
+ *
+ * With lanes, every message is held back while the client is behind, in the
+ * lane of its rule or else of its type. Held replies and errors are passed
+ * on first, then method calls, then signals, each lane in the order the
+ * messages arrived. A reply the client waits for then only waits for the
+ * messages already queued in libdbus, not for every signal before it.
+ *
+ * Messages that are not held are sent right away, so a held message may
+ * reach the client after messages the bus sent later.
+ *
+ * \param conn     The connection to the client
+ * \param msg      The message
+ * \param header   The header fields of the message, may be NULL if
+ *                 coalesce is FALSE
+ * \param lane     The lane of the rule that allowed the message, or
+ *                 RULE_LANE_NONE
+ * \param coalesce TRUE if the rule that allowed the message coalesces
+ */
+void delivery_send (DBusConnection      *conn,
+                    DBusMessage         *msg,
+                    const MessageHeader *header,
+                    RuleLane             lane,
+                    gboolean             coalesce);
+
+/*! \brief Send all held messages to the client */
+void delivery_flush (void);
+
+/*! \brief Log how many signals were coalesced */
+void delivery_log_counters (void);
+
+#endif /* DBUS_PROXY_DELIVERY_H */
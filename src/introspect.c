@@ -0,0 +1,545 @@
+/*
+ * Copyright (C) 2013-2016, Pelagicore AB   <joakim.gross@pelagicore.com>
+ *
+ * This library is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU Lesser General Public
+ * License as published by the Free Software Foundation; either
+ * version 2.1 of the License, or (at your option) any later version.
+ *
+ * This library is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ * Lesser General Public License for more details.
+ *
+ * You should have received a copy of the GNU Lesser General Public
+ * License along with this library; if not, write to the
+ * Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+ * Boston, MA  02110-1301, USA.
+ *
+ * For further information see LICENSE
+ */
+
+
+#include "introspect.h"
+
+#include <string.h>
+
+
+/*! Introspection data cached before the cache is flushed */
+#define INTROSPECT_CACHE_MAX_ENTRIES 256
+
+/*! Introspect calls waiting for their reply. A reply whose call is not
+    known is forwarded unpruned, so calls beyond it are refused rather than
+    forgotten. */
+#define INTROSPECT_MAX_QUERIES 256
+
+/*! Introspection data of one object */
+typedef struct {
+    gchar *destination;
+    gchar *owner;
+    gchar *xml;
+} IntrospectEntry;
+
+/*! Where an Introspect call forwarded to the bus was sent */
+typedef struct {
+    gchar *destination;
+    gchar *path;
+} IntrospectQuery;
+
+/*! State of pruning one document */
+typedef struct {
+    const char *path;
+    GString    *out;
+    GString    *interface;
+    GQuark      interface_quark;
+    gchar      *interface_name;
+    guint       members;
+    guint       kept;
+    guint       depth;
+    guint       node_depth;
+    guint       interface_depth;
+    guint       skip_depth;
+} PruneContext;
+
+static gboolean    cache_enabled = FALSE;
+static gboolean    prune_enabled = FALSE;
+
+/*! The rules of the client, to prune with */
+static RuleSet    *prune_rules = NULL;
+
+/*! "destination path" -> IntrospectEntry */
+static GHashTable *entries = NULL;
+
+/*! Serial -> IntrospectQuery of Introspect calls forwarded to the bus */
+static GHashTable *queries = NULL;
+
+static GQuark      quark_introspectable;
+static GQuark      quark_introspect;
+static GQuark      quark_dbus_interface;
+static GQuark      quark_name_owner_changed;
+static GQuark      quark_outgoing;
+static GQuark      quark_incoming;
+
+
+static void introspect_entry_free (IntrospectEntry *entry)
+{
+    g_free (entry->destination);
+    g_free (entry->owner);
+    g_free (entry->xml);
+    g_free (entry);
+}
+
+static void introspect_query_free (IntrospectQuery *query)
+{
+    g_free (query->destination);
+    g_free (query->path);
+    g_free (query);
+}
+
+void introspect_configure (gboolean cache, gboolean prune)
+{
+    cache_enabled = cache;
+    prune_enabled = prune;
+}
+
+void introspect_start (RuleSet *rules)
+{
+    if (!cache_enabled && !prune_enabled) {
+        return;
+    }
+
+    quark_introspectable     = g_quark_from_static_string (DBUS_INTERFACE_INTROSPECTABLE);
+    quark_introspect         = g_quark_from_static_string ("Introspect");
+    quark_dbus_interface     = g_quark_from_static_string (DBUS_INTERFACE_DBUS);
+    quark_name_owner_changed = g_quark_from_static_string ("NameOwnerChanged");
+    quark_outgoing           = g_quark_from_static_string ("outgoing");
+    quark_incoming           = g_quark_from_static_string ("incoming");
+
+    prune_rules = rules;
+    entries = g_hash_table_new_full (g_str_hash, g_str_equal, g_free,
+                                     (GDestroyNotify) introspect_entry_free);
+    queries = g_hash_table_new_full (g_direct_hash, g_direct_equal, NULL,
+                                     (GDestroyNotify) introspect_query_free);
+}
+
+static gchar *entry_key (const char *destination, const char *path)
+{
+    /* Bus names cannot contain spaces */
+    return g_strconcat (destination, " ", path, NULL);
+}
+
+gboolean introspect_reply (DBusConnection      *client,
+                           DBusMessage         *msg,
+                           const MessageHeader *header)
+{
+    IntrospectEntry *entry;
+    IntrospectQuery *query;
+    DBusMessage     *reply;
+    gchar           *key;
+
+    if (queries == NULL                                   ||
+        header->type        != DBUS_MESSAGE_TYPE_METHOD_CALL ||
+        header->interface   != quark_introspectable        ||
+        header->member      != quark_introspect            ||
+        header->destination == NULL                        ||
+        header->path        == NULL)
+    {
+        return FALSE;
+    }
+
+    if (cache_enabled) {
+        key   = entry_key (header->destination, header->path);
+        entry = g_hash_table_lookup (entries, key);
+        g_free (key);
+
+        if (entry != NULL) {
+            if (!dbus_message_get_no_reply (msg)) {
+                reply = dbus_message_new_method_return (msg);
+                dbus_message_set_sender (reply, entry->owner);
+                dbus_message_append_args (reply,
+                                          DBUS_TYPE_STRING, &entry->xml,
+                                          DBUS_TYPE_INVALID);
+                dbus_connection_send (client, reply, NULL);
+                dbus_message_unref (reply);
+            }
+            return TRUE;
+        }
+    }
+
+    /* Nothing comes back to prune or cache */
+    if (dbus_message_get_no_reply (msg)) {
+        return FALSE;
+    }
+
+    if (g_hash_table_size (queries) >= INTROSPECT_MAX_QUERIES) {
+        reply = dbus_message_new_error (msg, DBUS_ERROR_LIMITS_EXCEEDED,
+                                        "Too many Introspect calls waiting "
+                                        "for their reply");
+        dbus_connection_send (client, reply, NULL);
+        dbus_message_unref (reply);
+        return TRUE;
+    }
+
+    query = g_new0 (IntrospectQuery, 1);
+    query->destination = g_strdup (header->destination);
+    query->path        = g_strdup (header->path);
+    g_hash_table_replace (queries,
+                          GUINT_TO_POINTER (dbus_message_get_serial (msg)),
+                          query);
+    return FALSE;
+}
+
+static void prune_append_start (GString      *out,
+                                const gchar  *element_name,
+                                const gchar **attribute_names,
+                                const gchar **attribute_values)
+{
+    gchar *escaped;
+    guint  i;
+
+    g_string_append_printf (out, "<%s", element_name);
+    for (i = 0; attribute_names[i] != NULL; i++) {
+        escaped = g_markup_escape_text (attribute_values[i], -1);
+        g_string_append_printf (out, " %s=\"%s\"", attribute_names[i], escaped);
+        g_free (escaped);
+    }
+    g_string_append_c (out, '>');
+}
+
+static const gchar *prune_attribute (const gchar **attribute_names,
+                                     const gchar **attribute_values,
+                                     const gchar  *name)
+{
+    guint i;
+
+    for (i = 0; attribute_names[i] != NULL; i++) {
+        if (strcmp (attribute_names[i], name) == 0) {
+            return attribute_values[i];
+        }
+    }
+    return NULL;
+}
+
+/*! \brief Decide if a member of the interface being pruned is kept
+ *
+ * Methods are kept when the client may call them and signals when the
+ * client may receive them. Properties are accessed through
+ * org.freedesktop.DBus.Properties, whose methods are pruned on their own,
+ * so they are always kept. Pruning is not a message, so it is not counted
+ * as a hit of the rules.
+ */
+static gboolean prune_keeps_member (PruneContext *context,
+                                    const gchar  *element_name,
+                                    const gchar  *member)
+{
+    GQuark direction;
+
+    if (strcmp (element_name, "method") == 0) {
+        direction = quark_outgoing;
+    } else if (strcmp (element_name, "signal") == 0) {
+        direction = quark_incoming;
+    } else {
+        return TRUE;
+    }
+
+    return member != NULL &&
+           rule_set_would_allow (prune_rules,
+                                 direction,
+                                 context->interface_quark,
+                                 context->interface_name,
+                                 context->path,
+                                 g_quark_try_string (member),
+                                 member);
+}
+
+static void prune_start_element (GMarkupParseContext *markup,
+                                 const gchar         *element_name,
+                                 const gchar        **attribute_names,
+                                 const gchar        **attribute_values,
+                                 gpointer             user_data,
+                                 GError             **error)
+{
+    PruneContext *context = user_data;
+    const gchar  *name;
+
+    if (context->skip_depth > 0) {
+        context->skip_depth++;
+        return;
+    }
+
+    name = prune_attribute (attribute_names, attribute_values, "name");
+
+    /* Members are the children of the interface */
+    if (context->interface != NULL &&
+        context->depth == context->interface_depth) {
+        gboolean is_member = strcmp (element_name, "annotation") != 0;
+
+        if (is_member) {
+            context->members++;
+        }
+        if (!prune_keeps_member (context, element_name, name)) {
+            context->skip_depth = 1;
+            return;
+        }
+        if (is_member) {
+            context->kept++;
+        }
+    }
+
+    context->depth++;
+
+    if (strcmp (element_name, "node") == 0) {
+        context->node_depth++;
+    } else if (context->node_depth == 1 &&
+               context->interface == NULL &&
+               strcmp (element_name, "interface") == 0) {
+        /* Interfaces of child nodes have another path and are left alone */
+        context->interface       = g_string_new (NULL);
+        context->interface_quark = g_quark_try_string (name);
+        context->interface_name  = g_strdup (name);
+        context->interface_depth = context->depth;
+        context->members         = 0;
+        context->kept            = 0;
+    }
+
+    prune_append_start (context->interface != NULL ? context->interface
+                                                   : context->out,
+                        element_name, attribute_names, attribute_values);
+}
+
+static void prune_end_element (GMarkupParseContext *markup,
+                               const gchar         *element_name,
+                               gpointer             user_data,
+                               GError             **error)
+{
+    PruneContext *context = user_data;
+    GString      *out;
+
+    if (context->skip_depth > 0) {
+        context->skip_depth--;
+        return;
+    }
+
+    out = context->interface != NULL ? context->interface : context->out;
+    g_string_append_printf (out, "</%s>", element_name);
+
+    if (strcmp (element_name, "node") == 0) {
+        context->node_depth--;
+    } else if (context->interface != NULL &&
+               context->depth == context->interface_depth) {
+        /* An interface without members has nothing to prune, so it is
+           kept when the rules allow anything on it */
+        if (context->kept > 0 ||
+            (context->members == 0 &&
+             rule_set_allows_interface (prune_rules,
+                                        context->interface_quark,
+                                        context->interface_name,
+                                        context->path))) {
+            g_string_append_len (context->out,
+                                 context->interface->str,
+                                 context->interface->len);
+        }
+        g_string_free (context->interface, TRUE);
+        g_free (context->interface_name);
+        context->interface      = NULL;
+        context->interface_name = NULL;
+    }
+
+    context->depth--;
+}
+
+static void prune_text (GMarkupParseContext *markup,
+                        const gchar         *text,
+                        gsize                text_len,
+                        gpointer             user_data,
+                        GError             **error)
+{
+    PruneContext *context = user_data;
+    gchar        *escaped;
+
+    if (context->skip_depth > 0) {
+        return;
+    }
+
+    escaped = g_markup_escape_text (text, text_len);
+    g_string_append (context->interface != NULL ? context->interface
+                                                : context->out,
+                     escaped);
+    g_free (escaped);
+}
+
+static void prune_passthrough (GMarkupParseContext *markup,
+                               const gchar         *passthrough_text,
+                               gsize                text_len,
+                               gpointer             user_data,
+                               GError             **error)
+{
+    PruneContext *context = user_data;
+
+    if (context->skip_depth > 0) {
+        return;
+    }
+
+    /* The DOCTYPE and comments */
+    g_string_append_len (context->interface != NULL ? context->interface
+                                                    : context->out,
+                         passthrough_text, text_len);
+}
+
+/*! \brief Remove what the rules reject from introspection data
+ *
+ * \param xml  The introspection data of the object
+ * \param path The object path of the object
+ * \return The pruned data, or NULL if the data could not be parsed
+ */
+static gchar *prune_xml (const char *xml, const char *path)
+{
+    static const GMarkupParser parser = {
+        prune_start_element,
+        prune_end_element,
+        prune_text,
+        prune_passthrough,
+        NULL
+    };
+    GMarkupParseContext *markup;
+    PruneContext         context;
+    GError              *error = NULL;
+    gboolean             parsed;
+
+    memset (&context, 0, sizeof (context));
+    context.path = path;
+    context.out  = g_string_sized_new (strlen (xml));
+
+    markup = g_markup_parse_context_new (&parser, 0, &context, NULL);
+    parsed = g_markup_parse_context_parse (markup, xml, -1, &error) &&
+             g_markup_parse_context_end_parse (markup, &error);
+    g_markup_parse_context_free (markup);
+
+    if (context.interface != NULL) {
+        g_string_free (context.interface, TRUE);
+    }
+    g_free (context.interface_name);
+
+    if (!parsed) {
+        g_message("Could not prune introspection data of %s: %s\n",
+                  path, error->message);
+        g_clear_error (&error);
+        g_string_free (context.out, TRUE);
+        return NULL;
+    }
+
+    return g_string_free (context.out, FALSE);
+}
+
+/*! \brief Drop the cached data of a name, or of the old owner of a name */
+static gboolean entry_is_stale (gpointer key, gpointer value, gpointer user_data)
+{
+    IntrospectEntry *entry = value;
+    const char     **names = user_data;
+
+    return strcmp (entry->destination, names[0]) == 0 ||
+           strcmp (entry->owner, names[1]) == 0;
+}
+
+/*! \brief Handle a reply to a forwarded Introspect call
+ *
+ * \return TRUE if a pruned reply was sent in place of the message
+ */
+static gboolean introspect_handle_reply (DBusConnection  *client,
+                                         DBusMessage     *msg,
+                                         IntrospectQuery *query)
+{
+    DBusMessage *pruned_reply;
+    const char  *xml;
+    gchar       *pruned = NULL;
+    const char  *sender = dbus_message_get_sender (msg);
+
+    if (!dbus_message_get_args (msg, NULL,
+                                DBUS_TYPE_STRING, &xml,
+                                DBUS_TYPE_INVALID)) {
+        return FALSE;
+    }
+
+    if (prune_enabled) {
+        pruned = prune_xml (xml, query->path);
+    }
+
+    if (cache_enabled && sender != NULL) {
+        IntrospectEntry *entry;
+
+        if (g_hash_table_size (entries) >= INTROSPECT_CACHE_MAX_ENTRIES) {
+            g_hash_table_remove_all (entries);
+        }
+
+        entry = g_new0 (IntrospectEntry, 1);
+        entry->destination = g_strdup (query->destination);
+        entry->owner       = g_strdup (sender);
+        entry->xml         = g_strdup (pruned != NULL ? pruned : xml);
+        g_hash_table_replace (entries,
+                              entry_key (query->destination, query->path),
+                              entry);
+    }
+
+    if (pruned == NULL) {
+        return FALSE;
+    }
+
+    pruned_reply = dbus_message_new (DBUS_MESSAGE_TYPE_METHOD_RETURN);
+    dbus_message_set_reply_serial (pruned_reply, dbus_message_get_reply_serial (msg));
+    dbus_message_set_sender       (pruned_reply, sender);
+    dbus_message_set_destination  (pruned_reply, dbus_message_get_destination (msg));
+    dbus_message_set_no_reply     (pruned_reply, TRUE);
+    dbus_message_append_args (pruned_reply,
+                              DBUS_TYPE_STRING, &pruned,
+                              DBUS_TYPE_INVALID);
+    dbus_connection_send (client, pruned_reply, NULL);
+    dbus_message_unref (pruned_reply);
+    g_free (pruned);
+
+    return TRUE;
+}
+
+gboolean introspect_filter (DBusConnection      *client,
+                            DBusMessage         *msg,
+                            const MessageHeader *header)
+{
+    IntrospectQuery *query;
+    gpointer         reply_serial;
+    gboolean         replaced;
+    const char      *names[3];
+
+    if (queries == NULL) {
+        return FALSE;
+    }
+
+    switch (header->type) {
+    case DBUS_MESSAGE_TYPE_METHOD_RETURN:
+    case DBUS_MESSAGE_TYPE_ERROR:
+        reply_serial = GUINT_TO_POINTER (dbus_message_get_reply_serial (msg));
+        query = g_hash_table_lookup (queries, reply_serial);
+        if (query == NULL) {
+            return FALSE;
+        }
+
+        replaced = header->type == DBUS_MESSAGE_TYPE_METHOD_RETURN &&
+                   introspect_handle_reply (client, msg, query);
+        g_hash_table_remove (queries, reply_serial);
+        return replaced;
+
+    case DBUS_MESSAGE_TYPE_SIGNAL:
+        if (cache_enabled &&
+            header->interface == quark_dbus_interface &&
+            header->member    == quark_name_owner_changed &&
+            dbus_message_get_args (msg, NULL,
+                                   DBUS_TYPE_STRING, &names[0],
+                                   DBUS_TYPE_STRING, &names[1],
+                                   DBUS_TYPE_STRING, &names[2],
+                                   DBUS_TYPE_INVALID)) {
+            g_hash_table_foreach_remove (entries, entry_is_stale, names);
+        }
+        return FALSE;
+
+    default:
+        return FALSE;
+    }
+}
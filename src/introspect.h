@@ -0,0 +1,74 @@
+/*
+ * Copyright (C) 2013-2016, Pelagicore AB   <joakim.gross@pelagicore.com>
+ *
+ * This library is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU Lesser General Public
+ * License as published by the Free Software Foundation; either
+ * version 2.1 of the License, or (at your option) any later version.
+ *
+ * This library is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ * Lesser General Public License for more details.
+ *
+ * You should have received a copy of the GNU Lesser General Public
+ * License along with this library; if not, write to the
+ * Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+ * Boston, MA  02110-1301, USA.
+ *
+ * For further information see LICENSE
+ */
+
+#ifndef DBUS_PROXY_INTROSPECT_H
+#define DBUS_PROXY_INTROSPECT_H
+
+#include "proxy.h"
+#include "rules.h"
+
+/*! \brief Choose how Introspect calls are handled
+ *
+ * \param cache Answer repeated Introspect calls from a cache
+ * \param prune Remove the methods and signals the rules reject from the
+ *              introspection data, and the interfaces left empty
+ */
+void introspect_configure (gboolean cache, gboolean prune);
+
+/*! \brief Start handling Introspect calls of a client
+ *
+ * The cache relies on the NameOwnerChanged subscription of the names cache
+ * to be invalidated, see names_cache_start().
+ *
+ * \param rules The rules of the client, used for pruning
+ */
+void introspect_start (RuleSet *rules);
+
+/*! \brief Answer an Introspect call from the cache
+ *
+ * Only call this for messages the rules allow. Calls that are not answered
+ * and expect a reply are remembered, so their replies can be cached and
+ * pruned. Calls beyond a limit of calls waiting for their reply are answered
+ * with an error.
+ *
+ * \param client The connection to the client, the reply is sent on it
+ * \param msg    The message from the client
+ * \param header The header fields of the message
+ * \return TRUE if the message was answered, FALSE if it must be forwarded
+ */
+gboolean introspect_reply (DBusConnection      *client,
+                           DBusMessage         *msg,
+                           const MessageHeader *header);
+
+/*! \brief Cache and prune replies to Introspect calls from the bus
+ *
+ * Also drops cached data of names whose owner changes.
+ *
+ * \param client The connection to the client, pruned replies are sent on it
+ * \param msg    The message from the bus
+ * \param header The header fields of the message
+ * \return TRUE if a pruned reply was sent in place of the message
+ */
+gboolean introspect_filter (DBusConnection      *client,
+                            DBusMessage         *msg,
+                            const MessageHeader *header);
+
+#endif /* DBUS_PROXY_INTROSPECT_H */
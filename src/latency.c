@@ -0,0 +1,441 @@
+/*
+ * Copyright (C) 2013-2016, Pelagicore AB   <joakim.gross@pelagicore.com>
+ *
+ * This library is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU Lesser General Public
+ * License as published by the Free Software Foundation; either
+ * version 2.1 of the License, or (at your option) any later version.
+ *
+ * This library is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ * Lesser General Public License for more details.
+ *
+ * You should have received a copy of the GNU Lesser General Public
+ * License along with this library; if not, write to the
+ * Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+ * Boston, MA  02110-1301, USA.
+ *
+ * For further information see LICENSE
+ */
+
+
+#include "latency.h"
+#include "output.h"
+
+#include <stdlib.h>
+#include <string.h>
+#include <unistd.h>
+#include <errno.h>
+#include <signal.h>
+#include <time.h>
+#include <execinfo.h>
+#include <sys/time.h>
+
+#include <jansson.h>
+
+
+/*! Bits of a value kept in a bucket. Values below 2^LATENCY_SUB_BITS have a
+    bucket each, above that a bucket covers 1/16 of a power of two, so a
+    value is off by at most about 6%. */
+#define LATENCY_SUB_BITS 5
+#define LATENCY_SUB_HALF (1 << (LATENCY_SUB_BITS - 1))
+
+/*! Buckets for all values of 64 bits */
+#define LATENCY_BUCKETS \
+    ((1 << LATENCY_SUB_BITS) + (64 - LATENCY_SUB_BITS) * LATENCY_SUB_HALF)
+
+/*! Time from the first dispatch timed to the write of the histograms */
+#define LATENCY_FLUSH_INTERVAL_MS 10000
+
+/*! Frames of the stack written for a stall */
+#define LATENCY_STACK_DEPTH 64
+
+
+/*! Dispatch times of one point, in nanoseconds */
+typedef struct {
+    guint64 buckets[LATENCY_BUCKETS];
+    guint64 count;
+    guint64 sum;
+    guint64 max;
+    guint64 stalls;
+
+    /*! Count when the histogram was last written */
+    guint64 flushed;
+} LatencyHistogram;
+
+static const char *point_names[LATENCY_POINT_COUNT] = {
+    "outgoing", "incoming", "config"
+};
+
+/*! Set when dispatches are timed */
+static gboolean          timing = FALSE;
+
+static LatencyHistogram  histograms[LATENCY_POINT_COUNT];
+static int               log_fd = -1;
+static OutputBatch       batch  = { latency_flush, LATENCY_FLUSH_INTERVAL_MS, 0 };
+
+/*! Stall threshold in nanoseconds, 0 without a watchdog */
+static gint64            stall_threshold_ns = 0;
+static int               stall_fd = STDERR_FILENO;
+
+/*! The dispatch that is running, read by the watchdog in a signal handler.
+    The start is 0 between dispatches. */
+static volatile gint64               dispatch_start = 0;
+static volatile LatencyPoint         dispatch_point;
+static const MessageHeader *volatile dispatch_header = NULL;
+static volatile sig_atomic_t         stall_reported = FALSE;
+
+/*! The watchdog timer is stopped by the watchdog when nothing was
+    dispatched for a tick, so idle processes are not woken up, and started
+    again by the next dispatch */
+static volatile sig_atomic_t         watchdog_armed = FALSE;
+static volatile sig_atomic_t         dispatched_since_tick = FALSE;
+
+
+static gint64 now_ns (void)
+{
+    struct timespec now;
+
+    clock_gettime (CLOCK_MONOTONIC, &now);
+    return (gint64) now.tv_sec * 1000000000 + now.tv_nsec;
+}
+
+static guint bucket_index (guint64 value)
+{
+    guint shift;
+
+    if (value < (1 << LATENCY_SUB_BITS)) {
+        return value;
+    }
+
+    /* Keep the top LATENCY_SUB_BITS bits of the value. g_bit_storage() takes
+       a gulong, which may have 32 bits. */
+    shift = 1;
+    while ((value >> shift) >= (1 << LATENCY_SUB_BITS)) {
+        shift++;
+    }
+    return (1 << LATENCY_SUB_BITS) +
+           (shift - 1) * LATENCY_SUB_HALF +
+           (guint) (value >> shift) - LATENCY_SUB_HALF;
+}
+
+/*! \brief The highest value that falls in a bucket */
+static guint64 bucket_highest (guint index)
+{
+    guint shift;
+    guint sub;
+
+    if (index < (1 << LATENCY_SUB_BITS)) {
+        return index;
+    }
+
+    index -= 1 << LATENCY_SUB_BITS;
+    shift  = index / LATENCY_SUB_HALF + 1;
+    sub    = index % LATENCY_SUB_HALF + LATENCY_SUB_HALF;
+    return (((guint64) sub + 1) << shift) - 1;
+}
+
+static guint64 histogram_percentile (const LatencyHistogram *histogram,
+                                     gdouble                 percentile)
+{
+    guint64 wanted = (guint64) (histogram->count * percentile / 100.0);
+    guint64 seen = 0;
+    guint   i;
+
+    for (i = 0; i < LATENCY_BUCKETS; i++) {
+        seen += histogram->buckets[i];
+        if (seen > wanted) {
+            return MIN (bucket_highest (i), histogram->max);
+        }
+    }
+
+    return histogram->max;
+}
+
+static void set_watchdog_timer (gint64 interval_ns)
+{
+    struct itimerval timer;
+
+    timer.it_interval.tv_sec  = interval_ns / 1000000000;
+    timer.it_interval.tv_usec = interval_ns % 1000000000 / 1000;
+    timer.it_value            = timer.it_interval;
+    setitimer (ITIMER_REAL, &timer, NULL);
+}
+
+/* The stall report is written from a signal handler, where only write()
+   may be used, so it is formatted by hand */
+
+static void append_string (char *buffer, gsize *length, gsize size,
+                           const char *string)
+{
+    while (string != NULL && *string != '\0' && *length < size) {
+        buffer[(*length)++] = *string++;
+    }
+}
+
+static void append_number (char *buffer, gsize *length, gsize size,
+                           guint64 number)
+{
+    char  digits[21];
+    guint n = 0;
+
+    do {
+        digits[n++] = '0' + number % 10;
+        number /= 10;
+    } while (number > 0);
+
+    while (n > 0 && *length < size) {
+        buffer[(*length)++] = digits[--n];
+    }
+}
+
+static void write_stall_report (gint64 running_ns)
+{
+    static char                buffer[2048];
+    const MessageHeader       *header = dispatch_header;
+    void                      *frames[LATENCY_STACK_DEPTH];
+    gsize                      length = 0;
+    gsize                      size = sizeof (buffer);
+    ssize_t                    res;
+    int                        n_frames;
+
+#define APPEND(string) append_string (buffer, &length, size, (string))
+    APPEND ("dbus-proxy stall: pid ");
+    append_number (buffer, &length, size, getpid ());
+    APPEND (", ");
+    APPEND (point_names[dispatch_point]);
+    APPEND (" dispatch running for ");
+    append_number (buffer, &length, size, running_ns / 1000000);
+    APPEND (" ms\n");
+    if (header != NULL) {
+        APPEND ("  message type ");
+        append_number (buffer, &length, size, header->type);
+        APPEND (", interface ");
+        APPEND (header->interface_name != NULL ? header->interface_name : "-");
+        APPEND (", path ");
+        APPEND (header->path != NULL ? header->path : "-");
+        APPEND (", member ");
+        APPEND (header->member_name != NULL ? header->member_name : "-");
+        APPEND (", destination ");
+        APPEND (header->destination != NULL ? header->destination : "-");
+        APPEND (", sender ");
+        APPEND (header->sender != NULL ? header->sender : "-");
+        APPEND ("\n");
+    }
+    APPEND ("  stack:\n");
+#undef APPEND
+
+    res = write (stall_fd, buffer, length);
+    (void) res;
+
+    n_frames = backtrace (frames, LATENCY_STACK_DEPTH);
+    backtrace_symbols_fd (frames, n_frames, stall_fd);
+}
+
+static void watchdog_tick (int signum)
+{
+    int     saved_errno = errno;
+    gint64  start = dispatch_start;
+    gint64  running;
+
+    if (start != 0) {
+        running = now_ns () - start;
+        if (running >= stall_threshold_ns && !stall_reported) {
+            stall_reported = TRUE;
+            write_stall_report (running);
+        }
+    } else if (!dispatched_since_tick) {
+        set_watchdog_timer (0);
+        watchdog_armed = FALSE;
+    }
+
+    dispatched_since_tick = FALSE;
+    errno = saved_errno;
+}
+
+static void start_watchdog (void)
+{
+    struct sigaction action;
+    void            *frames[1];
+
+    /* The first backtrace loads what it needs, which must not happen in
+       the signal handler */
+    backtrace (frames, 1);
+
+    memset (&action, 0, sizeof (action));
+    action.sa_handler = watchdog_tick;
+    action.sa_flags   = SA_RESTART;
+    sigemptyset (&action.sa_mask);
+    sigaction (SIGALRM, &action, NULL);
+
+    watchdog_armed = FALSE;
+}
+
+gboolean latency_open (const char *log_path,
+                       guint       stall_threshold,
+                       const char *stall_path)
+{
+    if (log_path == NULL && stall_threshold == 0) {
+        return TRUE;
+    }
+
+    if (log_path != NULL) {
+        log_fd = output_open (log_path, "latency log");
+        if (log_fd < 0) {
+            return FALSE;
+        }
+        output_batch_register (&batch);
+    }
+
+    if (stall_threshold > 0) {
+        if (stall_path != NULL) {
+            stall_fd = output_open (stall_path, "stall log");
+            if (stall_fd < 0) {
+                return FALSE;
+            }
+        }
+
+        stall_threshold_ns = (gint64) stall_threshold * 1000000;
+        start_watchdog ();
+    }
+
+    timing = TRUE;
+    return TRUE;
+}
+
+void latency_enter_child (void)
+{
+    if (!timing) {
+        return;
+    }
+
+    memset (histograms, 0, sizeof (histograms));
+
+    /* Interval timers are not inherited by a child */
+    watchdog_armed = FALSE;
+}
+
+void latency_begin (LatencyPoint point, const MessageHeader *header)
+{
+    if (!timing) {
+        return;
+    }
+
+    dispatch_point        = point;
+    dispatch_header       = header;
+    stall_reported        = FALSE;
+    dispatched_since_tick = TRUE;
+    dispatch_start        = now_ns ();
+
+    /* The watchdog checks twice per threshold, so a stall is reported
+       within one and a half thresholds */
+    if (stall_threshold_ns > 0 && !watchdog_armed) {
+        watchdog_armed = TRUE;
+        set_watchdog_timer (MAX (stall_threshold_ns / 2, 1000000));
+    }
+}
+
+void latency_end (void)
+{
+    LatencyHistogram *histogram;
+    guint64           elapsed;
+
+    if (!timing || dispatch_start == 0) {
+        return;
+    }
+
+    elapsed        = now_ns () - dispatch_start;
+    dispatch_start = 0;
+
+    histogram = &histograms[dispatch_point];
+    histogram->buckets[bucket_index (elapsed)]++;
+    histogram->count++;
+    histogram->sum += elapsed;
+    histogram->max  = MAX (histogram->max, elapsed);
+
+    if (log_fd >= 0) {
+        output_batch_schedule (&batch);
+    }
+
+    if (stall_threshold_ns > 0 && (gint64) elapsed >= stall_threshold_ns) {
+        histogram->stalls++;
+        g_message("%s dispatch took %" G_GUINT64_FORMAT " ms\n",
+                  point_names[dispatch_point], elapsed / 1000000);
+    }
+}
+
+static json_t *json_microseconds (guint64 nanoseconds)
+{
+    return json_real (nanoseconds / 1000.0);
+}
+
+void latency_flush (void)
+{
+    GString *lines;
+    json_t  *object;
+    json_t  *buckets;
+    char    *line;
+    guint    point, i;
+
+    if (log_fd < 0) {
+        return;
+    }
+
+    lines = g_string_new (NULL);
+
+    for (point = 0; point < LATENCY_POINT_COUNT; point++) {
+        LatencyHistogram *histogram = &histograms[point];
+
+        if (histogram->count == histogram->flushed) {
+            continue;
+        }
+        histogram->flushed = histogram->count;
+
+        /* Only the buckets that were hit, as [highest value, count] */
+        buckets = json_array ();
+        for (i = 0; i < LATENCY_BUCKETS; i++) {
+            if (histogram->buckets[i] > 0) {
+                json_t *bucket = json_array ();
+
+                json_array_append_new (bucket, json_integer (bucket_highest (i)));
+                json_array_append_new (bucket, json_integer (histogram->buckets[i]));
+                json_array_append_new (buckets, bucket);
+            }
+        }
+
+        object = json_object ();
+        json_object_set_new (object, "time",
+                             json_real (g_get_real_time () / (double) G_USEC_PER_SEC));
+        json_object_set_new (object, "pid", json_integer (getpid ()));
+        json_object_set_new (object, "point", json_string (point_names[point]));
+        json_object_set_new (object, "count", json_integer (histogram->count));
+        json_object_set_new (object, "stalls", json_integer (histogram->stalls));
+        json_object_set_new (object, "mean_us",
+                             json_microseconds (histogram->sum / histogram->count));
+        json_object_set_new (object, "p50_us",
+                             json_microseconds (histogram_percentile (histogram, 50)));
+        json_object_set_new (object, "p90_us",
+                             json_microseconds (histogram_percentile (histogram, 90)));
+        json_object_set_new (object, "p99_us",
+                             json_microseconds (histogram_percentile (histogram, 99)));
+        json_object_set_new (object, "p999_us",
+                             json_microseconds (histogram_percentile (histogram, 99.9)));
+        json_object_set_new (object, "max_us", json_microseconds (histogram->max));
+        json_object_set_new (object, "buckets_ns", buckets);
+
+        line = json_dumps (object, JSON_COMPACT);
+        json_decref (object);
+        if (line != NULL) {
+            g_string_append (lines, line);
+            g_string_append_c (lines, '\n');
+            free (line);
+        }
+    }
+
+    /* One write per batch, with O_APPEND the lines of different proxy
+       processes do not interleave */
+    output_write (log_fd, lines->str, lines->len, "latency log");
+
+    g_string_free (lines, TRUE);
+}
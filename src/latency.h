@@ -0,0 +1,82 @@
+/*
+ * Copyright (C) 2013-2016, Pelagicore AB   <joakim.gross@pelagicore.com>
+ *
+ * This library is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU Lesser General Public
+ * License as published by the Free Software Foundation; either
+ * version 2.1 of the License, or (at your option) any later version.
+ *
+ * This library is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ * Lesser General Public License for more details.
+ *
+ * You should have received a copy of the GNU Lesser General Public
+ * License along with this library; if not, write to the
+ * Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+ * Boston, MA  02110-1301, USA.
+ *
+ * For further information see LICENSE
+ */
+
+#ifndef DBUS_PROXY_LATENCY_H
+#define DBUS_PROXY_LATENCY_H
+
+#include "proxy.h"
+
+/*! The dispatches that are timed */
+typedef enum {
+    /*! A message from the client, in filter_cb() */
+    LATENCY_OUTGOING = 0,
+    /*! A message from the bus, in master_filter_cb() */
+    LATENCY_INCOMING,
+    /*! A config read from stdin, in parse_full_config() */
+    LATENCY_CONFIG,
+    LATENCY_POINT_COUNT
+} LatencyPoint;
+
+/*! \brief Start timing dispatches
+ *
+ * The time of each dispatch is added to a histogram per point, with buckets
+ * of a few percent over the whole range like an HDR histogram. Each process
+ * appends its histograms to the log as JSON lines every few seconds and at
+ * exit.
+ *
+ * A watchdog reports dispatches that run for longer than the stall
+ * threshold while they still run, with the header of the message and the
+ * stack of the process, so the cause of a stall can be found.
+ *
+ * \param log_path        The file to append histograms to, or NULL
+ * \param stall_threshold Milliseconds a dispatch may take, 0 for no watchdog
+ * \param stall_path      The file to append stall reports to, or NULL for
+ *                        stderr
+ * \return FALSE if a file could not be opened
+ */
+gboolean latency_open (const char *log_path,
+                       guint       stall_threshold,
+                       const char *stall_path);
+
+/*! \brief Start afresh in a forked child
+ *
+ * The histograms of the parent are cleared, and the watchdog timer, which
+ * is not inherited, is set up again.
+ */
+void latency_enter_child (void);
+
+/*! \brief Note the start of a dispatch
+ *
+ * \param point  What is dispatched
+ * \param header The header of the message, NULL for a config. It must stay
+ *               valid until latency_end()
+ */
+void latency_begin (LatencyPoint point, const MessageHeader *header);
+
+/*! \brief Note the end of the dispatch started last, and add its time to
+ *         the histogram
+ */
+void latency_end (void);
+
+/*! \brief Append the histograms that changed to the log */
+void latency_flush (void);
+
+#endif /* DBUS_PROXY_LATENCY_H */
@@ -0,0 +1,535 @@
+/*
+ * Copyright (C) 2013-2016, Pelagicore AB   <joakim.gross@pelagicore.com>
+ *
+ * This library is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU Lesser General Public
+ * License as published by the Free Software Foundation; either
+ * version 2.1 of the License, or (at your option) any later version.
+ *
+ * This library is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ * Lesser General Public License for more details.
+ *
+ * You should have received a copy of the GNU Lesser General Public
+ * License along with this library; if not, write to the
+ * Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+ * Boston, MA  02110-1301, USA.
+ *
+ * For further information see LICENSE
+ */
+
+
+#include "names.h"
+
+#include <string.h>
+
+
+/*! The signals the cache follows */
+#define NAME_OWNER_CHANGED_RULE \
+    "type='signal',sender='" DBUS_SERVICE_DBUS "'," \
+    "interface='" DBUS_INTERFACE_DBUS "',member='NameOwnerChanged'," \
+    "path='" DBUS_PATH_DBUS "'"
+
+/*! Serials of the messages the cache sends itself. Messages of the client
+    are forwarded with the serials the client gave them, counting up from 1,
+    so the cache takes its serials from the top of the range. */
+#define NAMES_SERIAL_ADD_MATCH  0xfffffff0
+#define NAMES_SERIAL_LIST_NAMES 0xfffffff1
+
+/*! A match rule the client has added, as key/value pairs */
+typedef struct {
+    gchar      *text;
+    GHashTable *keys;
+} MatchRule;
+
+/*! Set once the cache follows the bus */
+static gboolean    started  = FALSE;
+
+/*! Set once the names of the bus have arrived, queries are forwarded to
+    the bus until then */
+static gboolean    complete = FALSE;
+
+/*! Name -> owner of all names on the bus. The owner is NULL for a
+    well-known name whose owner has not been seen yet. */
+static GHashTable *owners        = NULL;
+
+/*! Serial -> name of GetNameOwner calls forwarded to the bus */
+static GHashTable *owner_queries = NULL;
+
+/*! The match rules of the client */
+static GList      *match_rules   = NULL;
+
+static GQuark      quark_dbus_interface;
+static GQuark      quark_get_name_owner;
+static GQuark      quark_name_has_owner;
+static GQuark      quark_list_names;
+static GQuark      quark_name_owner_changed;
+static GQuark      quark_add_match;
+static GQuark      quark_remove_match;
+
+
+static void send_to_bus (DBusConnection *bus,
+                         const char     *member,
+                         const char     *argument,
+                         dbus_uint32_t   serial,
+                         gboolean        no_reply)
+{
+    DBusMessage *msg;
+
+    msg = dbus_message_new_method_call (DBUS_SERVICE_DBUS,
+                                        DBUS_PATH_DBUS,
+                                        DBUS_INTERFACE_DBUS,
+                                        member);
+    if (argument != NULL) {
+        dbus_message_append_args (msg,
+                                  DBUS_TYPE_STRING, &argument,
+                                  DBUS_TYPE_INVALID);
+    }
+    dbus_message_set_no_reply (msg, no_reply);
+    dbus_message_set_serial (msg, serial);
+
+    dbus_connection_send (bus, msg, NULL);
+    dbus_message_unref (msg);
+}
+
+void names_cache_start (DBusConnection *bus)
+{
+    quark_dbus_interface     = g_quark_from_static_string (DBUS_INTERFACE_DBUS);
+    quark_get_name_owner     = g_quark_from_static_string ("GetNameOwner");
+    quark_name_has_owner     = g_quark_from_static_string ("NameHasOwner");
+    quark_list_names         = g_quark_from_static_string ("ListNames");
+    quark_name_owner_changed = g_quark_from_static_string ("NameOwnerChanged");
+    quark_add_match          = g_quark_from_static_string ("AddMatch");
+    quark_remove_match       = g_quark_from_static_string ("RemoveMatch");
+
+    owners        = g_hash_table_new_full (g_str_hash, g_str_equal, g_free, g_free);
+    owner_queries = g_hash_table_new_full (g_direct_hash, g_direct_equal, NULL, g_free);
+
+    /* The bus handles messages in order, so all changes after the names
+       are listed arrive as signals after the reply */
+    send_to_bus (bus, "AddMatch", NAME_OWNER_CHANGED_RULE,
+                 NAMES_SERIAL_ADD_MATCH, TRUE);
+    send_to_bus (bus, "ListNames", NULL,
+                 NAMES_SERIAL_LIST_NAMES, FALSE);
+
+    started = TRUE;
+}
+
+static gboolean is_from_bus (const MessageHeader *header)
+{
+    return header->sender != NULL &&
+           strcmp (header->sender, DBUS_SERVICE_DBUS) == 0;
+}
+
+static gboolean is_query (const MessageHeader *header)
+{
+    return header->type      == DBUS_MESSAGE_TYPE_METHOD_CALL &&
+           header->interface == quark_dbus_interface          &&
+           header->destination != NULL                        &&
+           strcmp (header->destination, DBUS_SERVICE_DBUS) == 0;
+}
+
+/*! \brief Replace the names with the ones in a ListNames reply
+ *
+ * Owners seen in signals before the reply are kept. Unique names and the
+ * name of the bus own themselves.
+ */
+static void load_names (DBusMessage *reply)
+{
+    DBusMessageIter iter;
+    DBusMessageIter names;
+    GHashTable     *loaded;
+    const char     *name;
+    const char     *owner;
+
+    if (!dbus_message_has_signature (reply, "as")) {
+        g_message("Unexpected reply to ListNames, names are not cached\n");
+        return;
+    }
+
+    loaded = g_hash_table_new_full (g_str_hash, g_str_equal, g_free, g_free);
+
+    dbus_message_iter_init (reply, &iter);
+    dbus_message_iter_recurse (&iter, &names);
+    while (dbus_message_iter_get_arg_type (&names) == DBUS_TYPE_STRING) {
+        dbus_message_iter_get_basic (&names, &name);
+
+        if (name[0] == ':' || strcmp (name, DBUS_SERVICE_DBUS) == 0) {
+            owner = name;
+        } else {
+            owner = g_hash_table_lookup (owners, name);
+        }
+        g_hash_table_replace (loaded, g_strdup (name), g_strdup (owner));
+
+        dbus_message_iter_next (&names);
+    }
+
+    g_hash_table_destroy (owners);
+    owners   = loaded;
+    complete = TRUE;
+
+    g_message("Cached %u names\n", g_hash_table_size (owners));
+}
+
+static void send_reply (DBusConnection *client, DBusMessage *msg, DBusMessage *reply)
+{
+    if (!dbus_message_get_no_reply (msg)) {
+        dbus_message_set_sender (reply, DBUS_SERVICE_DBUS);
+        dbus_connection_send (client, reply, NULL);
+    }
+    dbus_message_unref (reply);
+}
+
+gboolean names_cache_reply (DBusConnection      *client,
+                            DBusMessage         *msg,
+                            const MessageHeader *header)
+{
+    DBusMessage     *reply;
+    DBusMessageIter  iter;
+    DBusMessageIter  array;
+    GHashTableIter   names;
+    const char      *name;
+    gpointer         owner;
+    dbus_bool_t      has_owner;
+
+    if (!complete || !is_query (header)) {
+        return FALSE;
+    }
+
+    /* Calls with unexpected arguments are left to the bus to reply to */
+    if (header->member == quark_list_names) {
+        if (!dbus_message_has_signature (msg, "")) {
+            return FALSE;
+        }
+
+        reply = dbus_message_new_method_return (msg);
+        dbus_message_iter_init_append (reply, &iter);
+        dbus_message_iter_open_container (&iter, DBUS_TYPE_ARRAY,
+                                          DBUS_TYPE_STRING_AS_STRING, &array);
+        g_hash_table_iter_init (&names, owners);
+        while (g_hash_table_iter_next (&names, (gpointer *) &name, NULL)) {
+            dbus_message_iter_append_basic (&array, DBUS_TYPE_STRING, &name);
+        }
+        dbus_message_iter_close_container (&iter, &array);
+
+    } else if (header->member == quark_name_has_owner) {
+        if (!dbus_message_get_args (msg, NULL,
+                                    DBUS_TYPE_STRING, &name,
+                                    DBUS_TYPE_INVALID)) {
+            return FALSE;
+        }
+
+        has_owner = g_hash_table_contains (owners, name);
+        reply = dbus_message_new_method_return (msg);
+        dbus_message_append_args (reply,
+                                  DBUS_TYPE_BOOLEAN, &has_owner,
+                                  DBUS_TYPE_INVALID);
+
+    } else if (header->member == quark_get_name_owner) {
+        if (!dbus_message_get_args (msg, NULL,
+                                    DBUS_TYPE_STRING, &name,
+                                    DBUS_TYPE_INVALID)) {
+            return FALSE;
+        }
+
+        if (!g_hash_table_lookup_extended (owners, name, NULL, &owner)) {
+            reply = dbus_message_new_error_printf (msg,
+                        DBUS_ERROR_NAME_HAS_NO_OWNER,
+                        "Could not get owner of name '%s': no such name",
+                        name);
+        } else if (owner == NULL) {
+            /* Learn the owner from the reply of the bus */
+            g_hash_table_replace (owner_queries,
+                                  GUINT_TO_POINTER (dbus_message_get_serial (msg)),
+                                  g_strdup (name));
+            return FALSE;
+        } else {
+            reply = dbus_message_new_method_return (msg);
+            dbus_message_append_args (reply,
+                                      DBUS_TYPE_STRING, &owner,
+                                      DBUS_TYPE_INVALID);
+        }
+
+    } else {
+        return FALSE;
+    }
+
+    send_reply (client, msg, reply);
+    return TRUE;
+}
+
+/*! \brief Parse the key/value pairs of a match rule
+ *
+ * Values may be quoted with apostrophes, and outside quotes \' is an
+ * apostrophe. Rules the bus rejects may be parsed into nonsense, which at
+ * worst lets the client get signals it did not ask for.
+ */
+static GHashTable *match_rule_parse (const char *text)
+{
+    GHashTable *keys;
+    GString    *key;
+    GString    *value;
+    const char *p = text;
+    gboolean    quoted;
+
+    keys  = g_hash_table_new_full (g_str_hash, g_str_equal, g_free, g_free);
+    key   = g_string_new (NULL);
+    value = g_string_new (NULL);
+
+    while (*p != '\0') {
+        g_string_truncate (key, 0);
+        g_string_truncate (value, 0);
+
+        while (*p == ' ' || *p == ',') {
+            p++;
+        }
+        while (*p != '\0' && *p != '=') {
+            g_string_append_c (key, *p++);
+        }
+        if (*p != '=') {
+            break;
+        }
+        p++;
+
+        for (quoted = FALSE; *p != '\0' && (quoted || *p != ','); p++) {
+            if (*p == '\'') {
+                quoted = !quoted;
+            } else if (!quoted && p[0] == '\\' && p[1] == '\'') {
+                g_string_append_c (value, '\'');
+                p++;
+            } else {
+                g_string_append_c (value, *p);
+            }
+        }
+
+        g_hash_table_replace (keys,
+                              g_strchomp (g_strdup (key->str)),
+                              g_strdup (value->str));
+    }
+
+    g_string_free (key, TRUE);
+    g_string_free (value, TRUE);
+    return keys;
+}
+
+static void match_rule_free (MatchRule *rule)
+{
+    g_free (rule->text);
+    g_hash_table_destroy (rule->keys);
+    g_free (rule);
+}
+
+static gboolean match_key (GHashTable *keys, const char *key, const char *value)
+{
+    const char *expected = g_hash_table_lookup (keys, key);
+
+    return expected == NULL || (value != NULL && strcmp (expected, value) == 0);
+}
+
+/*! \brief Test the sender of a match rule, a well-known name matches the
+ *         signals of its owner
+ */
+static gboolean match_sender (GHashTable *keys, const char *sender)
+{
+    const char *expected = g_hash_table_lookup (keys, "sender");
+
+    return expected == NULL ||
+           (sender != NULL &&
+            (strcmp (expected, sender) == 0 ||
+             g_strcmp0 (g_hash_table_lookup (owners, expected), sender) == 0));
+}
+
+static gboolean match_namespace (GHashTable *keys,
+                                 const char *key,
+                                 const char *value,
+                                 char        separator)
+{
+    const char *namespace = g_hash_table_lookup (keys, key);
+    gsize       length;
+
+    if (namespace == NULL) {
+        return TRUE;
+    }
+    if (value == NULL) {
+        return FALSE;
+    }
+
+    /* A path namespace of "/" is all paths */
+    length = strlen (namespace);
+    if (separator == '/' && length > 0 && namespace[length - 1] == '/') {
+        length--;
+    }
+
+    return strncmp (value, namespace, length) == 0 &&
+           (value[length] == '\0' || value[length] == separator);
+}
+
+/*! \brief Test if a match rule of the client covers a signal
+ *
+ * Keys the proxy does not know are ignored, so a rule may cover more
+ * signals than the bus would give the client.
+ *
+ * \param args The first three arguments of the signal, NULL where an
+ *             argument is missing or not a string
+ */
+static gboolean match_rule_covers (const MatchRule   *rule,
+                                   const char        *sender,
+                                   const char        *interface,
+                                   const char        *member,
+                                   const char        *path,
+                                   const char *const *args)
+{
+    return match_key (rule->keys, "type",      "signal")  &&
+           match_sender (rule->keys, sender)              &&
+           match_key (rule->keys, "interface", interface) &&
+           match_key (rule->keys, "member",    member)    &&
+           match_key (rule->keys, "path",      path)      &&
+           match_key (rule->keys, "arg0",      args[0])   &&
+           match_key (rule->keys, "arg1",      args[1])   &&
+           match_key (rule->keys, "arg2",      args[2])   &&
+           match_namespace (rule->keys, "arg0namespace",  args[0], '.') &&
+           match_namespace (rule->keys, "path_namespace", path,    '/');
+}
+
+static gboolean client_matches (const char        *sender,
+                                const char        *interface,
+                                const char        *member,
+                                const char        *path,
+                                const char *const *args)
+{
+    GList *iter;
+
+    for (iter = match_rules; iter != NULL; iter = iter->next) {
+        if (match_rule_covers (iter->data, sender, interface, member, path, args)) {
+            return TRUE;
+        }
+    }
+    return FALSE;
+}
+
+gboolean names_cache_client_matches (DBusMessage *msg, const MessageHeader *header)
+{
+    DBusMessageIter iter;
+    const char     *args[3] = { NULL, NULL, NULL };
+    guint           i;
+
+    /* Without the match rules of the client, assume it asked */
+    if (!started) {
+        return TRUE;
+    }
+
+    if (dbus_message_iter_init (msg, &iter)) {
+        for (i = 0; i < G_N_ELEMENTS (args); i++) {
+            if (dbus_message_iter_get_arg_type (&iter) == DBUS_TYPE_STRING) {
+                dbus_message_iter_get_basic (&iter, &args[i]);
+            }
+            if (!dbus_message_iter_next (&iter)) {
+                break;
+            }
+        }
+    }
+
+    return client_matches (header->sender, header->interface_name,
+                           header->member_name, header->path, args);
+}
+
+void names_cache_track_match (DBusMessage *msg, const MessageHeader *header)
+{
+    MatchRule  *rule;
+    const char *text;
+    GList      *iter;
+
+    if (!started || !is_query (header) ||
+        (header->member != quark_add_match && header->member != quark_remove_match) ||
+        !dbus_message_get_args (msg, NULL,
+                                DBUS_TYPE_STRING, &text,
+                                DBUS_TYPE_INVALID)) {
+        return;
+    }
+
+    if (header->member == quark_add_match) {
+        rule = g_new0 (MatchRule, 1);
+        rule->text = g_strdup (text);
+        rule->keys = match_rule_parse (text);
+        match_rules = g_list_append (match_rules, rule);
+        return;
+    }
+
+    /* Like the bus, remove one instance of the rule */
+    for (iter = match_rules; iter != NULL; iter = iter->next) {
+        rule = iter->data;
+        if (strcmp (rule->text, text) == 0) {
+            match_rules = g_list_delete_link (match_rules, iter);
+            match_rule_free (rule);
+            break;
+        }
+    }
+}
+
+gboolean names_cache_filter (DBusMessage *msg, const MessageHeader *header)
+{
+    dbus_uint32_t  reply_serial;
+    const char    *name;
+    const char    *old_owner;
+    const char    *new_owner;
+    const char    *args[3];
+
+    if (!started || !is_from_bus (header)) {
+        return FALSE;
+    }
+
+    switch (header->type) {
+    case DBUS_MESSAGE_TYPE_METHOD_RETURN:
+    case DBUS_MESSAGE_TYPE_ERROR:
+        reply_serial = dbus_message_get_reply_serial (msg);
+        if (reply_serial == NAMES_SERIAL_LIST_NAMES) {
+            if (header->type == DBUS_MESSAGE_TYPE_METHOD_RETURN) {
+                load_names (msg);
+            } else {
+                g_message("ListNames failed, names are not cached\n");
+            }
+            return TRUE;
+        }
+
+        name = g_hash_table_lookup (owner_queries, GUINT_TO_POINTER (reply_serial));
+        if (name != NULL) {
+            if (header->type == DBUS_MESSAGE_TYPE_METHOD_RETURN &&
+                g_hash_table_contains (owners, name) &&
+                dbus_message_get_args (msg, NULL,
+                                       DBUS_TYPE_STRING, &new_owner,
+                                       DBUS_TYPE_INVALID)) {
+                g_hash_table_replace (owners, g_strdup (name), g_strdup (new_owner));
+            }
+            g_hash_table_remove (owner_queries, GUINT_TO_POINTER (reply_serial));
+        }
+        return FALSE;
+
+    case DBUS_MESSAGE_TYPE_SIGNAL:
+        if (header->interface != quark_dbus_interface ||
+            header->member    != quark_name_owner_changed ||
+            !dbus_message_get_args (msg, NULL,
+                                    DBUS_TYPE_STRING, &name,
+                                    DBUS_TYPE_STRING, &old_owner,
+                                    DBUS_TYPE_STRING, &new_owner,
+                                    DBUS_TYPE_INVALID)) {
+            return FALSE;
+        }
+
+        if (new_owner[0] == '\0') {
+            g_hash_table_remove (owners, name);
+        } else {
+            g_hash_table_replace (owners, g_strdup (name), g_strdup (new_owner));
+        }
+
+        /* The signal is only for the cache, unless the client asked for it */
+        args[0] = name;
+        args[1] = old_owner;
+        args[2] = new_owner;
+        return !client_matches (DBUS_SERVICE_DBUS, DBUS_INTERFACE_DBUS,
+                                "NameOwnerChanged", DBUS_PATH_DBUS, args);
+
+    default:
+        return FALSE;
+    }
+}
@@ -0,0 +1,81 @@
+/*
+ * Copyright (C) 2013-2016, Pelagicore AB   <joakim.gross@pelagicore.com>
+ *
+ * This library is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU Lesser General Public
+ * License as published by the Free Software Foundation; either
+ * version 2.1 of the License, or (at your option) any later version.
+ *
+ * This library is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ * Lesser General Public License for more details.
+ *
+ * You should have received a copy of the GNU Lesser General Public
+ * License along with this library; if not, write to the
+ * Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+ * Boston, MA  02110-1301, USA.
+ *
+ * For further information see LICENSE
+ */
+
+#ifndef DBUS_PROXY_NAMES_H
+#define DBUS_PROXY_NAMES_H
+
+#include "proxy.h"
+
+/*! \brief Start following the owners of names on the bus
+ *
+ * Subscribes to NameOwnerChanged and asks the bus for the names it has.
+ * Queries are answered from the cache once the names have arrived.
+ *
+ * \param bus The connection to the bus
+ */
+void names_cache_start (DBusConnection *bus);
+
+/*! \brief Answer a query about names from the cache
+ *
+ * Handles GetNameOwner, NameHasOwner and ListNames sent to the bus by the
+ * client. Only call this for messages the rules allow.
+ *
+ * \param client The connection to the client, the reply is sent on it
+ * \param msg    The message from the client
+ * \param header The header fields of the message
+ * \return TRUE if the message was answered, FALSE if it must be forwarded
+ */
+gboolean names_cache_reply (DBusConnection      *client,
+                            DBusMessage         *msg,
+                            const MessageHeader *header);
+
+/*! \brief Follow the match rules of the client
+ *
+ * The cache subscribes to all NameOwnerChanged signals on behalf of the
+ * proxy. The match rules the client adds and removes decide which of them
+ * it gets. Call this for each AddMatch and RemoveMatch forwarded to the bus.
+ *
+ * \param msg    The message from the client
+ * \param header The header fields of the message
+ */
+void names_cache_track_match (DBusMessage *msg, const MessageHeader *header);
+
+/*! \brief Test if a match rule of the client covers a signal
+ *
+ * Lets other caches that subscribe to signals on behalf of the proxy decide
+ * if the client gets them too.
+ *
+ * \param msg    The signal from the bus
+ * \param header The header fields of the signal
+ * \return TRUE if the client added a match rule for the signal
+ */
+gboolean names_cache_client_matches (DBusMessage *msg, const MessageHeader *header);
+
+/*! \brief Update the cache from a message from the bus
+ *
+ * \param msg    The message from the bus
+ * \param header The header fields of the message
+ * \return TRUE if the message was only for the cache and must not be
+ *         forwarded to the client
+ */
+gboolean names_cache_filter (DBusMessage *msg, const MessageHeader *header);
+
+#endif /* DBUS_PROXY_NAMES_H */
@@ -0,0 +1,101 @@
+/*
+ * Copyright (C) 2013-2016, Pelagicore AB   <joakim.gross@pelagicore.com>
+ *
+ * This library is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU Lesser General Public
+ * License as published by the Free Software Foundation; either
+ * version 2.1 of the License, or (at your option) any later version.
+ *
+ * This library is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ * Lesser General Public License for more details.
+ *
+ * You should have received a copy of the GNU Lesser General Public
+ * License along with this library; if not, write to the
+ * Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+ * Boston, MA  02110-1301, USA.
+ *
+ * For further information see LICENSE
+ */
+
+
+
+#include "output.h"
+
+#include <stdlib.h>
+#include <string.h>
+#include <unistd.h>
+#include <fcntl.h>
+#include <errno.h>
+
+
+/*! The batches flushed at exit */
+static GList *batches = NULL;
+
+
+int output_open (const char *path, const char *what)
+{
+    int fd = open (path, O_WRONLY | O_CREAT | O_APPEND | O_CLOEXEC, 0640);
+
+    if (fd < 0) {
+        g_message("Could not open %s %s: %s\n", what, path, strerror (errno));
+    }
+    return fd;
+}
+
+gboolean output_write (int fd, const void *data, gsize length, const char *what)
+{
+    gsize written = 0;
+
+    while (written < length) {
+        ssize_t res = write (fd, (const guint8 *) data + written, length - written);
+        if (res < 0) {
+            if (errno == EINTR) {
+                continue;
+            }
+            g_message("Could not write %s: %s\n", what, strerror (errno));
+            return FALSE;
+        }
+        written += res;
+    }
+
+    return TRUE;
+}
+
+static void output_flush_at_exit (void)
+{
+    GList *iter;
+
+    for (iter = batches; iter != NULL; iter = iter->next) {
+        OutputBatch *batch = iter->data;
+        batch->flush ();
+    }
+}
+
+void output_batch_register (OutputBatch *batch)
+{
+    if (batches == NULL) {
+        atexit (output_flush_at_exit);
+    }
+    batches = g_list_prepend (batches, batch);
+}
+
+static gboolean output_batch_timeout (gpointer data)
+{
+    OutputBatch *batch = data;
+
+    /* The buffer is empty after a flush, the next record schedules the
+       next one */
+    batch->source = 0;
+    batch->flush ();
+    return FALSE;
+}
+
+void output_batch_schedule (OutputBatch *batch)
+{
+    if (batch->source == 0) {
+        batch->source = g_timeout_add (batch->interval_ms,
+                                       output_batch_timeout, batch);
+    }
+}
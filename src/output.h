@@ -0,0 +1,81 @@
+/*
+ * Copyright (C) 2013-2016, Pelagicore AB   <joakim.gross@pelagicore.com>
+ *
+ * This library is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU Lesser General Public
+ * License as published by the Free Software Foundation; either
+ * version 2.1 of the License, or (at your option) any later version.
+ *
+ * This library is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ * Lesser General Public License for more details.
+ *
+ * You should have received a copy of the GNU Lesser General Public
+ * License along with this library; if not, write to the
+ * Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+ * Boston, MA  02110-1301, USA.
+ *
+ * For further information see LICENSE
+ */
+
+
+
+#ifndef DBUS_PROXY_OUTPUT_H
+#define DBUS_PROXY_OUTPUT_H
+
+#include <glib.h>
+
+/*! Records buffered in memory and written to a file in batches.
+ *
+ * The batch is flushed a while after its first record rather than on a
+ * fixed tick, so a process with nothing buffered is not woken up. All proxy
+ * processes are single threaded and batches are only used from the main
+ * loop, so no locking is needed.
+ */
+typedef struct {
+    /*! Writes all buffered records */
+    void  (*flush) (void);
+
+    /*! Time from the first buffered record to the flush */
+    guint   interval_ms;
+
+    /*! The pending flush, 0 when none is pending */
+    guint   source;
+} OutputBatch;
+
+/*! \brief Open a file for appending
+ *
+ * Files opened before proxy processes are forked are shared by them. With
+ * O_APPEND each write of a batch lands at the end of the file, so the
+ * batches of different processes do not interleave.
+ *
+ * \param path The file to open
+ * \param what What the file is, for the message if it cannot be opened
+ * \return The file descriptor, or -1 if the file could not be opened
+ */
+int output_open (const char *path, const char *what);
+
+/*! \brief Write all of a buffer, retrying interrupted writes
+ *
+ * \param fd     The file to write to
+ * \param data   The bytes to write
+ * \param length The number of bytes
+ * \param what   What the file is, for the message if the write fails
+ * \return FALSE if the write failed
+ */
+gboolean output_write (int fd, const void *data, gsize length, const char *what);
+
+/*! \brief Flush a batch when the process exits
+ *
+ * Forked proxy processes inherit the exit handler.
+ */
+void output_batch_register (OutputBatch *batch);
+
+/*! \brief Flush a batch after its interval, unless a flush is pending
+ *
+ * Call this for each record added to the batch.
+ */
+void output_batch_schedule (OutputBatch *batch);
+
+#endif /* DBUS_PROXY_OUTPUT_H */
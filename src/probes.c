@@ -0,0 +1,35 @@
+/*
+ * Copyright (C) 2013-2016, Pelagicore AB   <joakim.gross@pelagicore.com>
+ *
+ * This library is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU Lesser General Public
+ * License as published by the Free Software Foundation; either
+ * version 2.1 of the License, or (at your option) any later version.
+ *
+ * This library is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ * Lesser General Public License for more details.
+ *
+ * You should have received a copy of the GNU Lesser General Public
+ * License along with this library; if not, write to the
+ * Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+ * Boston, MA  02110-1301, USA.
+ *
+ * For further information see LICENSE
+ */
+
+
+#include <glib.h>
+
+#include "probes.h"
+
+#ifdef HAVE_SYS_SDT_H
+
+/* The semaphores are in the .probes section, where tracers find them */
+#define PROBE_DEFINE(name) \
+    volatile unsigned short PROBE_SEMAPHORE (name) __attribute__ ((section (".probes")));
+PROBES (PROBE_DEFINE)
+#undef PROBE_DEFINE
+
+#endif /* HAVE_SYS_SDT_H */
@@ -0,0 +1,91 @@
+/*
+ * Copyright (C) 2013-2016, Pelagicore AB   <joakim.gross@pelagicore.com>
+ *
+ * This library is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU Lesser General Public
+ * License as published by the Free Software Foundation; either
+ * version 2.1 of the License, or (at your option) any later version.
+ *
+ * This library is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ * Lesser General Public License for more details.
+ *
+ * You should have received a copy of the GNU Lesser General Public
+ * License along with this library; if not, write to the
+ * Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+ * Boston, MA  02110-1301, USA.
+ *
+ * For further information see LICENSE
+ */
+
+#ifndef DBUS_PROXY_PROBES_H
+#define DBUS_PROXY_PROBES_H
+
+/*
+ * Static tracepoints (USDT) of provider "dbus_proxy", for bpftrace, perf and
+ * SystemTap. See tracing/ for scripts that use them.
+ *
+ * A probe is a nop in the code until a tracer attaches to it. Each probe has
+ * a semaphore, which the tracer increments while it is attached, and the
+ * arguments of a probe are only evaluated when it is set. A build without
+ * sys/sdt.h has no probes.
+ *
+ *   message__received   (direction, type, interface, path, member)
+ *   rule__evaluated     (rule index or -1, rules scanned, rules)
+ *   message__accepted   (direction, interface, member, rule index)
+ *   message__rejected   (direction, interface, member, rule index or -1,
+ *                        which is not -1 when a rate limit rejected it)
+ *   message__forwarded  (direction, interface, member)
+ *   message__coalesced  (interface, member), a held signal was replaced or
+ *                        merged, see src/delivery.h
+ *   connection__accepted (pid of the child, bus)
+ *   config__swapped     (section, rules)
+ */
+
+#ifdef HAVE_SYS_SDT_H
+
+#define _SDT_HAS_SEMAPHORES 1
+#include <sys/sdt.h>
+
+#define PROBES(X)                \
+    X (message__received)        \
+    X (rule__evaluated)          \
+    X (message__accepted)        \
+    X (message__rejected)        \
+    X (message__forwarded)       \
+    X (message__coalesced)       \
+    X (connection__accepted)     \
+    X (config__swapped)
+
+/*! The semaphore of a probe, the name sys/sdt.h expects */
+#define PROBE_SEMAPHORE(name) dbus_proxy_##name##_semaphore
+
+#define PROBE_DECLARE(name) extern volatile unsigned short PROBE_SEMAPHORE (name);
+PROBES (PROBE_DECLARE)
+#undef PROBE_DECLARE
+
+/*! \brief Test if a tracer is attached to a probe */
+#define PROBE_ENABLED(name) G_UNLIKELY (PROBE_SEMAPHORE (name) != 0)
+
+#define PROBE2(name, a, b) \
+    do { if (PROBE_ENABLED (name)) { DTRACE_PROBE2 (dbus_proxy, name, a, b); } } while (0)
+#define PROBE3(name, a, b, c) \
+    do { if (PROBE_ENABLED (name)) { DTRACE_PROBE3 (dbus_proxy, name, a, b, c); } } while (0)
+#define PROBE4(name, a, b, c, d) \
+    do { if (PROBE_ENABLED (name)) { DTRACE_PROBE4 (dbus_proxy, name, a, b, c, d); } } while (0)
+#define PROBE5(name, a, b, c, d, e) \
+    do { if (PROBE_ENABLED (name)) { DTRACE_PROBE5 (dbus_proxy, name, a, b, c, d, e); } } while (0)
+
+#else
+
+#define PROBE_ENABLED(name) FALSE
+
+#define PROBE2(name, a, b)          do { } while (0)
+#define PROBE3(name, a, b, c)       do { } while (0)
+#define PROBE4(name, a, b, c, d)    do { } while (0)
+#define PROBE5(name, a, b, c, d, e) do { } while (0)
+
+#endif /* HAVE_SYS_SDT_H */
+
+#endif /* DBUS_PROXY_PROBES_H */
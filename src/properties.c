@@ -0,0 +1,463 @@
+/*
+ * Copyright (C) 2013-2016, Pelagicore AB   <joakim.gross@pelagicore.com>
+ *
+ * This library is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU Lesser General Public
+ * License as published by the Free Software Foundation; either
+ * version 2.1 of the License, or (at your option) any later version.
+ *
+ * This library is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ * Lesser General Public License for more details.
+ *
+ * You should have received a copy of the GNU Lesser General Public
+ * License along with this library; if not, write to the
+ * Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+ * Boston, MA  02110-1301, USA.
+ *
+ * For further information see LICENSE
+ */
+
+
+#include "properties.h"
+#include "names.h"
+
+#include <string.h>
+
+
+/*! Serial of the match rules the cache adds and removes itself, taken from
+    the top of the range like the serials of the name cache. No reply is
+    expected. */
+#define PROPERTIES_SERIAL_MATCH 0xfffffff2
+
+/*! Calls waiting for their reply before they are all forgotten. A reply to
+    a forgotten call is only not cached. */
+#define PROPERTIES_MAX_QUERIES 256
+
+/*! The signals the cache follows for an object it has replies of */
+#define PROPERTIES_CHANGED_RULE \
+    "type='signal',sender='%s',interface='" DBUS_INTERFACE_PROPERTIES "'," \
+    "member='PropertiesChanged',path='%s'"
+
+
+/*! A cached reply to a Get or GetAll call */
+typedef struct {
+    gchar       *key;
+    gchar       *destination;
+    gchar       *owner;
+    gchar       *path;
+    gchar       *interface;
+    DBusMessage *reply;
+    gsize        size;
+    gint64       expires;
+} PropertiesEntry;
+
+/*! A Get or GetAll call forwarded to the bus */
+typedef struct {
+    gchar  *key;
+    gchar  *destination;
+    gchar  *path;
+    gchar  *interface;
+    gint64  ttl;
+} PropertiesQuery;
+
+static gsize       max_size   = PROPERTIES_CACHE_DEFAULT_SIZE;
+static gsize       total_size = 0;
+
+/*! Cached replies, most recently used first */
+static GQueue      lru        = G_QUEUE_INIT;
+
+/*! Key -> link of the entry in lru */
+static GHashTable *entries    = NULL;
+
+/*! Serial -> PropertiesQuery of calls forwarded to the bus */
+static GHashTable *queries    = NULL;
+
+/*! "destination path" -> number of entries and queries of the object, while
+    the cache is subscribed to its PropertiesChanged signals */
+static GHashTable *subscriptions = NULL;
+
+/*! The connection to the bus, match rules are added on it */
+static DBusConnection *bus    = NULL;
+
+static GQuark      quark_properties_interface;
+static GQuark      quark_dbus_interface;
+static GQuark      quark_get;
+static GQuark      quark_get_all;
+static GQuark      quark_set;
+static GQuark      quark_properties_changed;
+static GQuark      quark_name_owner_changed;
+
+
+static void properties_entry_free (PropertiesEntry *entry)
+{
+    g_free (entry->key);
+    g_free (entry->destination);
+    g_free (entry->owner);
+    g_free (entry->path);
+    g_free (entry->interface);
+    dbus_message_unref (entry->reply);
+    g_free (entry);
+}
+
+void properties_cache_configure (gsize max_bytes)
+{
+    max_size = max_bytes;
+}
+
+/*! \brief Add or remove the match rule for the signals of an object */
+static void send_match (const char *member, const char *destination, const char *path)
+{
+    DBusMessage *msg;
+    gchar       *rule;
+
+    /* Bus names and object paths cannot contain apostrophes. The bus
+       matches a well-known name against the signals of its owner. */
+    rule = g_strdup_printf (PROPERTIES_CHANGED_RULE, destination, path);
+    msg  = dbus_message_new_method_call (DBUS_SERVICE_DBUS,
+                                         DBUS_PATH_DBUS,
+                                         DBUS_INTERFACE_DBUS,
+                                         member);
+    dbus_message_append_args (msg,
+                              DBUS_TYPE_STRING, &rule,
+                              DBUS_TYPE_INVALID);
+    dbus_message_set_no_reply (msg, TRUE);
+    dbus_message_set_serial (msg, PROPERTIES_SERIAL_MATCH);
+
+    dbus_connection_send (bus, msg, NULL);
+    dbus_message_unref (msg);
+    g_free (rule);
+}
+
+/*! \brief Follow the PropertiesChanged signals of an object while it has
+ *         entries or queries
+ *
+ * The match rule is added before the first query is forwarded, so the bus
+ * has it before the service replies and no change after the reply is
+ * missed.
+ *
+ * \param delta 1 for an entry or query that is added, -1 for one that is
+ *              removed
+ */
+static void subscribe (const char *destination, const char *path, gint delta)
+{
+    gchar *key   = g_strjoin (" ", destination, path, NULL);
+    guint  count = GPOINTER_TO_UINT (g_hash_table_lookup (subscriptions, key));
+
+    if (count == 0) {
+        send_match ("AddMatch", destination, path);
+    }
+
+    count += delta;
+    if (count == 0) {
+        send_match ("RemoveMatch", destination, path);
+        g_hash_table_remove (subscriptions, key);
+        g_free (key);
+    } else {
+        g_hash_table_replace (subscriptions, key, GUINT_TO_POINTER (count));
+    }
+}
+
+static void properties_query_free (PropertiesQuery *query)
+{
+    subscribe (query->destination, query->path, -1);
+    g_free (query->key);
+    g_free (query->destination);
+    g_free (query->path);
+    g_free (query->interface);
+    g_free (query);
+}
+
+void properties_cache_start (DBusConnection *connection)
+{
+    if (max_size == 0) {
+        return;
+    }
+
+    bus = connection;
+
+    quark_properties_interface = g_quark_from_static_string (DBUS_INTERFACE_PROPERTIES);
+    quark_dbus_interface       = g_quark_from_static_string (DBUS_INTERFACE_DBUS);
+    quark_get                  = g_quark_from_static_string ("Get");
+    quark_get_all              = g_quark_from_static_string ("GetAll");
+    quark_set                  = g_quark_from_static_string ("Set");
+    quark_properties_changed   = g_quark_from_static_string ("PropertiesChanged");
+    quark_name_owner_changed   = g_quark_from_static_string ("NameOwnerChanged");
+
+    entries = g_hash_table_new (g_str_hash, g_str_equal);
+    queries = g_hash_table_new_full (g_direct_hash, g_direct_equal, NULL,
+                                     (GDestroyNotify) properties_query_free);
+    subscriptions = g_hash_table_new_full (g_str_hash, g_str_equal, g_free, NULL);
+}
+
+static void remove_link (GList *link)
+{
+    PropertiesEntry *entry = link->data;
+
+    subscribe (entry->destination, entry->path, -1);
+    g_hash_table_remove (entries, entry->key);
+    g_queue_delete_link (&lru, link);
+    total_size -= entry->size;
+    properties_entry_free (entry);
+}
+
+/*! \brief Drop the entries of an object, or all entries of a destination
+ *
+ * \param destination Drop entries sent to this name, or NULL
+ * \param owner       Drop entries from this owner, or NULL
+ * \param path        Only drop entries of this path, or NULL for all
+ * \param interface   Only drop entries of this interface, or NULL for all
+ */
+static void drop_entries (const char *destination,
+                          const char *owner,
+                          const char *path,
+                          const char *interface)
+{
+    GList *link = lru.head;
+    GList *next;
+
+    while (link != NULL) {
+        PropertiesEntry *entry = link->data;
+        next = link->next;
+
+        if (((destination != NULL && strcmp (entry->destination, destination) == 0) ||
+             (owner       != NULL && strcmp (entry->owner, owner) == 0))              &&
+            (path      == NULL || strcmp (entry->path, path) == 0)                    &&
+            (interface == NULL || strcmp (entry->interface, interface) == 0))
+        {
+            remove_link (link);
+        }
+
+        link = next;
+    }
+}
+
+/*! \brief Test if the cache follows the PropertiesChanged signals of an
+ *         object
+ *
+ * The cache does when it has entries of the owner, or queries sent to its
+ * unique name. A query sent to a well-known name whose reply has not arrived
+ * is not known by the owner, and the signals are passed on.
+ */
+static gboolean is_subscribed (const char *owner, const char *path)
+{
+    PropertiesEntry *entry;
+    GList           *link;
+    gchar           *key;
+    gboolean         subscribed;
+
+    key        = g_strjoin (" ", owner, path, NULL);
+    subscribed = g_hash_table_contains (subscriptions, key);
+    g_free (key);
+
+    for (link = lru.head; link != NULL && !subscribed; link = link->next) {
+        entry      = link->data;
+        subscribed = strcmp (entry->owner, owner) == 0 &&
+                     strcmp (entry->path, path) == 0;
+    }
+
+    return subscribed;
+}
+
+gboolean properties_cache_reply (DBusConnection      *client,
+                                 DBusMessage         *msg,
+                                 const MessageHeader *header,
+                                 gint64               ttl)
+{
+    PropertiesEntry *entry;
+    PropertiesQuery *query;
+    DBusMessage     *reply;
+    GList           *link;
+    const char      *interface;
+    const char      *property = "";
+    gchar           *key;
+    gboolean         is_get;
+
+    if (max_size == 0                                     ||
+        header->type        != DBUS_MESSAGE_TYPE_METHOD_CALL ||
+        header->destination == NULL                        ||
+        header->path        == NULL)
+    {
+        return FALSE;
+    }
+
+    if (entries == NULL || header->interface != quark_properties_interface) {
+        return FALSE;
+    }
+
+    /* Writes go to the service, and whatever was cached may have changed */
+    if (header->member == quark_set) {
+        if (dbus_message_get_args (msg, NULL,
+                                   DBUS_TYPE_STRING, &interface,
+                                   DBUS_TYPE_INVALID)) {
+            drop_entries (header->destination, NULL, header->path, interface);
+        }
+        return FALSE;
+    }
+
+    is_get = header->member == quark_get;
+    if (ttl <= 0 || (!is_get && header->member != quark_get_all)) {
+        return FALSE;
+    }
+
+    if (is_get ? !dbus_message_get_args (msg, NULL,
+                                         DBUS_TYPE_STRING, &interface,
+                                         DBUS_TYPE_STRING, &property,
+                                         DBUS_TYPE_INVALID)
+               : !dbus_message_get_args (msg, NULL,
+                                         DBUS_TYPE_STRING, &interface,
+                                         DBUS_TYPE_INVALID)) {
+        return FALSE;
+    }
+
+    /* Names, paths, interfaces and properties cannot contain spaces. GetAll
+       has an empty property. */
+    key  = g_strjoin (" ", header->destination, header->path, interface, property, NULL);
+    link = g_hash_table_lookup (entries, key);
+
+    if (link != NULL) {
+        entry = link->data;
+
+        if (entry->expires > g_get_monotonic_time ()) {
+            g_free (key);
+
+            g_queue_unlink (&lru, link);
+            g_queue_push_head_link (&lru, link);
+
+            if (!dbus_message_get_no_reply (msg)) {
+                reply = dbus_message_copy (entry->reply);
+                dbus_message_set_reply_serial (reply, dbus_message_get_serial (msg));
+                dbus_connection_send (client, reply, NULL);
+                dbus_message_unref (reply);
+            }
+            return TRUE;
+        }
+
+        remove_link (link);
+    }
+
+    /* Nothing comes back to cache */
+    if (dbus_message_get_no_reply (msg)) {
+        g_free (key);
+        return FALSE;
+    }
+
+    if (g_hash_table_size (queries) >= PROPERTIES_MAX_QUERIES) {
+        g_hash_table_remove_all (queries);
+    }
+
+    query = g_new0 (PropertiesQuery, 1);
+    query->key         = key;
+    query->destination = g_strdup (header->destination);
+    query->path        = g_strdup (header->path);
+    query->interface   = g_strdup (interface);
+    query->ttl         = ttl;
+    subscribe (query->destination, query->path, 1);
+    g_hash_table_replace (queries,
+                          GUINT_TO_POINTER (dbus_message_get_serial (msg)),
+                          query);
+    return FALSE;
+}
+
+/*! \brief Cache the reply to a forwarded Get or GetAll call */
+static void cache_reply (DBusMessage *msg, PropertiesQuery *query)
+{
+    PropertiesEntry *entry;
+    GList           *link;
+    char            *marshalled;
+    int              size;
+
+    if (dbus_message_get_sender (msg) == NULL ||
+        !dbus_message_marshal (msg, &marshalled, &size)) {
+        return;
+    }
+    dbus_free (marshalled);
+
+    if ((gsize) size > max_size) {
+        return;
+    }
+
+    link = g_hash_table_lookup (entries, query->key);
+    if (link != NULL) {
+        remove_link (link);
+    }
+
+    entry = g_new0 (PropertiesEntry, 1);
+    entry->key         = g_strdup (query->key);
+    entry->destination = g_strdup (query->destination);
+    entry->owner       = g_strdup (dbus_message_get_sender (msg));
+    entry->path        = g_strdup (query->path);
+    entry->interface   = g_strdup (query->interface);
+    entry->reply       = dbus_message_ref (msg);
+    entry->size        = size;
+    entry->expires     = g_get_monotonic_time () + query->ttl;
+
+    g_queue_push_head (&lru, entry);
+    g_hash_table_insert (entries, entry->key, lru.head);
+    total_size += entry->size;
+    subscribe (entry->destination, entry->path, 1);
+
+    /* Evict the least recently used replies */
+    while (total_size > max_size) {
+        remove_link (lru.tail);
+    }
+}
+
+gboolean properties_cache_filter (DBusMessage *msg, const MessageHeader *header)
+{
+    PropertiesQuery *query;
+    gpointer         reply_serial;
+    const char      *name;
+    const char      *old_owner;
+    const char      *new_owner;
+    gboolean         subscribed;
+
+    if (entries == NULL) {
+        return FALSE;
+    }
+
+    switch (header->type) {
+    case DBUS_MESSAGE_TYPE_METHOD_RETURN:
+    case DBUS_MESSAGE_TYPE_ERROR:
+        reply_serial = GUINT_TO_POINTER (dbus_message_get_reply_serial (msg));
+        query = g_hash_table_lookup (queries, reply_serial);
+        if (query != NULL) {
+            if (header->type == DBUS_MESSAGE_TYPE_METHOD_RETURN) {
+                cache_reply (msg, query);
+            }
+            g_hash_table_remove (queries, reply_serial);
+        }
+        break;
+
+    case DBUS_MESSAGE_TYPE_SIGNAL:
+        if (header->interface == quark_properties_interface &&
+            header->member    == quark_properties_changed   &&
+            header->sender    != NULL                        &&
+            header->path      != NULL                        &&
+            dbus_message_get_args (msg, NULL,
+                                   DBUS_TYPE_STRING, &name,
+                                   DBUS_TYPE_INVALID)) {
+            subscribed = is_subscribed (header->sender, header->path);
+            drop_entries (NULL, header->sender, header->path, name);
+
+            /* A signal the cache subscribed to is only for the cache, unless
+               the client asked for it */
+            return subscribed && !names_cache_client_matches (msg, header);
+        } else if (header->interface == quark_dbus_interface     &&
+                   header->member    == quark_name_owner_changed &&
+                   dbus_message_get_args (msg, NULL,
+                                          DBUS_TYPE_STRING, &name,
+                                          DBUS_TYPE_STRING, &old_owner,
+                                          DBUS_TYPE_STRING, &new_owner,
+                                          DBUS_TYPE_INVALID)) {
+            drop_entries (name, old_owner, NULL, NULL);
+        }
+        break;
+
+    default:
+        break;
+    }
+
+    return FALSE;
+}
@@ -0,0 +1,77 @@
+/*
+ * Copyright (C) 2013-2016, Pelagicore AB   <joakim.gross@pelagicore.com>
+ *
+ * This library is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU Lesser General Public
+ * License as published by the Free Software Foundation; either
+ * version 2.1 of the License, or (at your option) any later version.
+ *
+ * This library is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ * Lesser General Public License for more details.
+ *
+ * You should have received a copy of the GNU Lesser General Public
+ * License along with this library; if not, write to the
+ * Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+ * Boston, MA  02110-1301, USA.
+ *
+ * For further information see LICENSE
+ */
+
+#ifndef DBUS_PROXY_PROPERTIES_H
+#define DBUS_PROXY_PROPERTIES_H
+
+#include "proxy.h"
+
+/*! Default size of the cache of property replies in bytes */
+#define PROPERTIES_CACHE_DEFAULT_SIZE (1024 * 1024)
+
+/*! \brief Set the size of the cache of property replies
+ *
+ * \param max_bytes Size of the cached replies, least recently used replies
+ *                  are evicted beyond it. 0 disables the cache.
+ */
+void properties_cache_configure (gsize max_bytes);
+
+/*! \brief Start caching property replies, unless the cache is disabled
+ *
+ * \param bus The connection to the bus. While the cache has replies of an
+ *            object it follows the PropertiesChanged signals of the object
+ *            with match rules of its own on it.
+ */
+void properties_cache_start (DBusConnection *bus);
+
+/*! \brief Answer a Get or GetAll call from the cache
+ *
+ * Only call this for messages the rules allow. Calls that are not answered
+ * are remembered so their replies can be cached, and Set calls drop the
+ * cached replies of the interface.
+ *
+ * \param client The connection to the client, the reply is sent on it
+ * \param msg    The message from the client
+ * \param header The header fields of the message
+ * \param ttl    How long the rule that allowed the message caches replies,
+ *               in microseconds, 0 if it does not
+ * \return TRUE if the message was answered, FALSE if it must be forwarded
+ */
+gboolean properties_cache_reply (DBusConnection      *client,
+                                 DBusMessage         *msg,
+                                 const MessageHeader *header,
+                                 gint64               ttl);
+
+/*! \brief Update the cache from a message from the bus
+ *
+ * Caches replies to forwarded Get and GetAll calls, and drops cached
+ * replies on PropertiesChanged and when the owner of a name changes. The
+ * cache subscribes to the PropertiesChanged signals of the objects it has
+ * replies of, so they are dropped whether the client subscribed or not.
+ *
+ * \param msg    The message from the bus
+ * \param header The header fields of the message
+ * \return TRUE if the message is a signal the cache subscribed to, the
+ *         client did not and that must not be forwarded to it
+ */
+gboolean properties_cache_filter (DBusMessage *msg, const MessageHeader *header);
+
+#endif /* DBUS_PROXY_PROPERTIES_H */
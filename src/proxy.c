@@ -23,6 +23,18 @@
 
 
 #include "proxy.h"
+#include "rules.h"
+#include "audit.h"
+#include "capture.h"
+#include "names.h"
+#include "introspect.h"
+#include "properties.h"
+#include "check.h"
+#include "children.h"
+#include "delivery.h"
+#include "latency.h"
+#include "output.h"
+#include "probes.h"
 
 #include <stdio.h>
 #include <stdlib.h>
@@ -41,38 +53,310 @@
 #include <dbus/dbus-glib-lowlevel.h>
 
 
-/*! the connection to dbus_srv from a local client, or NULL */
+/*! the connection to the server socket from a local client, or NULL */
 DBusConnection  *dbus_conn    = NULL;
 
 /*! the connection to the real server */
 DBusGConnection *master_conn  = NULL;
 
-DBusServer *dbus_srv = NULL;
-
-/*! JSON filter rules read from file */
-json_t          *json_filters = NULL;
-
-/*! D-Bus address to listen on */
-gchar           *address      = NULL;
+/*! The rules of one section of the config, "dbus-gateway-config-<bus>" */
+typedef struct {
+    gchar         *name;
+    RuleSet       *rules;
+    RuleVerdict    outgoing_verdict;
+    RuleVerdict    incoming_verdict;
+
+    /*! The limit of all outgoing messages of a client, given in
+        "dbus-gateway-rate-limit-<bus>", or NULL */
+    gchar         *limit_name;
+    RateLimitSpec *connection_limit;
+} ConfigSection;
+
+/*! A socket local clients connect to, and the bus it is a proxy for */
+struct _ProxyListener {
+    gchar         *address;
+    DBusBusType    bus;
+    ConfigSection *section;
+    DBusServer    *server;
+};
+
+/*! The listeners of this process, one per address given on the command line */
+GList           *listeners    = NULL;
+
+/*! The config sections used by the listeners, one per bus type */
+GList           *sections     = NULL;
+
+/*! The filter rules compiled for evaluation, in a child the rules of the
+    listener it was forked from */
+RuleSet         *rules        = NULL;
+
+/*! What the rules decide for all messages per direction */
+RuleVerdict      outgoing_verdict = RULE_VERDICT_DENY_ALL;
+RuleVerdict      incoming_verdict = RULE_VERDICT_DENY_ALL;
 
 /*! Enable this for debus output */
 gboolean         verbose      = FALSE;
 
-/*! Bus type to create */
+/*! Bus type to create, in a child the bus of the listener it was forked
+    from */
 DBusBusType      bus          = DBUS_BUS_SESSION;
 
 /*! List of connections that are to be ignored */
 GList           *eavesdropping_conns = NULL;
 
+/*! In a child, the limiter of each rule and of all outgoing messages */
+RateLimiter     *rule_limiters = NULL;
+RateLimiter      connection_limiter;
+
+/*! Source id of the watch on stdin for configs, 0 when not watching */
+guint            stdin_watch_id = 0;
+
+/*! Read configs from stdin as NUL terminated frames, and acknowledge each
+    on stdout */
+gboolean         framed_config = FALSE;
+
+/*! The config frame read so far, and the number of frames read */
+static GString  *config_frame = NULL;
+static guint     config_frame_count = 0;
+
+/*! Seconds between reorders of the rules of a child by their hits, 0 to
+    keep the order of the config */
+static guint     reorder_interval = 0;
+
+/*! File the active order of the rules is appended to after each reorder,
+    -1 when it is not written */
+static int       rule_order_fd = -1;
+
+/*! Set once the Hello from the local client has been answered */
+gboolean         hello_answered = FALSE;
+
+/*! Well-known names, interned once at startup */
+static GQuark    quark_outgoing;
+static GQuark    quark_incoming;
+static GQuark    quark_dbus_interface;
+static GQuark    quark_local_interface;
+static GQuark    quark_hello;
+static GQuark    quark_disconnected;
+static GQuark    quark_name_acquired;
+static GQuark    quark_add_match;
+
+#define DBUS_NAME_DBUS "org.freedesktop.DBus"
+#define DBUS_PATH_DBUS "/org/freedesktop/DBus"
+
+/*! Bytes read from stdin at a time when configs are framed */
+#define CONFIG_READ_SIZE 65536
+
+/*! Largest config frame that is parsed */
+#define CONFIG_FRAME_MAX (64 * 1024 * 1024)
+
+
+static void intern_well_known_names() {
+    quark_outgoing        = g_quark_from_static_string ("outgoing");
+    quark_incoming        = g_quark_from_static_string ("incoming");
+    quark_dbus_interface  = g_quark_from_static_string (DBUS_NAME_DBUS);
+    quark_local_interface = g_quark_from_static_string ("org.freedesktop.DBus.Local");
+    quark_hello           = g_quark_from_static_string ("Hello");
+    quark_disconnected    = g_quark_from_static_string ("Disconnected");
+    quark_name_acquired   = g_quark_from_static_string ("NameAcquired");
+    quark_add_match       = g_quark_from_static_string ("AddMatch");
+}
+
+/*! \brief Read the header fields of a message
+ *
+ * \param header The header struct to fill in
+ * \param msg    The message to read from
+ */
+void message_header_read (MessageHeader *header, DBusMessage *msg)
+{
+    header->type           = dbus_message_get_type (msg);
+    header->interface_name = dbus_message_get_interface (msg);
+    header->member_name    = dbus_message_get_member (msg);
+    header->interface      = g_quark_try_string (header->interface_name);
+    header->member         = g_quark_try_string (header->member_name);
+    header->path           = dbus_message_get_path (msg);
+    header->destination    = dbus_message_get_destination (msg);
+    header->sender         = dbus_message_get_sender (msg);
+}
+
+/*! \brief Decide if a message is allowed by the compiled rules
+ *
+ * When the rules allow or deny everything in the direction of the message,
+ * the rules are not evaluated at all.
+ *
+ * \param direction  Direction of the message, quark_outgoing or quark_incoming
+ * \param header     The header fields of the message
+ * \param rule_index Set to the index of the matching rule, or -1 if there is
+ *                   none or the rules were not evaluated
+ */
+static gboolean is_message_allowed (GQuark               direction,
+                                    const MessageHeader *header,
+                                    gint                *rule_index)
+{
+    RuleVerdict verdict;
+
+    *rule_index = -1;
+    verdict = direction == quark_outgoing ? outgoing_verdict : incoming_verdict;
+
+    switch (verdict) {
+    case RULE_VERDICT_ALLOW_ALL:
+        /* No rule matches a missing header field */
+        return header->interface_name != NULL &&
+               header->path           != NULL &&
+               header->member_name    != NULL;
+    case RULE_VERDICT_DENY_ALL:
+        return FALSE;
+    default:
+        break;
+    }
+
+    return rule_set_is_allowed (rules,
+                                direction,
+                                header->interface,
+                                header->interface_name,
+                                header->path,
+                                header->member,
+                                header->member_name,
+                                rule_index);
+}
+
+
+/*! \brief Get the size of a message on the wire
+ *
+ * libdbus has no accessor for the size, so the message is marshalled. This
+ * is only done for messages charged against a limit of bytes per second.
+ */
+static gsize message_size (DBusMessage *msg)
+{
+    char *marshalled;
+    int   length;
+
+    if (!dbus_message_marshal (msg, &marshalled, &length)) {
+        return 0;
+    }
+
+    dbus_free (marshalled);
+    return length;
+}
+
+/*! \brief Charge an allowed message against the limits that apply to it
+ *
+ * Messages are charged against the limit of the rule that allowed them, and
+ * outgoing messages also against the limit of the connection.
+ *
+ * \param direction  Direction of the message
+ * \param msg        The message
+ * \param rule_index The rule that allowed the message, or -1
+ * \return The limiter the message is over, or NULL if it is within all
+ *         limits
+ */
+static RateLimiter *charge_rate_limits (GQuark       direction,
+                                        DBusMessage *msg,
+                                        gint         rule_index)
+{
+    RateLimiter *limiters[2];
+    guint        n_limiters = 0;
+    gsize        size = 0;
+    guint        i;
+
+    if (rule_limiters != NULL && rule_index >= 0 &&
+        rule_limiters[rule_index].spec != NULL) {
+        limiters[n_limiters++] = &rule_limiters[rule_index];
+    }
+    if (direction == quark_outgoing && connection_limiter.spec != NULL) {
+        limiters[n_limiters++] = &connection_limiter;
+    }
+
+    for (i = 0; i < n_limiters; i++) {
+        if (rate_limit_spec_counts_bytes (limiters[i]->spec)) {
+            size = message_size (msg);
+            break;
+        }
+    }
 
-void handle_sigchld(int sig) {
-    g_message("Received signal SIGCHLD");
-    while (waitpid((pid_t)(-1), 0, WNOHANG) > 0) {
-        g_message("Waiting for child");
-        usleep(30);
+    for (i = 0; i < n_limiters; i++) {
+        if (!rate_limiter_admit (limiters[i], size)) {
+            return limiters[i];
+        }
     }
 
-    g_message("Finished waiting for child");
+    return NULL;
+}
+
+/*! \brief Handle a message that is over a limit
+ *
+ * Method calls that expect a reply get the error of the limit as reply,
+ * unless the limit drops messages. Everything else is dropped.
+ *
+ * \param conn    The connection the message came from
+ * \param msg     The message
+ * \param limiter The limiter the message is over
+ */
+static void throttle_message (DBusConnection    *conn,
+                              DBusMessage       *msg,
+                              const RateLimiter *limiter)
+{
+    DBusMessage *reply;
+
+    if (limiter->spec->action != RATE_LIMIT_ACTION_ERROR ||
+        dbus_message_get_type (msg) != DBUS_MESSAGE_TYPE_METHOD_CALL ||
+        dbus_message_get_no_reply (msg)) {
+        return;
+    }
+
+    reply = dbus_message_new_error (msg,
+                                    g_quark_to_string (limiter->spec->error_name),
+                                    "Rate limit exceeded");
+    if (reply != NULL) {
+        dbus_connection_send (conn, reply, NULL);
+        dbus_message_unref (reply);
+    }
+}
+
+/*! \brief Log how many messages each limit has throttled */
+static void log_rate_limit_counters () {
+    guint i;
+
+    for (i = 0; rule_limiters != NULL && i < rule_set_size (rules); i++) {
+        if (rule_limiters[i].throttled_messages > 0) {
+            g_message("Rule %u throttled %" G_GUINT64_FORMAT " messages, "
+                      "%" G_GUINT64_FORMAT " bytes\n",
+                      i,
+                      rule_limiters[i].throttled_messages,
+                      rule_limiters[i].throttled_bytes);
+        }
+    }
+
+    if (connection_limiter.throttled_messages > 0) {
+        g_message("Connection limit throttled %" G_GUINT64_FORMAT " messages, "
+                  "%" G_GUINT64_FORMAT " bytes\n",
+                  connection_limiter.throttled_messages,
+                  connection_limiter.throttled_bytes);
+    }
+}
+
+/*! \brief Close the connection to the client and exit the child
+ *
+ * Messages already forwarded to the bus or the client are sent first.
+ *
+ * \param status The exit status, see CHILD_EXIT_IDLE and CHILD_EXIT_MEMORY
+ */
+static void disconnect_client (int status) {
+    log_rate_limit_counters ();
+    delivery_log_counters ();
+
+    if (master_conn != NULL) {
+        dbus_connection_flush (dbus_g_connection_get_connection (master_conn));
+    }
+
+    if (dbus_conn != NULL) {
+        delivery_flush ();
+        dbus_connection_flush (dbus_conn);
+        dbus_connection_close (dbus_conn);
+        dbus_connection_unref (dbus_conn);
+        dbus_conn = NULL;
+    }
+
+    exit(status);
 }
 
 
@@ -94,22 +378,26 @@ DBusHandlerResult filter_cb (DBusConnection *conn,
 {
     /* Data arriving from client */
     guint32           serial;
+    MessageHeader     header;
+    gint              rule_index;
+    RateLimiter      *limiter;
     DBusHandlerResult retval = DBUS_HANDLER_RESULT_HANDLED;
 
+    children_touch ();
+    message_header_read (&header, msg);
+    latency_begin (LATENCY_OUTGOING, &header);
+    PROBE5 (message__received, "outgoing", header.type,
+            header.interface_name, header.path, header.member_name);
+    capture_message (quark_outgoing, &header, msg);
+
     /* Handle Hello */
-    if (dbus_message_get_type (msg) ==
-                    DBUS_MESSAGE_TYPE_METHOD_CALL             &&
-                    dbus_message_get_path(msg) != NULL        &&
-                    strcmp (dbus_message_get_path(msg),
-                            "/org/freedesktop/DBus") == 0     &&
-                    dbus_message_get_interface(msg) != NULL   &&
-                    strcmp (dbus_message_get_interface(msg),
-                            "org.freedesktop.DBus")  == 0     &&
-                    dbus_message_get_destination(msg) != NULL &&
-                    strcmp (dbus_message_get_destination(msg),
-                            "org.freedesktop.DBus")  == 0     &&
-                    dbus_message_get_member(msg) != NULL      &&
-                    strcmp (dbus_message_get_member (msg), "Hello") == 0) {
+    if (header.type      == DBUS_MESSAGE_TYPE_METHOD_CALL &&
+        header.member    == quark_hello                   &&
+        header.interface == quark_dbus_interface          &&
+        header.path != NULL                               &&
+        strcmp (header.path, DBUS_PATH_DBUS) == 0         &&
+        header.destination != NULL                        &&
+        strcmp (header.destination, DBUS_NAME_DBUS) == 0) {
 
               DBusMessage *welcome;
         const gchar       *dbus_local_name;
@@ -132,158 +420,79 @@ DBusHandlerResult filter_cb (DBusConnection *conn,
         dbus_connection_send(conn, welcome, &serial);
 
         dbus_message_unref (welcome);
+        hello_answered = TRUE;
         goto out;
     }
 
     /* Handle Disconnected */
-    if (dbus_message_get_type(msg) ==
-                DBUS_MESSAGE_TYPE_SIGNAL                   &&
-                dbus_message_get_interface(msg) != NULL    &&
-                strcmp (dbus_message_get_interface (msg),
-                        "org.freedesktop.DBus.Local") == 0 &&
-                dbus_message_get_member(msg) != NULL       &&
-                strcmp (dbus_message_get_member (msg),
-                        "Disconnected")               == 0) {
+    if (header.type      == DBUS_MESSAGE_TYPE_SIGNAL &&
+        header.member    == quark_disconnected       &&
+        header.interface == quark_local_interface) {
 
         /* connection was disconnected */
         if (verbose) {
             g_message("connection was disconnected\n");
         }
 
-        dbus_connection_close (dbus_conn);
-        dbus_connection_unref (dbus_conn);
-        dbus_conn = NULL;
-        exit(0);
+        disconnect_client (0);
         goto out;
     }
 
     /* Forward */
-    if (is_allowed("outgoing",
-                   dbus_message_get_interface (msg),
-                   dbus_message_get_path      (msg),
-                   dbus_message_get_member    (msg)))
+    if (is_message_allowed (quark_outgoing, &header, &rule_index))
     {
+        limiter = charge_rate_limits (quark_outgoing, msg, rule_index);
+        if (limiter != NULL) {
+            audit_verdict (quark_outgoing, &header, FALSE, rule_index);
+            PROBE4 (message__rejected, "outgoing",
+                    header.interface_name, header.member_name, rule_index);
+            g_message("Throttled call to '%s' from client to '%s' on '%s'.\n",
+                      header.member_name, header.interface_name,
+                      header.path);
+            throttle_message (conn, msg, limiter);
+            goto out;
+        }
+
+        audit_verdict (quark_outgoing, &header, TRUE, rule_index);
+        PROBE4 (message__accepted, "outgoing",
+                header.interface_name, header.member_name, rule_index);
         g_message("Accepted call to '%s' from client to '%s' on '%s'.\n",
-                  dbus_message_get_member   (msg),
-                  dbus_message_get_interface(msg),
-                  dbus_message_get_path     (msg));
+                  header.member_name, header.interface_name,
+                  header.path);
+
+        /* Queries about names, introspection data and properties are
+           answered like Hello, when the caches can */
+        if (names_cache_reply (conn, msg, &header) ||
+            introspect_reply (conn, msg, &header)  ||
+            properties_cache_reply (conn, msg, &header,
+                                    rule_set_property_cache_ttl (rules,
+                                                                 rule_index))) {
+            goto out;
+        }
+        names_cache_track_match (msg, &header);
 
         dbus_connection_send (
                         dbus_g_connection_get_connection (master_conn),
                         msg,
                         &serial);
+        PROBE3 (message__forwarded, "outgoing",
+                header.interface_name, header.member_name);
     } else {
+        audit_verdict (quark_outgoing, &header, FALSE, rule_index);
+        PROBE4 (message__rejected, "outgoing",
+                header.interface_name, header.member_name, rule_index);
         g_message("Rejected call to '%s' from "
                         "client to '%s' on '%s'.\n",
-                  dbus_message_get_member    (msg),
-                  dbus_message_get_interface (msg),
-                  dbus_message_get_path      (msg));
+                  header.member_name, header.interface_name,
+                  header.path);
         retval = DBUS_HANDLER_RESULT_NOT_YET_HANDLED;
     }
 
 out:
+    latency_end ();
     return retval;
 }
 
-/*! \brief compares if the comparison is contained by string
- *
- * \param  comparison The field to compare
- * \param  string The field in the rule
- * \return TRUE       if the rule matches the comparison
- * \return FALSE      if there is no match
- */
-gboolean compare_entry(const char *comparison, const gchar  *string) {
-    if (verbose) {
-        g_message("will try matching %s with %s\n", string, comparison);
-    }
-
-    if ((strcmp (string, "") != 0) && g_pattern_match_simple (string, comparison)) {
-        if (verbose) {
-            g_message("was a match\n");
-        }
-        return TRUE;
-    } else {
-        if (verbose) {
-            g_message("no match\n");
-        }
-        return FALSE;
-    }
-}
-
-/*! \brief Match a JSON rule against an entry
- *
- * Compare a rule as defined in the JSON rules file against the incoming or
- * outgoing message. This is a helper function for is_allowed().
- *
- * \param  rule       The JSON rule
- * \param  entry      The JSON field to compare against
- * \param  comparison The field to compare in the rule
- * \return TRUE       if the rule matches the comparison
- * \return FALSE      if there is no match
- */
-gboolean match_rule(const json_t *rule,
-                    const char   *entry,
-                    const char   *comparison)
-{
-    json_t *json_entry;
-    gchar  *string;
-
-    json_entry = json_object_get(rule, entry);
-
-
-    if (!json_is_string (json_entry)) {
-        return FALSE;
-    }
-
-    string = (gchar*) json_string_value (json_entry);
-    return compare_entry(comparison, string);
-}
-
-/*! \brief Match a JSON method against an entry
- *
- * Compare a method as defined in the JSON rules file against the incoming or
- * outgoing message. This is a helper function for is_allowed().
- *
- * \param  rule       The JSON rule
- * \param  comparison The field to compare in the rule
- * \return TRUE       if the rule matches the comparison
- * \return FALSE      if there is no match
- */
-gboolean match_method(const json_t *rule, const char *comparison)
-{
-    json_t *json_entry;
-    gchar  *string;
-
-    json_entry = json_object_get(rule, "method");
-    if (json_is_array(json_entry)) {
-        size_t ix;
-        json_t *val;
-
-        json_array_foreach(json_entry, ix, val) {
-            if (!json_is_string(val)) {
-                if (verbose) {
-                    g_message("Entry in method array is not a string.");
-                }
-                return FALSE;
-            }
-
-            string = (gchar*) json_string_value (val);
-            if ((strcmp (string, "") != 0) && g_pattern_match_simple (string, comparison)) {
-                if (verbose) {
-                    g_message("was a match\n");
-                }
-                return TRUE;
-            }
-        }
-    } else if (json_is_string (json_entry)) {
-        string = (gchar*) json_string_value (json_entry);
-        return compare_entry(comparison, string);
-    }
-
-    return FALSE;
-}
-
-
 /*! \brief Decide if a message is allowed
  *
  * Go through all the neccessary parameters of a message to decide whether it
@@ -301,52 +510,14 @@ gboolean is_allowed (const char *direction,
                      const char *path,
                      const char *member)
 {
-    size_t    i;
-    json_t   *rule;
-    gboolean  direction_ok, interface_ok, object_path_ok, method_ok;
-
-    /* Check all rules until a match is found. When a match is found we
-       don't check any following rules. This means that a more permissive
-       rule will trump less permissive rules. */
-    for (i = 0; i < json_array_size (json_filters); i++) {
-        direction_ok, interface_ok, object_path_ok, method_ok = FALSE;
-
-        /* Get the JSON array containing the JSON objects */
-        rule = json_array_get (json_filters, i);
-        if (rule == NULL || !json_is_object (rule)) {
-            json_decref (rule);
-            break;
-        }
-
-        direction_ok   = match_rule (rule, "direction",   direction);
-        interface_ok   = match_rule (rule, "interface",   interface);
-        object_path_ok = match_rule (rule, "object-path", path);
-        method_ok      = match_method(rule, member);
-
-        /* All entries matched for the rule */
-        if (direction_ok   &&
-            interface_ok   &&
-            object_path_ok &&
-            method_ok)
-        {
-            return TRUE;
-        }
-
-        /*
-         * Since direction seems to be a common source of errors, the
-         * following printout is added as a helper to developer
-         */
-        if (!direction_ok   &&
-             interface_ok   &&
-             object_path_ok &&
-             method_ok)
-        {
-            g_message("Direction '%s' does not match but "
-                      "everything else does\n", direction);
-        }
-    }
-
-    return FALSE;
+    return rule_set_is_allowed (rules,
+                                g_quark_try_string (direction),
+                                g_quark_try_string (interface),
+                                interface,
+                                path,
+                                g_quark_try_string (member),
+                                member,
+                                NULL);
 }
 
 /*! \brief Filter for incoming D-Bus requests
@@ -367,18 +538,27 @@ DBusHandlerResult master_filter_cb (DBusConnection *conn,
 {
     /* Data arriving from server */
 
-    guint32           serial;
+    MessageHeader     header;
+    gint              rule_index;
+    RateLimiter      *limiter;
     DBusHandlerResult retval = DBUS_HANDLER_RESULT_HANDLED;
 
     if (!dbus_conn) {
         exit(1);
     }
+
+    children_touch ();
+    message_header_read (&header, msg);
+    latency_begin (LATENCY_INCOMING, &header);
+    PROBE5 (message__received, "incoming", header.type,
+            header.interface_name, header.path, header.member_name);
+    capture_message (quark_incoming, &header, msg);
+
     /* Make sure that a new connection does not have a unique name
        that was previously owned by an eavesdropping connection */
-    if (dbus_message_get_member(msg) != NULL &&
-        strcmp(dbus_message_get_member(msg), "NameAcquired") == 0)
+    if (header.member == quark_name_acquired)
     {
-        const char *dest = dbus_message_get_destination(msg);
+        const char *dest = header.destination;
         if (verbose)
         {
             g_message("NameAcquired received by %s\n", dest);
@@ -397,47 +577,242 @@ DBusHandlerResult master_filter_cb (DBusConnection *conn,
         }
     }
 
+    /* Pruned introspection data, and replies and signals for the caches
+       only */
+    if (properties_cache_filter (msg, &header)     ||
+        introspect_filter (dbus_conn, msg, &header) ||
+        names_cache_filter (msg, &header)) {
+        goto out;
+    }
+
     /* Forward */
-    if (dbus_message_get_interface(msg) == NULL ||
-        strcmp(dbus_message_get_interface(msg),
-               "org.freedesktop.DBus")  == 0)
+    if (header.interface_name == NULL ||
+        header.interface == quark_dbus_interface)
     {
-        if (is_incoming_eavesdropping(msg) &&
-            !is_conn_known_eavesdropper(dbus_message_get_sender(msg)))
+        if (is_incoming_eavesdropping(msg, &header) &&
+            !is_conn_known_eavesdropper(header.sender))
         {
             eavesdropping_conns =
                 g_list_append (eavesdropping_conns,
-                       (gpointer) dbus_message_get_sender(msg));
+                       (gpointer) header.sender);
         }
 
-        dbus_connection_send(dbus_conn, msg, &serial);
+        delivery_send (dbus_conn, msg, &header, RULE_LANE_NONE, FALSE);
+        PROBE3 (message__forwarded, "incoming",
+                header.interface_name, header.member_name);
     } else if (is_conn_known_eavesdropper (dbus_bus_get_unique_name(conn)))
     {
         if (verbose) {
             g_message("'%s' is an eavesdropping connection, let it go...\n",
                       dbus_bus_get_unique_name(conn));
         }
-    } else if (is_allowed("incoming",
-                          dbus_message_get_interface (msg),
-                          dbus_message_get_path      (msg),
-                          dbus_message_get_member    (msg)))
+    } else if (is_message_allowed (quark_incoming, &header, &rule_index))
     {
+        limiter = charge_rate_limits (quark_incoming, msg, rule_index);
+        if (limiter != NULL) {
+            audit_verdict (quark_incoming, &header, FALSE, rule_index);
+            PROBE4 (message__rejected, "incoming",
+                    header.interface_name, header.member_name, rule_index);
+            g_message("Throttled call to '%s' from server to '%s' on '%s'.\n",
+                      header.member_name, header.interface_name,
+                      header.path);
+            throttle_message (conn, msg, limiter);
+            goto out;
+        }
+
+        audit_verdict (quark_incoming, &header, TRUE, rule_index);
+        PROBE4 (message__accepted, "incoming",
+                header.interface_name, header.member_name, rule_index);
         g_message("Accepted call to '%s' from server to '%s' on '%s'.\n",
-                  dbus_message_get_member    (msg),
-                  dbus_message_get_interface (msg),
-                  dbus_message_get_path      (msg));
-        dbus_connection_send(dbus_conn, msg, &serial);
+                  header.member_name, header.interface_name,
+                  header.path);
+        delivery_send (dbus_conn, msg, &header,
+                       rule_set_lane (rules, rule_index),
+                       rule_set_coalesce (rules, rule_index));
+        PROBE3 (message__forwarded, "incoming",
+                header.interface_name, header.member_name);
     } else {
+        audit_verdict (quark_incoming, &header, FALSE, rule_index);
+        PROBE4 (message__rejected, "incoming",
+                header.interface_name, header.member_name, rule_index);
         g_message("Rejected call to '%s' from server to '%s' on '%s'.\n",
-                  dbus_message_get_member    (msg),
-                  dbus_message_get_interface (msg),
-                  dbus_message_get_path      (msg));
+                  header.member_name, header.interface_name,
+                  header.path);
         retval = DBUS_HANDLER_RESULT_NOT_YET_HANDLED;
     }
 
+out:
+    latency_end ();
     return retval;
 }
 
+/*! \brief Append the active order of the rules as a JSON line
+ *
+ * The line has the time, the pid and bus of the child and the order, a list
+ * of the indices of the rules in the order they are evaluated.
+ */
+static void log_rule_order (void) {
+    json_t  *object;
+    json_t  *order;
+    GString *line;
+    char    *text;
+    guint    i;
+
+    order = json_array();
+    line  = g_string_new("Active rule order:");
+    for (i = 0; i < rule_set_size(rules); i++) {
+        json_array_append_new(order, json_integer(rule_set_active_rule(rules, i)));
+        g_string_append_printf(line, " %u", rule_set_active_rule(rules, i));
+    }
+    g_message("%s\n", line->str);
+    g_string_free(line, TRUE);
+
+    if (rule_order_fd < 0) {
+        json_decref(order);
+        return;
+    }
+
+    object = json_object();
+    json_object_set_new(object, "time",
+                        json_real(g_get_real_time() / (double) G_USEC_PER_SEC));
+    json_object_set_new(object, "pid", json_integer(getpid()));
+    json_object_set_new(object, "bus",
+                        json_string(bus == DBUS_BUS_SYSTEM ? "system" : "session"));
+    json_object_set_new(object, "order", order);
+    text = json_dumps(object, JSON_COMPACT);
+    json_decref(object);
+    if (text == NULL) {
+        return;
+    }
+
+    line = g_string_new(text);
+    g_string_append_c(line, '\n');
+    free(text);
+
+    /* One write per line, with O_APPEND the lines of different children do
+       not interleave */
+    output_write(rule_order_fd, line->str, line->len, "rule order");
+    g_string_free(line, TRUE);
+}
+
+/*! \brief Move the rules that give the most verdicts earlier */
+static gboolean reorder_rules_timeout (gpointer data) {
+    if (rule_set_reorder(rules)) {
+        log_rule_order();
+    }
+    return TRUE;
+}
+
+/*! \brief Test if messages can be relayed without filtering
+ *
+ * A connection is relayed when the rules allow everything in both
+ * directions, there is no connection limit and messages are neither audited
+ * nor captured.
+ */
+static gboolean is_relaying() {
+    return !audit_enabled() &&
+           !capture_enabled() &&
+           connection_limiter.spec == NULL &&
+           outgoing_verdict == RULE_VERDICT_ALLOW_ALL &&
+           incoming_verdict == RULE_VERDICT_ALLOW_ALL;
+}
+
+/*! \brief Relay for outgoing D-Bus messages
+ *
+ * Used in place of filter_cb() for connections where everything is allowed.
+ * Once Hello has been answered, messages are forwarded without reading the
+ * rest of the header into a MessageHeader and without logging. The messages
+ * that need handling, and messages the rules would reject because a header
+ * field is missing, are passed on to filter_cb().
+ *
+ * \param conn      The D-Bus connection to filter
+ * \param msg       The message to filter
+ * \param user_data Unused (required by D-Bus API)
+ * \return DBUS_HANDLER_RESULT_HANDLED         if the request is accepted
+ * \return DBUS_HANDLER_RESULT_NOT_YET_HANDLED if the request is denied
+ */
+DBusHandlerResult relay_filter_cb (DBusConnection *conn,
+                                   DBusMessage    *msg,
+                                   void           *user_data)
+{
+    guint32 serial;
+
+    if (!hello_answered || !is_relaying()) {
+        return filter_cb (conn, msg, user_data);
+    }
+
+    /* Disconnected is a local signal from libdbus */
+    if (dbus_message_get_type (msg) == DBUS_MESSAGE_TYPE_SIGNAL &&
+        dbus_message_has_interface (msg, "org.freedesktop.DBus.Local"))
+    {
+        return filter_cb (conn, msg, user_data);
+    }
+
+    if (dbus_message_get_interface (msg) == NULL ||
+        dbus_message_get_path (msg)      == NULL ||
+        dbus_message_get_member (msg)    == NULL)
+    {
+        return filter_cb (conn, msg, user_data);
+    }
+
+    children_touch ();
+    dbus_connection_send (dbus_g_connection_get_connection (master_conn),
+                          msg,
+                          &serial);
+    PROBE3 (message__forwarded, "outgoing",
+            dbus_message_get_interface (msg), dbus_message_get_member (msg));
+
+    return DBUS_HANDLER_RESULT_HANDLED;
+}
+
+/*! \brief Relay for incoming D-Bus messages
+ *
+ * Used in place of master_filter_cb() for connections where everything is
+ * allowed. Method returns and errors, and messages on other interfaces than
+ * org.freedesktop.DBus, are forwarded without further inspection. Messages
+ * from the bus itself are passed on to master_filter_cb() so NameAcquired
+ * and eavesdropping AddMatch are still tracked, and so is everything once an
+ * eavesdropper is known.
+ *
+ * \param conn      The D-Bus connection to filter
+ * \param msg       The message to filter
+ * \param user_data Unused (required by D-Bus API)
+ * \return DBUS_HANDLER_RESULT_HANDLED         if the request is accepted
+ * \return DBUS_HANDLER_RESULT_NOT_YET_HANDLED if the request is denied
+ */
+DBusHandlerResult master_relay_filter_cb (DBusConnection *conn,
+                                          DBusMessage    *msg,
+                                          void           *user_data)
+{
+    int         type;
+    const char *interface;
+
+    if (!dbus_conn || !is_relaying() || eavesdropping_conns != NULL) {
+        return master_filter_cb (conn, msg, user_data);
+    }
+
+    type = dbus_message_get_type (msg);
+    if (type != DBUS_MESSAGE_TYPE_METHOD_RETURN &&
+        type != DBUS_MESSAGE_TYPE_ERROR)
+    {
+        interface = dbus_message_get_interface (msg);
+        if (interface == NULL                              ||
+            strcmp (interface, DBUS_NAME_DBUS) == 0        ||
+            dbus_message_get_path (msg)   == NULL          ||
+            dbus_message_get_member (msg) == NULL)
+        {
+            return master_filter_cb (conn, msg, user_data);
+        }
+    }
+
+    children_touch ();
+    delivery_send (dbus_conn, msg, NULL, RULE_LANE_NONE, FALSE);
+    PROBE3 (message__forwarded, "incoming",
+            dbus_message_get_interface (msg), dbus_message_get_member (msg));
+
+    return DBUS_HANDLER_RESULT_HANDLED;
+}
+
 /*! \brief Allow all connections to the D-Bus socket
  *
  * By returning true here regardless of input data, any user may communicate
@@ -457,23 +832,31 @@ dbus_bool_t allow_all_connections (DBusConnection *conn,
  * the D-Bus proxy will keep track of it and make sure that it does not
  * hijack the messages.
  *
- * \param msg The D-Bus message sent to org.freedesktop.DBus
+ * \param msg    The D-Bus message sent to org.freedesktop.DBus
+ * \param header The header fields of the message
  * \return TRUE If connection wants to eavesdrop
  * \return FALSE If connection does not want to eavesdrop
  */
-gboolean is_incoming_eavesdropping (DBusMessage *msg)
+gboolean is_incoming_eavesdropping (DBusMessage         *msg,
+                                    const MessageHeader *header)
 {
     gboolean is_eavesdropping = FALSE;
 
-    /* Look for AddMatch and eavesdrop=true in message */
-    if (dbus_message_get_member(msg) != NULL &&
-        strcmp(dbus_message_get_member(msg), "AddMatch") == 0)
+    /* Look for AddMatch and eavesdrop=true in message. This is the only
+       place the body of a message is read, all other decisions are made on
+       the header fields. */
+    if (header->type   == DBUS_MESSAGE_TYPE_METHOD_CALL &&
+        header->member == quark_add_match)
+        {
+        const char *msg_arguments = NULL;
+        if (!dbus_message_get_args (msg,
+                                    NULL,
+                                    DBUS_TYPE_STRING,
+                                    &msg_arguments,
+                                    DBUS_TYPE_INVALID))
         {
-        const char *msg_arguments;
-        dbus_message_get_args (msg,
-                               NULL,
-                               DBUS_TYPE_STRING,
-                               &msg_arguments);
+            return FALSE;
+        }
 
         if (strstr(msg_arguments, "eavesdrop=true") != NULL ||
             strstr(msg_arguments, "eavesdrop='true'") != NULL)
@@ -482,7 +865,7 @@ gboolean is_incoming_eavesdropping (DBusMessage *msg)
             if (verbose)
             {
                 g_message("'%s' AddMatch-args: \"%s\"\n",
-                          dbus_message_get_sender(msg),
+                          header->sender,
                           msg_arguments);
             }
         }
@@ -556,23 +939,52 @@ gboolean remove_name_from_known_eavesdroppers (const char *unique_name)
  *
  * \param server The D-Bus server
  * \param conn   The D-Bus connection to filter
- * \param data   Unused (needed by D-Bus API)
+ * \param data   The ProxyListener that accepted the connection
  */
 void new_connection_cb (DBusServer *server, DBusConnection *conn, void *data) {
-    pid_t   pid;
-    pid_t   forked;
-    GError *error = NULL;
+    ProxyListener *listener = data;
+    GList         *iter;
+    guint          i;
+    pid_t          pid;
+    pid_t          forked;
+    gint           slot;
+    gint64         fork_start;
+    GError        *error = NULL;
+
+    /* A connection that is not referenced is closed */
+    if (!children_accepting()) {
+        return;
+    }
+
+    slot       = children_reserve_slot();
+    fork_start = g_get_monotonic_time();
 
     forked = fork();
     pid    = getpid();
 
+    if (forked < 0) {
+        /* The connection is closed when it is not referenced */
+        g_message("Could not fork for new connection: %s\n", strerror(errno));
+        children_release_slot(slot);
+        return;
+    }
+
     if (forked != 0) {
         if (verbose) {
             g_message("in main process, pid: %d\n", pid);
         }
 
-        /* Reconfigure the master socket as forking will break it */
-        start_bus();
+        /* Reconfigure the master sockets as forking will break them, the
+           child has inherited all of them */
+        for (iter = listeners; iter != NULL; iter = iter->next) {
+            start_bus ((ProxyListener *) iter->data);
+        }
+
+        children_add(forked, slot, conn,
+                     listener->bus == DBUS_BUS_SYSTEM ? "system" : "session",
+                     g_get_monotonic_time() - fork_start);
+        PROBE2 (connection__accepted, (int) forked,
+                listener->bus == DBUS_BUS_SYSTEM ? "system" : "session");
         return;
     } else {
         if (verbose) {
@@ -580,6 +992,32 @@ void new_connection_cb (DBusServer *server, DBusConnection *conn, void *data) {
         }
     }
 
+    children_enter_child(slot, disconnect_client);
+    latency_enter_child();
+
+    /* The child is a proxy for the bus of the listener that accepted the
+       connection, with the rules of that bus */
+    bus              = listener->bus;
+    rules            = listener->section->rules;
+    outgoing_verdict = listener->section->outgoing_verdict;
+    incoming_verdict = listener->section->incoming_verdict;
+
+    rule_limiters = g_new0 (RateLimiter, MAX (rule_set_size (rules), 1));
+    for (i = 0; i < rule_set_size (rules); i++) {
+        rate_limiter_init (&rule_limiters[i], rule_set_rate_limit (rules, i));
+    }
+    rate_limiter_init (&connection_limiter, listener->section->connection_limit);
+
+    /* Each child serves one client with its own main loop and bus
+       connection, and keeps the rules it was forked with. Configs on
+       stdin are for the parent, a child that also watched stdin would be
+       woken by every config and could block reading a line the parent
+       already consumed. */
+    if (stdin_watch_id != 0) {
+        g_source_remove (stdin_watch_id);
+        stdin_watch_id = 0;
+    }
+
     if (master_conn != NULL) {
         g_message("master_conn already initialized\n");
         exit (1);
@@ -598,19 +1036,37 @@ void new_connection_cb (DBusServer *server, DBusConnection *conn, void *data) {
         exit(1);
     }
 
+    /* Connections where everything is allowed are relayed */
     dbus_connection_add_filter (
             dbus_g_connection_get_connection(master_conn),
-            master_filter_cb,
+            is_relaying() ? master_relay_filter_cb : master_filter_cb,
             NULL,
             NULL);
 
+    /* Filtered connections answer queries about names from a cache, and
+       may cache properties and cache and prune introspection data */
+    if (!is_relaying()) {
+        names_cache_start (dbus_g_connection_get_connection (master_conn));
+        properties_cache_start (dbus_g_connection_get_connection (master_conn));
+        introspect_start (rules);
+    }
+
+    /* The rules are learnt from the traffic of this client only */
+    if (reorder_interval > 0 && !is_relaying()) {
+        g_timeout_add_seconds (reorder_interval, reorder_rules_timeout, NULL);
+    }
+
     if (verbose) {
         g_message("New connection\n");
     }
 
     dbus_connection_ref               (conn);
     dbus_connection_setup_with_g_main (conn, NULL);
-    dbus_connection_add_filter        (conn, filter_cb, NULL, NULL);
+    dbus_connection_add_filter        (conn,
+                                       is_relaying() ? relay_filter_cb
+                                                     : filter_cb,
+                                       NULL,
+                                       NULL);
 
     dbus_connection_set_unix_user_function (conn,
                                             allow_all_connections,
@@ -621,72 +1077,217 @@ void new_connection_cb (DBusServer *server, DBusConnection *conn, void *data) {
     dbus_conn = conn;
 }
 
-void start_bus() {
+void start_bus (ProxyListener *listener) {
     DBusError   error;
 
     dbus_error_init (&error);
 
-    if (dbus_srv != NULL) {
-        dbus_server_disconnect(dbus_srv);
-        dbus_server_unref(dbus_srv);
+    if (listener->server != NULL) {
+        dbus_server_disconnect(listener->server);
+        dbus_server_unref(listener->server);
     }
-    dbus_srv = dbus_server_listen (address, &error);
-    if (dbus_srv == NULL) {
-        g_error("Cannot listen on %s\n", address);
+    listener->server = dbus_server_listen (listener->address, &error);
+    if (listener->server == NULL) {
+        g_error("Cannot listen on %s\n", listener->address);
         exit(1);
     }
 
-    dbus_server_set_new_connection_function (dbus_srv,
+    dbus_server_set_new_connection_function (listener->server,
                                              new_connection_cb,
-                                             NULL,
+                                             listener,
                                              NULL);
-    dbus_server_setup_with_g_main (dbus_srv, NULL);
+    dbus_server_setup_with_g_main (listener->server, NULL);
 }
 
 
-void parse_full_config(const char *config_string, const char *section) {
+/*! \brief Compile the rules of a config section
+ *
+ * The rules of a config are appended to the rules of the earlier configs.
+ * Sections with identical rules share one compiled rule set.
+ *
+ * \param section The section to compile
+ * \param config  The JSON rule array of the section in the new config
+ */
+static void compile_section (ConfigSection *section, const json_t *config) {
+    RuleSet *rules;
+    GList   *iter;
+
+    rules = rule_set_append (section->rules, config);
+
+    for (iter = sections; iter != NULL && iter->data != section; iter = iter->next) {
+        ConfigSection *other = iter->data;
+
+        if (other->rules != NULL && rule_set_equal (other->rules, rules)) {
+            g_message("Rules of %s are identical to %s, sharing them\n",
+                      section->name, other->name);
+            rule_set_unref (rules);
+            rules = rule_set_ref (other->rules);
+            break;
+        }
+    }
+
+    rule_set_unref (section->rules);
+    section->rules = rules;
+
+    section->outgoing_verdict = rule_set_analyze (section->rules, "outgoing");
+    section->incoming_verdict = rule_set_analyze (section->rules, "incoming");
+    g_message("Compiled %u rules for %s, outgoing verdict %d, incoming verdict %d\n",
+              rule_set_size (section->rules), section->name,
+              section->outgoing_verdict, section->incoming_verdict);
+}
+
+/*! \brief Parse a config and compile the rules of each section
+ *
+ * \param config_string The config, need not be NUL terminated
+ * \param length        Length of the config in bytes
+ * \param error_message Set to a description of why the config was ignored,
+ *                      free with g_free(). May be NULL
+ * \return FALSE if the config was ignored and the old rules are kept
+ */
+gboolean parse_full_config(const char *config_string,
+                           gsize length,
+                           gchar **error_message) {
     json_error_t error;
     json_t *root;
     json_t *config;
-
-    char *full_section = calloc(30, sizeof(char));
-
-    snprintf(full_section, 30, "dbus-gateway-config-%s", section);
+    json_t *limit;
+    char   *dump;
+    GList  *iter;
+    RateLimitSpec connection_limit;
 
     g_message("Parsing config");
 
     /* Get root JSON object */
-    root = json_loads(config_string, 0, &error);
+    root = json_loadb(config_string, length, 0, &error);
 
+    /* A malformed config is ignored as a whole, and the proxy keeps the
+       rules it has. Use --check-config to find what is wrong. */
     if (!root) {
-       g_error("error: on line %d: %s\n", error.line, error.text);
-       return;
+       g_message("error: on line %d: %s, config ignored\n",
+                 error.line, error.text);
+       if (error_message != NULL) {
+           *error_message = g_strdup_printf("line %d: %s",
+                                            error.line, error.text);
+       }
+       return FALSE;
     }
 
-    /* Get array */
-    config = json_object_get(root, full_section);
+    for (iter = sections; iter != NULL; iter = iter->next) {
+        ConfigSection *section = iter->data;
 
-    g_message("%s\n", json_dumps(config, JSON_INDENT(4)));
+        if (!json_is_array(json_object_get(root, section->name))) {
+            g_message("error: %s is not present in config, or not an array. "
+                      "Config ignored, fix your config\n", section->name);
+            if (error_message != NULL) {
+                *error_message = g_strdup_printf("%s is not present in config, "
+                                                 "or not an array",
+                                                 section->name);
+            }
+            json_decref (root);
+            return FALSE;
+        }
+    }
+
+    for (iter = sections; iter != NULL; iter = iter->next) {
+        ConfigSection *section = iter->data;
+
+        /* Get array */
+        config = json_object_get(root, section->name);
+
+        dump = json_dumps(config, JSON_INDENT(4));
+        g_message("%s\n", dump);
+        free(dump);
 
-    if (!json_is_array(config)) {
-        g_error("error: %s is not present in config, or not an array. "
-                "Fix your config\n", full_section);
-        json_decref (config);
+        compile_section (section, config);
+        PROBE2 (config__swapped, section->name, rule_set_size (section->rules));
+
+        /* The connection limit is replaced by each config that has one,
+           and removed by one that does not limit anything */
+        limit = json_object_get(root, section->limit_name);
+        if (limit != NULL) {
+            g_clear_pointer (&section->connection_limit, g_free);
+            if (rate_limit_spec_parse (&connection_limit, limit)) {
+                section->connection_limit = g_memdup (&connection_limit,
+                                                      sizeof (connection_limit));
+            }
+        }
     }
 
-    if (NULL == json_filters) {
-        json_filters = config;
+    /* Nothing refers to the JSON once the rules are compiled, so forked
+       proxies do not inherit it */
+    json_decref(root);
+
+    return TRUE;
+}
+
+
+/*! \brief Add a listener for a socket path and bus type
+ *
+ * \param path     The socket path to listen on
+ * \param bus_name The bus type, "session" or "system"
+ * \return FALSE if the bus type is not valid
+ */
+static gboolean add_listener (const char *path, const char *bus_name) {
+    ProxyListener *listener;
+    ConfigSection *section = NULL;
+    gchar         *section_name;
+    GList         *iter;
+
+    listener = g_new0 (ProxyListener, 1);
+    listener->address = g_strconcat ("unix:path=", path, NULL);
+
+    if (strcmp (bus_name, "system") == 0) {
+        listener->bus = DBUS_BUS_SYSTEM;
+    } else if (strcmp (bus_name, "session") == 0) {
+        listener->bus = DBUS_BUS_SESSION;
     } else {
-        if (0 != json_array_extend(json_filters, config)) {
-            g_error("Error extending config array\n");
+        g_free (listener->address);
+        g_free (listener);
+        return FALSE;
+    }
+
+    /* Listeners for the same bus type share the section of the config */
+    section_name = g_strconcat ("dbus-gateway-config-", bus_name, NULL);
+    for (iter = sections; iter != NULL; iter = iter->next) {
+        if (strcmp (((ConfigSection *) iter->data)->name, section_name) == 0) {
+            section = iter->data;
+            break;
         }
     }
+
+    if (section == NULL) {
+        section = g_new0 (ConfigSection, 1);
+        section->name = section_name;
+        section->limit_name = g_strconcat ("dbus-gateway-rate-limit-",
+                                           bus_name, NULL);
+        section->outgoing_verdict = RULE_VERDICT_DENY_ALL;
+        section->incoming_verdict = RULE_VERDICT_DENY_ALL;
+        sections = g_list_append (sections, section);
+    } else {
+        g_free (section_name);
+    }
+
+    listener->section = section;
+    listeners = g_list_append (listeners, listener);
+
+    return TRUE;
 }
 
 
 void print_usage() {
     g_print("dbus-proxy, version %s\n", PACKAGE_VERSION);
-    g_print("Usage: dbus-proxy address session|system\n"
+    g_print("Usage: dbus-proxy --check-config [--max-cost=N] [FILE]\n");
+    g_print("       dbus-proxy [--audit-log=FILE [--audit-sample=N] "
+            "[--audit-reject-rate=N]] [--introspect-cache] "
+            "[--introspect-prune] [--property-cache-size=N] "
+            "[--framed-config] [--child-registry=FILE] [--max-clients=N] "
+            "[--idle-timeout=N] [--max-child-memory=N] "
+            "[--capture=FILE [--capture-messages]] "
+            "[--reorder-rules=N [--rule-order-log=FILE]] "
+            "[--latency-log=FILE] [--stall-threshold=N [--stall-log=FILE]] "
+            "[--priority-lanes] "
+            "address session|system "
+            "[address session|system ...]\n"
             "waits for config on stdin\n");
 }
 
@@ -765,8 +1366,8 @@ void log_handler_silent(const gchar *log_domain,
  *
  * Other events are not handled and will be ignored.
  *
- * 'data' contains the section (either "session" or "system") to
- * parse from the config.
+ * The sections parsed from the config are the ones of the bus types
+ * given on the command line.
  */
 static gboolean stdin_watch(GIOChannel *source,
                             GIOCondition condition,
@@ -779,6 +1380,7 @@ static gboolean stdin_watch(GIOChannel *source,
         g_message("Event was G_IO_HUP, will stop listening for events");
 
         /* We stop listening for events at this point */
+        stdin_watch_id = 0;
         return FALSE;
     }
 
@@ -800,12 +1402,16 @@ static gboolean stdin_watch(GIOChannel *source,
                zero bytes. We stop listenting for events at this point */
             g_message("Read zero bytes, will stop listening for events");
 
+            stdin_watch_id = 0;
             return FALSE;
         }
 
         g_message("%s", msg);
 
-        parse_full_config(msg, (const char *)data);
+        latency_begin(LATENCY_CONFIG, NULL);
+        parse_full_config(msg, len, NULL);
+        latency_end();
+        g_free(msg);
 
         return TRUE;
     }
@@ -816,33 +1422,300 @@ static gboolean stdin_watch(GIOChannel *source,
 }
 
 
+/*! \brief Write an ack frame for a config frame to stdout
+ *
+ * The ack is a JSON object followed by a NUL byte, with the number of the
+ * config frame and whether its rules are now used for new connections.
+ */
+static void write_config_ack (guint number, const gchar *error_message) {
+    json_t  *ack;
+    char    *text;
+
+    ack = json_object();
+    json_object_set_new(ack, "config", json_integer(number));
+    json_object_set_new(ack, "status",
+                        json_string(error_message == NULL ? "ok" : "error"));
+    if (error_message != NULL) {
+        json_object_set_new(ack, "error", json_string(error_message));
+    }
+    text = json_dumps(ack, JSON_COMPACT);
+    json_decref(ack);
+    if (text == NULL) {
+        return;
+    }
+
+    /* The terminating NUL is written as well */
+    output_write(STDOUT_FILENO, text, strlen(text) + 1, "config ack");
+    free(text);
+}
+
+/*! \brief Apply a complete config frame and acknowledge it */
+static void apply_config_frame (const gchar *frame, gsize length) {
+    gchar *error_message = NULL;
+
+    config_frame_count++;
+    g_message("Read config frame %u of %" G_GSIZE_FORMAT " bytes",
+              config_frame_count, length);
+
+    if (length > CONFIG_FRAME_MAX) {
+        error_message = g_strdup_printf("config is larger than %d bytes",
+                                        CONFIG_FRAME_MAX);
+    } else {
+        latency_begin(LATENCY_CONFIG, NULL);
+        parse_full_config(frame, length, &error_message);
+        latency_end();
+    }
+
+    write_config_ack(config_frame_count, error_message);
+    g_free(error_message);
+}
+
+/*
+ * Read config frames from stdin.
+ *
+ * Configs are separated by NUL bytes and may span any number of reads and
+ * lines. Whatever is available is read and added to the current frame, and
+ * each frame is parsed once its NUL has been read. The frame is not parsed
+ * while it is incomplete, so a partial read is not an error.
+ *
+ * Reading zero bytes means the writing end has closed stdin, an incomplete
+ * frame is then dropped and we stop listening for more events.
+ */
+static gboolean stdin_frame_watch(GIOChannel *source,
+                                  GIOCondition condition,
+                                  gpointer *data)
+{
+    gchar   buffer[CONFIG_READ_SIZE];
+    gchar  *start;
+    gchar  *end;
+    ssize_t len;
+
+    len = read(g_io_channel_unix_get_fd(source), buffer, sizeof(buffer));
+    if (len < 0 && (errno == EINTR || errno == EAGAIN)) {
+        return TRUE;
+    }
+
+    if (len <= 0) {
+        if (len < 0) {
+            g_message("Error reading from stdin: %s", strerror(errno));
+        }
+        if (config_frame != NULL && config_frame->len > 0) {
+            g_message("Dropping incomplete config frame of %" G_GSIZE_FORMAT
+                      " bytes", config_frame->len);
+        }
+        g_message("End of stdin, will stop listening for events");
+
+        if (config_frame != NULL) {
+            g_string_free(config_frame, TRUE);
+            config_frame = NULL;
+        }
+        stdin_watch_id = 0;
+        return FALSE;
+    }
+
+    if (config_frame == NULL) {
+        config_frame = g_string_new(NULL);
+    }
+
+    start = buffer;
+    while ((end = memchr(start, '\0', buffer + len - start)) != NULL) {
+        if (config_frame->len == 0) {
+            /* The whole frame is in this read, no need to copy it */
+            apply_config_frame(start, end - start);
+        } else {
+            if (config_frame->len <= CONFIG_FRAME_MAX) {
+                g_string_append_len(config_frame, start, end - start);
+            }
+            apply_config_frame(config_frame->str, config_frame->len);
+            g_string_truncate(config_frame, 0);
+        }
+        start = end + 1;
+    }
+
+    /* Keep the start of the next frame. Appending stops once the frame is
+       over the limit, and it is rejected when its end is read. */
+    if (config_frame->len <= CONFIG_FRAME_MAX) {
+        g_string_append_len(config_frame, start, buffer + len - start);
+    }
+
+    return TRUE;
+}
+
+
+/*! \brief Check a config and print a report on it
+ *
+ * \param path     The config file, or NULL to read the config from stdin
+ * \param max_cost Glob matches per message a section may need, 0 for no
+ *                 limit
+ * \return The exit status, 0 if the config has no errors
+ */
+static int check_config (const char *path, guint max_cost) {
+    json_error_t error;
+    json_t *root;
+    GString *report;
+    gboolean valid;
+
+    if (path != NULL) {
+        root = json_load_file(path, 0, &error);
+    } else {
+        root = json_loadf(stdin, 0, &error);
+    }
+
+    if (!root) {
+        g_print("error: on line %d: %s\n", error.line, error.text);
+        return 1;
+    }
+
+    report = g_string_new(NULL);
+    valid = config_check(root, max_cost, report);
+    g_print("%s%s\n", report->str, valid ? "Config OK" : "Config has errors");
+
+    g_string_free(report, TRUE);
+    json_decref(root);
+    return valid ? 0 : 1;
+}
+
+
 int main(int argc, char *argv[]) {
     g_message("Starting dbus-proxy, pid: %d", getpid());
 
     GMainLoop *mainloop = NULL;
     GError *error = NULL;
+    GList *iter;
+    int i;
+
+    /* Options */
+    gboolean show_version = FALSE;
+    gchar *audit_log = NULL;
+    gint audit_sample = 1;
+    gint audit_reject_rate = 0;
+    gboolean introspect_cache = FALSE;
+    gboolean introspect_prune = FALSE;
+    gint property_cache_size = PROPERTIES_CACHE_DEFAULT_SIZE;
+    gboolean check = FALSE;
+    gint max_cost = 0;
+    gchar *child_registry = NULL;
+    gint max_clients = 0;
+    gint idle_timeout = 0;
+    gint max_child_memory = 0;
+    gchar *capture = NULL;
+    gboolean capture_messages = FALSE;
+    gint reorder_rules = 0;
+    gchar *rule_order_log = NULL;
+    gchar *latency_log = NULL;
+    gint stall_threshold = 0;
+    gchar *stall_log = NULL;
+    gboolean priority_lanes = FALSE;
+    GOptionEntry entries[] = {
+        { "version", 0, 0, G_OPTION_ARG_NONE, &show_version,
+          "Print version and usage", NULL },
+        { "audit-log", 0, 0, G_OPTION_ARG_FILENAME, &audit_log,
+          "Append a JSON line for each verdict to FILE", "FILE" },
+        { "audit-sample", 0, 0, G_OPTION_ARG_INT, &audit_sample,
+          "Audit one in N accepted messages, 0 for none (default 1)", "N" },
+        { "audit-reject-rate", 0, 0, G_OPTION_ARG_INT, &audit_reject_rate,
+          "Audit at most N rejected messages per second, 0 for no limit "
+          "(default 0)", "N" },
+        { "introspect-cache", 0, 0, G_OPTION_ARG_NONE, &introspect_cache,
+          "Answer repeated Introspect calls from a cache", NULL },
+        { "introspect-prune", 0, 0, G_OPTION_ARG_NONE, &introspect_prune,
+          "Remove what the rules reject from introspection data", NULL },
+        { "property-cache-size", 0, 0, G_OPTION_ARG_INT, &property_cache_size,
+          "Cache at most N bytes of property replies per client, 0 for none "
+          "(default 1 MiB)", "N" },
+        { "check-config", 0, 0, G_OPTION_ARG_NONE, &check,
+          "Check the config in FILE, or on stdin, and report on its rules",
+          NULL },
+        { "max-cost", 0, 0, G_OPTION_ARG_INT, &max_cost,
+          "With --check-config, fail if a message may need more than N glob "
+          "matches", "N" },
+        { "child-registry", 0, 0, G_OPTION_ARG_FILENAME, &child_registry,
+          "Write the processes serving clients to FILE as JSON, on changes "
+          "and on SIGUSR1", "FILE" },
+        { "max-clients", 0, 0, G_OPTION_ARG_INT, &max_clients,
+          "Serve at most N clients at a time, 0 for no limit (default 0)",
+          "N" },
+        { "idle-timeout", 0, 0, G_OPTION_ARG_INT, &idle_timeout,
+          "Disconnect a client after N seconds without messages, 0 for no "
+          "limit (default 0)", "N" },
+        { "max-child-memory", 0, 0, G_OPTION_ARG_INT, &max_child_memory,
+          "Disconnect a client whose process has more than N MiB resident, "
+          "0 for no limit (default 0)", "N" },
+        { "framed-config", 0, 0, G_OPTION_ARG_NONE, &framed_config,
+          "Read configs from stdin as NUL terminated frames, and write an "
+          "ack frame to stdout once each is applied", NULL },
+        { "capture", 0, 0, G_OPTION_ARG_FILENAME, &capture,
+          "Append the header, size and time of each message to FILE",
+          "FILE" },
+        { "capture-messages", 0, 0, G_OPTION_ARG_NONE, &capture_messages,
+          "With --capture, also append the whole messages", NULL },
+        { "reorder-rules", 0, 0, G_OPTION_ARG_INT, &reorder_rules,
+          "Every N seconds, evaluate the rules that decide most messages "
+          "first where that does not change a verdict, 0 to never reorder "
+          "(default 0)", "N" },
+        { "rule-order-log", 0, 0, G_OPTION_ARG_FILENAME, &rule_order_log,
+          "With --reorder-rules, append the order of the rules to FILE as "
+          "a JSON line after each reorder", "FILE" },
+        { "latency-log", 0, 0, G_OPTION_ARG_FILENAME, &latency_log,
+          "Time each dispatch and append histograms of the times to FILE "
+          "as JSON lines", "FILE" },
+        { "stall-threshold", 0, 0, G_OPTION_ARG_INT, &stall_threshold,
+          "Report the message and stack of a dispatch that runs for more "
+          "than N ms, 0 for never (default 0)", "N" },
+        { "stall-log", 0, 0, G_OPTION_ARG_FILENAME, &stall_log,
+          "Append stall reports to FILE instead of stderr", "FILE" },
+        { "priority-lanes", 0, 0, G_OPTION_ARG_NONE, &priority_lanes,
+          "Send replies to a client that is behind before method calls, "
+          "and method calls before signals", NULL },
+        { NULL }
+    };
+    GOptionContext *context;
+
+    context = g_option_context_new("address session|system "
+                                   "[address session|system ...]");
+    g_option_context_add_main_entries(context, entries, NULL);
+    if (!g_option_context_parse(context, &argc, &argv, &error)) {
+        g_printerr("%s\n", error->message);
+        exit(1);
+    }
+    g_option_context_free(context);
 
     /* Support --version */
-    if (argc == 2 && strcmp(argv[1], "--version") == 0) {
+    if (show_version) {
         print_usage();
         exit(0);
     }
 
-    /* Check for right number of args */
-    if (argc < 3) {
+    if (audit_sample < 0 || audit_reject_rate < 0 || property_cache_size < 0 ||
+        max_cost < 0 || max_clients < 0 || idle_timeout < 0 ||
+        max_child_memory < 0 || reorder_rules < 0 || stall_threshold < 0) {
         print_usage();
         exit(1);
     }
 
-    /* Extract address */
-    address = g_strconcat("unix:path=", argv[1], NULL);
-    if (strcmp (argv[2], "system") == 0) {
-        bus = DBUS_BUS_SYSTEM;
-    } else if (strcmp(argv[2], "session") == 0) {
-        bus = DBUS_BUS_SESSION;
-    } else {
-        g_message("Must give bus type as second argument (either session or system).\n");
-        exit (1);
+    if (check) {
+        exit(check_config(argc > 1 ? argv[1] : NULL, max_cost));
+    }
+
+    introspect_configure(introspect_cache, introspect_prune);
+    properties_cache_configure(property_cache_size);
+    delivery_set_lanes(priority_lanes);
+    children_set_limits(max_clients, idle_timeout,
+                        (guint64) max_child_memory * 1024 * 1024);
+
+    /* Check for right number of args, addresses and bus types come in
+       pairs */
+    if (argc < 3 || (argc - 1) % 2 != 0) {
+        print_usage();
+        exit(1);
+    }
+
+    /* Extract addresses */
+    for (i = 1; i < argc; i += 2) {
+        if (!add_listener (argv[i], argv[i + 1])) {
+            g_message("Must give bus type after each address (either session or system).\n");
+            exit (1);
+        }
     }
 
     /* Setup log handlers, if needed, for g_message, g_warning etc.
@@ -869,33 +1742,52 @@ int main(int argc, char *argv[]) {
                       NULL /*no need to pass data to handler*/);
 #endif
 
-    /* Set set signal handler */
-    struct sigaction sa;
-    sa.sa_handler = &handle_sigchld;
-    sigemptyset(&sa.sa_mask);
-    sa.sa_flags = SA_RESTART | SA_NOCLDSTOP;
-    if (sigaction(SIGCHLD, &sa, 0) == -1) {
-        perror(0);
+    /* Children are reaped from the main loop */
+    children_registry_open(child_registry);
+
+    intern_well_known_names();
+
+    /* Opened before any client is accepted, so all proxy processes share
+       the log */
+    if (audit_log != NULL &&
+        !audit_open(audit_log, audit_sample, audit_reject_rate)) {
+        g_printerr("Could not open audit log %s\n", audit_log);
         exit(1);
     }
 
-    /* Remember what section of the config we should read later */
-    gpointer section = argv[2];
+    if (capture != NULL && !capture_open(capture, capture_messages)) {
+        g_printerr("Could not open capture %s\n", capture);
+        exit(1);
+    }
+
+    if (!latency_open(latency_log, stall_threshold, stall_log)) {
+        g_printerr("Could not open latency or stall log\n");
+        exit(1);
+    }
 
-	/* Start listening */
-	start_bus();
+    reorder_interval = reorder_rules;
+    if (rule_order_log != NULL) {
+        rule_order_fd = output_open(rule_order_log, "rule order log");
+        if (rule_order_fd < 0) {
+            g_printerr("Could not open rule order log %s\n", rule_order_log);
+            exit(1);
+        }
+    }
 
     g_message("Setting up event listener on stdin");
     GIOChannel *channel = g_io_channel_unix_new(STDIN_FILENO);
-    g_io_add_watch(channel,
-                   G_IO_IN | G_IO_PRI | G_IO_ERR | G_IO_HUP,
-                   (GIOFunc)stdin_watch,
-                   section);
+    stdin_watch_id = g_io_add_watch(channel,
+                                    G_IO_IN | G_IO_PRI | G_IO_ERR | G_IO_HUP,
+                                    framed_config ? (GIOFunc)stdin_frame_watch
+                                                  : (GIOFunc)stdin_watch,
+                                    NULL);
 
     g_message("Entering mainloop\n");
 
     /* Start listening */
-    start_bus();
+    for (iter = listeners; iter != NULL; iter = iter->next) {
+        start_bus ((ProxyListener *) iter->data);
+    }
     mainloop = g_main_loop_new(NULL /*use default context*/,
                                FALSE /*mainloop is not currently running*/);
     g_main_loop_run(mainloop);
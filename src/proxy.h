@@ -21,22 +21,53 @@
  * For further information see LICENSE
  */
 
+#ifndef DBUS_PROXY_PROXY_H
+#define DBUS_PROXY_PROXY_H
+
 #include <dbus/dbus.h>
 #include <dbus/dbus-glib.h>
 
+/*! A socket local clients connect to, and the bus it is a proxy for */
+typedef struct _ProxyListener ProxyListener;
+
 /*! \brief Listen for new connections
  *
- * Listen for new connections, and once a new connection is received send this
- * over to the new_connection_cb () callback function
+ * Listen for new connections on the socket of a listener, and once a new
+ * connection is received send this over to the new_connection_cb () callback
+ * function
  */
-void start_bus();
+void start_bus (ProxyListener *listener);
+
+/*! Header fields of a D-Bus message, read once per message.
+ *
+ * Interface and member are kept as quarks, so comparing them against
+ * well-known names and rule literals is an integer compare. Names in messages
+ * are not a bounded set and quarks are never freed, so they are only looked
+ * up: a name that was never interned has a 0 quark, and is kept as a string
+ * like the paths and bus names. A missing field is a NULL string.
+ */
+typedef struct {
+    int          type;
+    GQuark       interface;
+    GQuark       member;
+    const char  *interface_name;
+    const char  *member_name;
+    const char  *path;
+    const char  *destination;
+    const char  *sender;
+} MessageHeader;
+
+void message_header_read (MessageHeader *header, DBusMessage *msg);
 
 gboolean is_allowed (const char *direction, const char *interface,
                      const char *path, const char *member);
 gboolean is_conn_known_eavesdropper (const char *unique_name);
 gboolean remove_name_from_known_eavesdroppers (const char *unique_name);
-gboolean is_incoming_eavesdropping (DBusMessage *msg);
+gboolean is_incoming_eavesdropping (DBusMessage         *msg,
+                                    const MessageHeader *header);
 
 // External
 pid_t fork();
 pid_t getpid();
+
+#endif /* DBUS_PROXY_PROXY_H */
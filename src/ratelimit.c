@@ -0,0 +1,162 @@
+/*
+ * Copyright (C) 2013-2016, Pelagicore AB   <joakim.gross@pelagicore.com>
+ *
+ * This library is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU Lesser General Public
+ * License as published by the Free Software Foundation; either
+ * version 2.1 of the License, or (at your option) any later version.
+ *
+ * This library is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ * Lesser General Public License for more details.
+ *
+ * You should have received a copy of the GNU Lesser General Public
+ * License along with this library; if not, write to the
+ * Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+ * Boston, MA  02110-1301, USA.
+ *
+ * For further information see LICENSE
+ */
+
+
+#include "ratelimit.h"
+
+#include <string.h>
+
+#include <dbus/dbus.h>
+
+
+/*! \brief Read a rate from the config, 0 if it is missing or invalid */
+static gdouble parse_rate (const json_t *json)
+{
+    gdouble rate;
+
+    if (!json_is_number (json)) {
+        return 0;
+    }
+
+    rate = json_number_value (json);
+    return rate > 0 ? rate : 0;
+}
+
+gboolean rate_limit_spec_parse (RateLimitSpec *spec, const json_t *json)
+{
+    const json_t *action;
+    const json_t *error_name;
+
+    memset (spec, 0, sizeof (*spec));
+
+    if (!json_is_object (json)) {
+        return FALSE;
+    }
+
+    spec->messages_per_second = parse_rate (json_object_get (json, "messages-per-second"));
+    spec->bytes_per_second    = parse_rate (json_object_get (json, "bytes-per-second"));
+
+    action = json_object_get (json, "action");
+    if (json_is_string (action) &&
+        strcmp (json_string_value (action), "drop") == 0) {
+        spec->action = RATE_LIMIT_ACTION_DROP;
+    } else {
+        spec->action = RATE_LIMIT_ACTION_ERROR;
+    }
+
+    /* libdbus aborts on replying with an invalid error name */
+    error_name = json_object_get (json, "error");
+    if (error_name != NULL && !rate_limit_error_is_valid (json)) {
+        g_message("Ignoring rate-limit error that is not a valid error name\n");
+        error_name = NULL;
+    }
+    spec->error_name = g_quark_from_string (error_name != NULL
+                                                ? json_string_value (error_name)
+                                                : RATE_LIMIT_DEFAULT_ERROR);
+
+    return spec->messages_per_second > 0 || spec->bytes_per_second > 0;
+}
+
+gboolean rate_limit_error_is_valid (const json_t *json)
+{
+    const json_t *error_name = json_object_get (json, "error");
+
+    return error_name == NULL ||
+           (json_is_string (error_name) &&
+            dbus_validate_error_name (json_string_value (error_name), NULL));
+}
+
+gboolean rate_limit_spec_counts_bytes (const RateLimitSpec *spec)
+{
+    return spec != NULL && spec->bytes_per_second > 0;
+}
+
+static void token_bucket_init (TokenBucket *bucket, gdouble rate, gint64 now)
+{
+    bucket->rate        = rate;
+    bucket->tokens      = rate;
+    bucket->last_refill = now;
+}
+
+/*! \brief Refill a bucket for the time passed since the last refill
+ *
+ * \return TRUE if the bucket has tokens left, or has no rate at all
+ */
+static gboolean token_bucket_refill (TokenBucket *bucket, gint64 now)
+{
+    if (bucket->rate <= 0) {
+        return TRUE;
+    }
+
+    bucket->tokens += bucket->rate * (now - bucket->last_refill) / G_USEC_PER_SEC;
+    bucket->tokens  = MIN (bucket->tokens, bucket->rate);
+    bucket->last_refill = now;
+
+    return bucket->tokens > 0;
+}
+
+static void token_bucket_take (TokenBucket *bucket, gdouble amount)
+{
+    if (bucket->rate > 0) {
+        bucket->tokens -= amount;
+    }
+}
+
+void rate_limiter_init (RateLimiter *limiter, const RateLimitSpec *spec)
+{
+    gint64 now = g_get_monotonic_time ();
+
+    memset (limiter, 0, sizeof (*limiter));
+    limiter->spec = spec;
+
+    if (spec != NULL) {
+        token_bucket_init (&limiter->messages, spec->messages_per_second, now);
+        token_bucket_init (&limiter->bytes,    spec->bytes_per_second,    now);
+    }
+}
+
+gboolean rate_limiter_admit (RateLimiter *limiter, gsize size)
+{
+    gint64 now;
+
+    if (limiter->spec == NULL) {
+        return TRUE;
+    }
+
+    now = g_get_monotonic_time ();
+
+    /* Both buckets must have tokens before either is charged, so a message
+       refused by one does not use up tokens of the other */
+    if (!token_bucket_refill (&limiter->messages, now) ||
+        !token_bucket_refill (&limiter->bytes, now))
+    {
+        goto throttled;
+    }
+
+    token_bucket_take (&limiter->messages, 1);
+    token_bucket_take (&limiter->bytes, size);
+    return TRUE;
+
+throttled:
+    limiter->throttled_messages++;
+    limiter->throttled_bytes += size;
+    return FALSE;
+}
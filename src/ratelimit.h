@@ -0,0 +1,107 @@
+/*
+ * Copyright (C) 2013-2016, Pelagicore AB   <joakim.gross@pelagicore.com>
+ *
+ * This library is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU Lesser General Public
+ * License as published by the Free Software Foundation; either
+ * version 2.1 of the License, or (at your option) any later version.
+ *
+ * This library is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ * Lesser General Public License for more details.
+ *
+ * You should have received a copy of the GNU Lesser General Public
+ * License along with this library; if not, write to the
+ * Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+ * Boston, MA  02110-1301, USA.
+ *
+ * For further information see LICENSE
+ */
+
+#ifndef DBUS_PROXY_RATELIMIT_H
+#define DBUS_PROXY_RATELIMIT_H
+
+#include <glib.h>
+#include <jansson.h>
+
+/*! Error name of the reply to method calls over a limit, unless the config
+    gives another one */
+#define RATE_LIMIT_DEFAULT_ERROR "org.freedesktop.DBus.Error.LimitsExceeded"
+
+/*! What to do with a message over a limit */
+typedef enum {
+    /*! Reply to method calls with an error, drop other messages */
+    RATE_LIMIT_ACTION_ERROR = 0,
+    /*! Drop the message without a reply */
+    RATE_LIMIT_ACTION_DROP
+} RateLimitAction;
+
+/*! A limit as given in the config, a rate of 0 means no limit */
+typedef struct {
+    gdouble          messages_per_second;
+    gdouble          bytes_per_second;
+    RateLimitAction  action;
+    GQuark           error_name;
+} RateLimitSpec;
+
+/*! A token bucket, holding at most one second worth of its rate */
+typedef struct {
+    gdouble rate;
+    gdouble tokens;
+    gint64  last_refill;
+} TokenBucket;
+
+/*! The state of one limit in one proxy process */
+typedef struct {
+    const RateLimitSpec *spec;
+    TokenBucket          messages;
+    TokenBucket          bytes;
+    guint64              throttled_messages;
+    guint64              throttled_bytes;
+} RateLimiter;
+
+/*! \brief Parse a "rate-limit" object of the config
+ *
+ * The object has the optional members "messages-per-second",
+ * "bytes-per-second", "action" ("error" or "drop") and "error", the name of
+ * the error replied to method calls. An "error" that is not a valid D-Bus
+ * error name is ignored, with a warning.
+ *
+ * \param spec The limit to fill in
+ * \param json The JSON object
+ * \return FALSE if the object is not valid or does not limit anything
+ */
+gboolean rate_limit_spec_parse (RateLimitSpec *spec, const json_t *json);
+
+/*! \brief Test if the "error" of a "rate-limit" object is a valid D-Bus
+ *         error name
+ *
+ * \return TRUE if it is, or if the object has no "error"
+ */
+gboolean rate_limit_error_is_valid (const json_t *json);
+
+/*! \brief Test if a limit needs the size of each message */
+gboolean rate_limit_spec_counts_bytes (const RateLimitSpec *spec);
+
+/*! \brief Set up a limiter with full buckets
+ *
+ * \param limiter The limiter
+ * \param spec    The limit, NULL for a limiter that admits everything. It
+ *                must outlive the limiter.
+ */
+void rate_limiter_init (RateLimiter *limiter, const RateLimitSpec *spec);
+
+/*! \brief Charge a message against a limiter
+ *
+ * A message is admitted as long as the buckets are not empty, and may take
+ * them below zero. Messages larger than the burst are then admitted at the
+ * configured rate on average instead of never.
+ *
+ * \param limiter The limiter
+ * \param size    Size of the message in bytes, only used with a bytes limit
+ * \return TRUE if the message is admitted, FALSE if it is over the limit
+ */
+gboolean rate_limiter_admit (RateLimiter *limiter, gsize size);
+
+#endif /* DBUS_PROXY_RATELIMIT_H */
@@ -0,0 +1,1260 @@
+/*
+ * Copyright (C) 2013-2016, Pelagicore AB   <joakim.gross@pelagicore.com>
+ *
+ * This library is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU Lesser General Public
+ * License as published by the Free Software Foundation; either
+ * version 2.1 of the License, or (at your option) any later version.
+ *
+ * This library is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ * Lesser General Public License for more details.
+ *
+ * You should have received a copy of the GNU Lesser General Public
+ * License along with this library; if not, write to the
+ * Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+ * Boston, MA  02110-1301, USA.
+ *
+ * For further information see LICENSE
+ */
+
+
+#include "rules.h"
+#include "probes.h"
+
+#include <string.h>
+
+
+/*! Number of rule bits held by one bitset word */
+#define RULE_BITS_PER_WORD (sizeof (gulong) * 8)
+
+/*! Field values cached per field before the cache is flushed. Object paths
+    and names can be generated by clients and services, so the caches must
+    not grow unbounded. */
+#define RULE_CACHE_MAX_ENTRIES 4096
+
+
+/*! A compiled pattern. Patterns without wildcards are matched by comparing
+    interned strings, patterns of only '*' match anything and the others are
+    matched with a GPatternSpec. A pattern with none of these never matches
+    anything. */
+typedef struct {
+    GQuark        literal;
+    gboolean      match_all;
+    GPatternSpec *spec;
+
+    /*! The pattern as given in the config, in the string arena of the rule
+        set, or NULL for an empty pattern */
+    const gchar  *text;
+} RulePattern;
+
+/*! A single compiled rule. The method patterns and the rate limit point into
+    arrays of the rule set, so a rule owns no memory of its own. */
+typedef struct {
+    RulePattern  direction;
+    RulePattern  interface;
+    RulePattern  object_path;
+    RulePattern *methods;
+    guint        n_methods;
+
+    /*! The limit of the messages this rule allows, or NULL */
+    const RateLimitSpec *rate_limit;
+
+    /*! How long replies to the property reads this rule allows are cached,
+        in microseconds, or 0 */
+    gint64       property_cache_ttl;
+
+    /*! If the signals this rule allows are coalesced for slow clients */
+    gboolean     coalesce;
+
+    /*! The lane the messages this rule allows are sent to a client in */
+    RuleLane     lane;
+} Rule;
+
+struct _RuleSet {
+    gint        ref_count;
+
+    /*! The rules, and the method patterns and rate limits of all rules,
+        each in one array that is allocated when the set is compiled */
+    Rule          *rules;
+    guint          n_rules;
+    RulePattern   *methods;
+    guint          n_methods;
+    RateLimitSpec *rate_limits;
+    guint          n_rate_limits;
+    guint          n_words;
+
+    /*! The active order: the rule evaluated at each bit position of the
+        bitsets. It starts as the order of the config and is changed by
+        rule_set_reorder(). */
+    guint         *order;
+
+    /*! Per rule: the messages it decided since the last reorder */
+    guint64       *hits;
+
+    /*! Arena of the pattern texts, each distinct text is stored once */
+    GStringChunk  *strings;
+
+    /*! Set when compiling stopped at an entry that is not a rule object, the
+        rules appended after it are never evaluated */
+    gboolean       stopped;
+
+    /*! Per field: field value -> bitset of the rules matching the value.
+        Values with a quark are cached on the quark, object paths and names
+        that are not interned on the string. */
+    GHashTable *quark_cache[RULE_FIELD_COUNT];
+    GHashTable *name_cache[RULE_FIELD_COUNT];
+};
+
+
+/*! \brief Compile one pattern of a rule
+ *
+ * Missing and empty patterns can never match, and are compiled to an empty
+ * pattern.
+ *
+ * \param string The pattern, or NULL
+ * \return TRUE if the pattern can match anything
+ */
+static gboolean compile_pattern_text (RuleSet     *rule_set,
+                                      RulePattern *pattern,
+                                      const char  *string)
+{
+    if (string == NULL || strcmp (string, "") == 0) {
+        return FALSE;
+    }
+
+    pattern->text = g_string_chunk_insert_const (rule_set->strings, string);
+
+    if (strpbrk (string, "*?") == NULL) {
+        pattern->literal = g_quark_from_string (string);
+    } else if (strspn (string, "*") == strlen (string)) {
+        pattern->match_all = TRUE;
+    } else {
+        pattern->spec = g_pattern_spec_new (string);
+    }
+
+    return TRUE;
+}
+
+/*! \brief Compile one string pattern of a rule
+ *
+ * Fields that are not strings can never match, and are compiled to an empty
+ * pattern.
+ *
+ * \return TRUE if the pattern can match anything
+ */
+static gboolean compile_pattern (RuleSet      *rule_set,
+                                 RulePattern  *pattern,
+                                 const json_t *json_entry)
+{
+    return compile_pattern_text (rule_set, pattern,
+                                 json_is_string (json_entry)
+                                     ? json_string_value (json_entry)
+                                     : NULL);
+}
+
+/*! \brief Number of method patterns a rule may compile to */
+static size_t count_methods (const json_t *json_entry)
+{
+    if (json_is_string (json_entry)) {
+        return 1;
+    }
+
+    return json_is_array (json_entry) ? json_array_size (json_entry) : 0;
+}
+
+/*! \brief Compile the method field of a rule
+ *
+ * Method is either a string or an array of strings. When an array contains
+ * something that is not a string, the entries from that point on can never
+ * match and are left out. The patterns are added to the method array of the
+ * rule set.
+ */
+static void compile_methods (RuleSet *rule_set, Rule *rule, const json_t *json_entry)
+{
+    size_t  ix;
+    json_t *val;
+
+    rule->methods = &rule_set->methods[rule_set->n_methods];
+
+    if (json_is_string (json_entry)) {
+        if (compile_pattern (rule_set, &rule->methods[0], json_entry)) {
+            rule->n_methods = 1;
+        }
+    } else if (json_is_array (json_entry)) {
+        json_array_foreach (json_entry, ix, val) {
+            if (!json_is_string (val)) {
+                break;
+            }
+
+            if (compile_pattern (rule_set, &rule->methods[rule->n_methods], val)) {
+                rule->n_methods++;
+            }
+        }
+    }
+
+    rule_set->n_methods += rule->n_methods;
+}
+
+/*! \brief Compile the optional "rate-limit" object of a rule */
+static void compile_rate_limit (RuleSet *rule_set, Rule *rule, const json_t *json_entry)
+{
+    RateLimitSpec *spec;
+
+    if (json_entry == NULL) {
+        return;
+    }
+
+    spec = &rule_set->rate_limits[rule_set->n_rate_limits];
+    if (!rate_limit_spec_parse (spec, json_entry)) {
+        g_message("Ignoring rate-limit that does not limit anything\n");
+        return;
+    }
+
+    rule->rate_limit = spec;
+    rule_set->n_rate_limits++;
+}
+
+/*! \brief Compile the optional "property-cache" object of a rule
+ *
+ * The object may give the "ttl" of cached replies in seconds, which
+ * defaults to RULE_PROPERTY_CACHE_DEFAULT_TTL.
+ */
+static void compile_property_cache (Rule *rule, const json_t *json_entry)
+{
+    const json_t *ttl;
+
+    if (!json_is_object (json_entry)) {
+        return;
+    }
+
+    ttl = json_object_get (json_entry, "ttl");
+    if (ttl == NULL) {
+        rule->property_cache_ttl = RULE_PROPERTY_CACHE_DEFAULT_TTL * G_USEC_PER_SEC;
+    } else if (json_is_number (ttl) && json_number_value (ttl) > 0) {
+        rule->property_cache_ttl = json_number_value (ttl) * G_USEC_PER_SEC;
+    } else {
+        g_message("Ignoring property-cache with invalid ttl\n");
+    }
+}
+
+/*! \brief Compile the optional "coalesce" flag of a rule */
+static void compile_coalesce (Rule *rule, const json_t *json_entry)
+{
+    if (json_entry == NULL) {
+        return;
+    }
+
+    if (json_is_boolean (json_entry)) {
+        rule->coalesce = json_is_true (json_entry);
+    } else {
+        g_message("Ignoring coalesce that is not true or false\n");
+    }
+}
+
+/*! The names of the lanes in the config, by RuleLane */
+static const char *lane_names[RULE_LANE_COUNT] = { "reply", "call", "signal" };
+
+/*! \brief Compile the optional "lane" of a rule */
+static void compile_lane (Rule *rule, const json_t *json_entry)
+{
+    RuleLane lane;
+
+    rule->lane = RULE_LANE_NONE;
+    if (json_entry == NULL) {
+        return;
+    }
+
+    for (lane = 0; lane < RULE_LANE_COUNT; lane++) {
+        if (json_is_string (json_entry) &&
+            strcmp (json_string_value (json_entry), lane_names[lane]) == 0) {
+            rule->lane = lane;
+            return;
+        }
+    }
+    g_message("Ignoring lane that is not \"reply\", \"call\" or \"signal\"\n");
+}
+
+/*! \brief Copy a compiled rule of another rule set
+ *
+ * The patterns are compiled again from their texts, since a GPatternSpec
+ * can not be shared or copied.
+ */
+static void copy_rule (RuleSet *rule_set, Rule *rule, const Rule *other)
+{
+    RateLimitSpec *spec;
+    guint          m;
+
+    compile_pattern_text (rule_set, &rule->direction,   other->direction.text);
+    compile_pattern_text (rule_set, &rule->interface,   other->interface.text);
+    compile_pattern_text (rule_set, &rule->object_path, other->object_path.text);
+
+    rule->methods   = &rule_set->methods[rule_set->n_methods];
+    rule->n_methods = other->n_methods;
+    for (m = 0; m < other->n_methods; m++) {
+        compile_pattern_text (rule_set, &rule->methods[m], other->methods[m].text);
+    }
+    rule_set->n_methods += rule->n_methods;
+
+    if (other->rate_limit != NULL) {
+        spec  = &rule_set->rate_limits[rule_set->n_rate_limits++];
+        *spec = *other->rate_limit;
+        rule->rate_limit = spec;
+    }
+
+    rule->property_cache_ttl = other->property_cache_ttl;
+    rule->coalesce           = other->coalesce;
+    rule->lane               = other->lane;
+}
+
+RuleSet *rule_set_new (const json_t *rules)
+{
+    return rule_set_append (NULL, rules);
+}
+
+RuleSet *rule_set_append (const RuleSet *base, const json_t *rules)
+{
+    RuleSet *rule_set;
+    json_t  *rule;
+    size_t   size = 0;
+    size_t   n_methods;
+    size_t   n_rate_limits;
+    size_t   i;
+    guint    field;
+
+    /* Messages are evaluated with their direction looked up as a quark,
+       which has to exist even when no rule names the direction */
+    g_quark_from_static_string ("outgoing");
+    g_quark_from_static_string ("incoming");
+
+    rule_set = g_new0 (RuleSet, 1);
+    rule_set->ref_count = 1;
+    rule_set->strings   = g_string_chunk_new (1024);
+    rule_set->stopped   = base != NULL && base->stopped;
+
+    n_methods     = base != NULL ? base->n_methods     : 0;
+    n_rate_limits = base != NULL ? base->n_rate_limits : 0;
+
+    /* Size the arrays before compiling, so the rules can point into them */
+    if (!rule_set->stopped && json_is_array (rules)) {
+        for (size = 0; size < json_array_size (rules); size++) {
+            rule = json_array_get (rules, size);
+            if (rule == NULL || !json_is_object (rule)) {
+                rule_set->stopped = TRUE;
+                break;
+            }
+
+            n_methods += count_methods (json_object_get (rule, "method"));
+            if (json_object_get (rule, "rate-limit") != NULL) {
+                n_rate_limits++;
+            }
+        }
+    }
+
+    rule_set->rules       = g_new0 (Rule, MAX (rule_set_size (base) + size, 1));
+    rule_set->methods     = g_new0 (RulePattern, MAX (n_methods, 1));
+    rule_set->rate_limits = g_new0 (RateLimitSpec, MAX (n_rate_limits, 1));
+
+    for (i = 0; i < rule_set_size (base); i++) {
+        copy_rule (rule_set, &rule_set->rules[rule_set->n_rules++], &base->rules[i]);
+    }
+
+    for (i = 0; i < size; i++) {
+        rule = json_array_get (rules, i);
+
+        Rule *compiled = &rule_set->rules[rule_set->n_rules++];
+        compile_pattern (rule_set, &compiled->direction,   json_object_get (rule, "direction"));
+        compile_pattern (rule_set, &compiled->interface,   json_object_get (rule, "interface"));
+        compile_pattern (rule_set, &compiled->object_path, json_object_get (rule, "object-path"));
+        compile_methods (rule_set, compiled, json_object_get (rule, "method"));
+        compile_rate_limit (rule_set, compiled, json_object_get (rule, "rate-limit"));
+        compile_property_cache (compiled, json_object_get (rule, "property-cache"));
+        compile_coalesce (compiled, json_object_get (rule, "coalesce"));
+        compile_lane (compiled, json_object_get (rule, "lane"));
+    }
+
+    rule_set->n_words = (rule_set->n_rules + RULE_BITS_PER_WORD - 1) /
+                        RULE_BITS_PER_WORD;
+
+    rule_set->order = g_new (guint, MAX (rule_set->n_rules, 1));
+    rule_set->hits  = g_new0 (guint64, MAX (rule_set->n_rules, 1));
+    for (i = 0; i < rule_set->n_rules; i++) {
+        rule_set->order[i] = i;
+    }
+
+    for (field = 0; field < RULE_FIELD_COUNT; field++) {
+        rule_set->quark_cache[field] = g_hash_table_new_full (g_direct_hash,
+                                                              g_direct_equal,
+                                                              NULL,
+                                                              g_free);
+        rule_set->name_cache[field]  = g_hash_table_new_full (g_str_hash,
+                                                              g_str_equal,
+                                                              g_free,
+                                                              g_free);
+    }
+
+    return rule_set;
+}
+
+RuleSet *rule_set_ref (RuleSet *rule_set)
+{
+    rule_set->ref_count++;
+    return rule_set;
+}
+
+static void rule_pattern_clear (RulePattern *pattern)
+{
+    g_clear_pointer (&pattern->spec, g_pattern_spec_free);
+}
+
+void rule_set_unref (RuleSet *rule_set)
+{
+    guint i;
+
+    if (rule_set == NULL || --rule_set->ref_count > 0) {
+        return;
+    }
+
+    for (i = 0; i < rule_set->n_rules; i++) {
+        rule_pattern_clear (&rule_set->rules[i].direction);
+        rule_pattern_clear (&rule_set->rules[i].interface);
+        rule_pattern_clear (&rule_set->rules[i].object_path);
+    }
+    for (i = 0; i < rule_set->n_methods; i++) {
+        rule_pattern_clear (&rule_set->methods[i]);
+    }
+    g_free (rule_set->rules);
+    g_free (rule_set->methods);
+    g_free (rule_set->rate_limits);
+    g_free (rule_set->order);
+    g_free (rule_set->hits);
+    g_string_chunk_free (rule_set->strings);
+
+    for (i = 0; i < RULE_FIELD_COUNT; i++) {
+        g_hash_table_destroy (rule_set->quark_cache[i]);
+        g_hash_table_destroy (rule_set->name_cache[i]);
+    }
+
+    g_free (rule_set);
+}
+
+guint rule_set_size (const RuleSet *rule_set)
+{
+    return rule_set != NULL ? rule_set->n_rules : 0;
+}
+
+static gboolean rule_pattern_equal (const RulePattern *pattern,
+                                    const RulePattern *other)
+{
+    return g_strcmp0 (pattern->text, other->text) == 0;
+}
+
+gboolean rule_set_equal (const RuleSet *rule_set, const RuleSet *other)
+{
+    const Rule *rule, *other_rule;
+    guint       i, m;
+
+    if (rule_set_size (rule_set) != rule_set_size (other) ||
+        (rule_set != NULL && other != NULL && rule_set->stopped != other->stopped))
+    {
+        return FALSE;
+    }
+
+    for (i = 0; i < rule_set_size (rule_set); i++) {
+        rule       = &rule_set->rules[i];
+        other_rule = &other->rules[i];
+
+        if (!rule_pattern_equal (&rule->direction,   &other_rule->direction)   ||
+            !rule_pattern_equal (&rule->interface,   &other_rule->interface)   ||
+            !rule_pattern_equal (&rule->object_path, &other_rule->object_path) ||
+            rule->n_methods != other_rule->n_methods                           ||
+            rule->property_cache_ttl != other_rule->property_cache_ttl         ||
+            rule->coalesce != other_rule->coalesce                             ||
+            rule->lane != other_rule->lane                                     ||
+            (rule->rate_limit == NULL) != (other_rule->rate_limit == NULL))
+        {
+            return FALSE;
+        }
+
+        for (m = 0; m < rule->n_methods; m++) {
+            if (!rule_pattern_equal (&rule->methods[m], &other_rule->methods[m])) {
+                return FALSE;
+            }
+        }
+
+        if (rule->rate_limit != NULL &&
+            (rule->rate_limit->messages_per_second != other_rule->rate_limit->messages_per_second ||
+             rule->rate_limit->bytes_per_second    != other_rule->rate_limit->bytes_per_second    ||
+             rule->rate_limit->action              != other_rule->rate_limit->action              ||
+             rule->rate_limit->error_name          != other_rule->rate_limit->error_name))
+        {
+            return FALSE;
+        }
+    }
+
+    return TRUE;
+}
+
+const RateLimitSpec *rule_set_rate_limit (const RuleSet *rule_set, gint rule_index)
+{
+    if (rule_index < 0 || (guint) rule_index >= rule_set_size (rule_set)) {
+        return NULL;
+    }
+
+    return rule_set->rules[rule_index].rate_limit;
+}
+
+gint64 rule_set_property_cache_ttl (const RuleSet *rule_set, gint rule_index)
+{
+    if (rule_index < 0 || (guint) rule_index >= rule_set_size (rule_set)) {
+        return 0;
+    }
+
+    return rule_set->rules[rule_index].property_cache_ttl;
+}
+
+gboolean rule_set_coalesce (const RuleSet *rule_set, gint rule_index)
+{
+    if (rule_index < 0 || (guint) rule_index >= rule_set_size (rule_set)) {
+        return FALSE;
+    }
+
+    return rule_set->rules[rule_index].coalesce;
+}
+
+RuleLane rule_set_lane (const RuleSet *rule_set, gint rule_index)
+{
+    if (rule_index < 0 || (guint) rule_index >= rule_set_size (rule_set)) {
+        return RULE_LANE_NONE;
+    }
+
+    return rule_set->rules[rule_index].lane;
+}
+
+/*! \brief Match a field value against a compiled pattern
+ *
+ * \param pattern The compiled pattern
+ * \param quark   The value as a quark, or 0 if the value is not interned
+ * \param value   The value as a string
+ */
+static gboolean rule_pattern_matches (const RulePattern *pattern,
+                                      GQuark             quark,
+                                      const char        *value)
+{
+    if (pattern->literal != 0) {
+        return quark == pattern->literal;
+    }
+
+    if (pattern->match_all) {
+        return TRUE;
+    }
+
+    return pattern->spec != NULL &&
+           g_pattern_match_string (pattern->spec, value);
+}
+
+static gboolean rule_field_matches (const Rule *rule,
+                                    RuleField   field,
+                                    GQuark      quark,
+                                    const char *value)
+{
+    guint i;
+
+    switch (field) {
+    case RULE_FIELD_DIRECTION:
+        return rule_pattern_matches (&rule->direction, quark, value);
+    case RULE_FIELD_INTERFACE:
+        return rule_pattern_matches (&rule->interface, quark, value);
+    case RULE_FIELD_OBJECT_PATH:
+        return rule_pattern_matches (&rule->object_path, quark, value);
+    case RULE_FIELD_METHOD:
+        for (i = 0; i < rule->n_methods; i++) {
+            if (rule_pattern_matches (&rule->methods[i], quark, value)) {
+                return TRUE;
+            }
+        }
+        return FALSE;
+    default:
+        return FALSE;
+    }
+}
+
+static gboolean rule_pattern_is_empty (const RulePattern *pattern)
+{
+    return pattern->literal == 0 && !pattern->match_all && pattern->spec == NULL;
+}
+
+RuleVerdict rule_set_analyze (const RuleSet *rule_set, const char *direction)
+{
+    GQuark   quark = g_quark_try_string (direction);
+    gboolean can_match = FALSE;
+    gboolean needs_rule = FALSE;
+    guint    i, m;
+
+    for (i = 0; i < rule_set_size (rule_set); i++) {
+        const Rule *rule = &rule_set->rules[i];
+
+        if (!rule_pattern_matches (&rule->direction, quark, direction) ||
+            rule_pattern_is_empty (&rule->interface)                    ||
+            rule_pattern_is_empty (&rule->object_path)                  ||
+            rule->n_methods == 0)
+        {
+            continue;
+        }
+
+        can_match = TRUE;
+
+        /* The rule a message matches decides which limit it is charged
+           against, if its reply is cached and how it is sent, so the rules
+           have to be evaluated */
+        if (rule->rate_limit != NULL || rule->property_cache_ttl > 0 ||
+            rule->coalesce || rule->lane != RULE_LANE_NONE) {
+            needs_rule = TRUE;
+        }
+
+        if (needs_rule ||
+            !rule->interface.match_all || !rule->object_path.match_all) {
+            continue;
+        }
+
+        for (m = 0; m < rule->n_methods; m++) {
+            if (rule->methods[m].match_all) {
+                return RULE_VERDICT_ALLOW_ALL;
+            }
+        }
+    }
+
+    return can_match ? RULE_VERDICT_FILTER : RULE_VERDICT_DENY_ALL;
+}
+
+/*! \brief Test if every value matched by one pattern is matched by another
+ *
+ * Two different wildcard patterns are assumed not to cover each other,
+ * so shadowing by them is not detected.
+ */
+static gboolean rule_pattern_covers (const RulePattern *pattern,
+                                     const RulePattern *other)
+{
+    if (rule_pattern_is_empty (other) || pattern->match_all) {
+        return TRUE;
+    }
+
+    if (other->literal != 0) {
+        return rule_pattern_matches (pattern,
+                                     other->literal,
+                                     g_quark_to_string (other->literal));
+    }
+
+    return pattern->spec != NULL && !other->match_all &&
+           pattern->text == other->text;
+}
+
+gboolean rule_set_rule_can_match (const RuleSet *rule_set, guint index)
+{
+    const Rule *rule;
+    GQuark      outgoing = g_quark_from_static_string ("outgoing");
+    GQuark      incoming = g_quark_from_static_string ("incoming");
+
+    if (index >= rule_set_size (rule_set)) {
+        return FALSE;
+    }
+
+    rule = &rule_set->rules[index];
+    return (rule_pattern_matches (&rule->direction, outgoing, "outgoing") ||
+            rule_pattern_matches (&rule->direction, incoming, "incoming")) &&
+           !rule_pattern_is_empty (&rule->interface)                         &&
+           !rule_pattern_is_empty (&rule->object_path)                       &&
+           rule->n_methods > 0;
+}
+
+gint rule_set_shadowing_rule (const RuleSet *rule_set, guint index)
+{
+    const Rule *rule;
+    const Rule *earlier;
+    gboolean    covered;
+    guint       i, m, n;
+
+    if (index >= rule_set_size (rule_set)) {
+        return -1;
+    }
+
+    rule = &rule_set->rules[index];
+
+    for (i = 0; i < index; i++) {
+        earlier = &rule_set->rules[i];
+
+        if (!rule_pattern_covers (&earlier->direction,   &rule->direction) ||
+            !rule_pattern_covers (&earlier->interface,   &rule->interface) ||
+            !rule_pattern_covers (&earlier->object_path, &rule->object_path))
+        {
+            continue;
+        }
+
+        covered = TRUE;
+        for (m = 0; m < rule->n_methods && covered; m++) {
+            covered = FALSE;
+            for (n = 0; n < earlier->n_methods && !covered; n++) {
+                covered = rule_pattern_covers (&earlier->methods[n],
+                                               &rule->methods[m]);
+            }
+        }
+
+        if (covered) {
+            return i;
+        }
+    }
+
+    return -1;
+}
+
+static void rule_pattern_cost (const RulePattern *pattern, RuleSetCost *cost)
+{
+    if (pattern->spec != NULL) {
+        cost->glob_matches++;
+    } else if (!rule_pattern_is_empty (pattern)) {
+        cost->compares++;
+    }
+}
+
+void rule_set_cost (const RuleSet *rule_set, RuleSetCost *cost)
+{
+    guint i, m;
+
+    memset (cost, 0, sizeof (*cost));
+
+    for (i = 0; i < rule_set_size (rule_set); i++) {
+        const Rule *rule = &rule_set->rules[i];
+
+        rule_pattern_cost (&rule->direction,   cost);
+        rule_pattern_cost (&rule->interface,   cost);
+        rule_pattern_cost (&rule->object_path, cost);
+        for (m = 0; m < rule->n_methods; m++) {
+            rule_pattern_cost (&rule->methods[m], cost);
+        }
+    }
+
+    cost->bitset_words = rule_set != NULL ? rule_set->n_words * RULE_FIELD_COUNT : 0;
+}
+
+static void rule_pattern_describe (const RulePattern *pattern, GString *out)
+{
+    if (pattern->literal != 0) {
+        g_string_append_printf (out, "'%s' (literal)", pattern->text);
+    } else if (pattern->match_all) {
+        g_string_append_printf (out, "'%s' (any)", pattern->text);
+    } else if (pattern->spec != NULL) {
+        g_string_append_printf (out, "'%s' (glob)", pattern->text);
+    } else {
+        g_string_append (out, "(never)");
+    }
+}
+
+void rule_set_describe (const RuleSet *rule_set, GString *out)
+{
+    guint *positions;
+    guint  i, m;
+
+    g_string_append_printf (out,
+                            "%u rules, %u bitset words per field, "
+                            "at most %u cached values per field\n",
+                            rule_set_size (rule_set),
+                            rule_set != NULL ? rule_set->n_words : 0,
+                            RULE_CACHE_MAX_ENTRIES);
+
+    positions = g_new0 (guint, MAX (rule_set_size (rule_set), 1));
+    for (i = 0; i < rule_set_size (rule_set); i++) {
+        positions[rule_set->order[i]] = i;
+    }
+
+    for (i = 0; i < rule_set_size (rule_set); i++) {
+        const Rule *rule = &rule_set->rules[i];
+
+        g_string_append_printf (out, "  #%u word %u bit %u: direction ",
+                                i,
+                                (guint) (positions[i] / RULE_BITS_PER_WORD),
+                                (guint) (positions[i] % RULE_BITS_PER_WORD));
+        rule_pattern_describe (&rule->direction, out);
+        g_string_append (out, ", interface ");
+        rule_pattern_describe (&rule->interface, out);
+        g_string_append (out, ", object-path ");
+        rule_pattern_describe (&rule->object_path, out);
+        g_string_append (out, ", method [");
+        for (m = 0; m < rule->n_methods; m++) {
+            if (m > 0) {
+                g_string_append (out, ", ");
+            }
+            rule_pattern_describe (&rule->methods[m], out);
+        }
+        g_string_append_c (out, ']');
+        if (rule->rate_limit != NULL) {
+            g_string_append (out, ", rate limited");
+        }
+        if (rule->property_cache_ttl > 0) {
+            g_string_append (out, ", caches properties");
+        }
+        if (rule->coalesce) {
+            g_string_append (out, ", coalesces signals");
+        }
+        if (rule->lane != RULE_LANE_NONE) {
+            g_string_append_printf (out, ", %s lane", lane_names[rule->lane]);
+        }
+        g_string_append_c (out, '\n');
+    }
+
+    g_free (positions);
+}
+
+/*! \brief Length of the text after the last wildcard of a pattern */
+static gsize rule_pattern_fixed_suffix (const char *text)
+{
+    gsize length = strlen (text);
+    gsize suffix = 0;
+
+    while (suffix < length && strchr ("*?", text[length - suffix - 1]) == NULL) {
+        suffix++;
+    }
+
+    return suffix;
+}
+
+/*! \brief Test if no value can match both of two patterns
+ *
+ * Only disjoint patterns that are easy to prove are found: two different
+ * literals, a literal the other pattern does not match, and wildcard
+ * patterns whose texts before the first or after the last wildcard can not
+ * both start or end one value.
+ */
+static gboolean rule_pattern_disjoint (const RulePattern *pattern,
+                                       const RulePattern *other)
+{
+    gsize length, other_length, prefix, other_prefix, suffix;
+
+    if (rule_pattern_is_empty (pattern) || rule_pattern_is_empty (other)) {
+        return TRUE;
+    }
+
+    if (pattern->match_all || other->match_all) {
+        return FALSE;
+    }
+
+    if (pattern->literal != 0 && other->literal != 0) {
+        return pattern->literal != other->literal;
+    }
+
+    if (pattern->literal != 0) {
+        return !g_pattern_match_string (other->spec, pattern->text);
+    }
+
+    if (other->literal != 0) {
+        return !g_pattern_match_string (pattern->spec, other->text);
+    }
+
+    prefix       = strcspn (pattern->text, "*?");
+    other_prefix = strcspn (other->text, "*?");
+    suffix       = MIN (rule_pattern_fixed_suffix (pattern->text),
+                        rule_pattern_fixed_suffix (other->text));
+    length       = strlen (pattern->text);
+    other_length = strlen (other->text);
+
+    return strncmp (pattern->text, other->text, MIN (prefix, other_prefix)) != 0 ||
+           strncmp (pattern->text + length - suffix,
+                    other->text + other_length - suffix,
+                    suffix) != 0;
+}
+
+/*! \brief Test if no message can match both of two rules */
+static gboolean rules_disjoint (const Rule *rule, const Rule *other)
+{
+    guint m, n;
+
+    if (rule_pattern_disjoint (&rule->direction,   &other->direction) ||
+        rule_pattern_disjoint (&rule->interface,   &other->interface) ||
+        rule_pattern_disjoint (&rule->object_path, &other->object_path))
+    {
+        return TRUE;
+    }
+
+    for (m = 0; m < rule->n_methods; m++) {
+        for (n = 0; n < other->n_methods; n++) {
+            if (!rule_pattern_disjoint (&rule->methods[m], &other->methods[n])) {
+                return FALSE;
+            }
+        }
+    }
+
+    return TRUE;
+}
+
+/*! \brief Test if two rules decide the same on every message
+ *
+ * Every rule allows what it matches, so rules only decide differently by
+ * the rate limit a message is charged against, how long replies are cached,
+ * if signals are coalesced and which lane they are sent in. Each rule has a
+ * limiter of its own, so two rules with rate limits never decide the same.
+ */
+static gboolean rules_decide_the_same (const Rule *rule, const Rule *other)
+{
+    return rule->rate_limit == NULL && other->rate_limit == NULL &&
+           rule->property_cache_ttl == other->property_cache_ttl &&
+           rule->coalesce           == other->coalesce &&
+           rule->lane               == other->lane;
+}
+
+gboolean rule_set_reorder (RuleSet *rule_set)
+{
+    gboolean changed = FALSE;
+    guint    i, j, index, earlier;
+    guint    field;
+
+    if (rule_set == NULL) {
+        return FALSE;
+    }
+
+    /* An insertion sort on the hits. Swapping two neighbours in the order
+       can only change the rule that decides a message both match, so a rule
+       moves before its neighbour only when no message matches both or when
+       both decide the same. A sequence of such swaps decides every message
+       as the order of the config does. */
+    for (i = 1; i < rule_set->n_rules; i++) {
+        index = rule_set->order[i];
+
+        for (j = i; j > 0; j--) {
+            earlier = rule_set->order[j - 1];
+
+            if (rule_set->hits[index] <= rule_set->hits[earlier] ||
+                (!rules_disjoint (&rule_set->rules[index], &rule_set->rules[earlier]) &&
+                 !rules_decide_the_same (&rule_set->rules[index], &rule_set->rules[earlier])))
+            {
+                break;
+            }
+
+            rule_set->order[j] = earlier;
+            changed = TRUE;
+        }
+
+        rule_set->order[j] = index;
+    }
+
+    /* Older hits count for less, so the order follows the traffic */
+    for (i = 0; i < rule_set->n_rules; i++) {
+        rule_set->hits[i] /= 2;
+    }
+
+    /* The cached bitsets are in the old order */
+    if (changed) {
+        for (field = 0; field < RULE_FIELD_COUNT; field++) {
+            g_hash_table_remove_all (rule_set->quark_cache[field]);
+            g_hash_table_remove_all (rule_set->name_cache[field]);
+        }
+    }
+
+    return changed;
+}
+
+guint rule_set_active_rule (const RuleSet *rule_set, guint position)
+{
+    return rule_set->order[position];
+}
+
+guint64 rule_set_hits (const RuleSet *rule_set, guint index)
+{
+    return index < rule_set_size (rule_set) ? rule_set->hits[index] : 0;
+}
+
+/*! \brief Get the bitset of rules matching a field value
+ *
+ * The bitset is computed once per distinct value and then served from the
+ * cache of the field. Bit i is set when the rule at position i of the active
+ * order matches. The returned bitset stays valid until the next call
+ * for the same field.
+ *
+ * \param quark The value as a quark, or 0 when it is not interned
+ * \param value The value as a string, used when there is no quark
+ */
+static const gulong *rule_set_field_bits (RuleSet    *rule_set,
+                                          RuleField   field,
+                                          GQuark      quark,
+                                          const char *value)
+{
+    GHashTable *cache;
+    gpointer    key;
+    gulong     *bits;
+    guint       i;
+
+    if (field != RULE_FIELD_OBJECT_PATH && quark != 0) {
+        cache = rule_set->quark_cache[field];
+        key   = GUINT_TO_POINTER (quark);
+    } else {
+        cache = rule_set->name_cache[field];
+        key   = (gpointer) value;
+    }
+
+    bits = g_hash_table_lookup (cache, key);
+    if (bits != NULL) {
+        return bits;
+    }
+
+    if (g_hash_table_size (cache) >= RULE_CACHE_MAX_ENTRIES) {
+        g_hash_table_remove_all (cache);
+    }
+
+    /* Literal patterns are all interned, so a value that is not interned
+       can only be matched by wildcard patterns */
+    if (cache == rule_set->name_cache[field]) {
+        quark = g_quark_try_string (value);
+        key   = g_strdup (value);
+    } else {
+        value = g_quark_to_string (quark);
+    }
+
+    bits = g_new0 (gulong, rule_set->n_words);
+    for (i = 0; i < rule_set->n_rules; i++) {
+        if (rule_field_matches (&rule_set->rules[rule_set->order[i]],
+                                field, quark, value)) {
+            bits[i / RULE_BITS_PER_WORD] |= 1UL << (i % RULE_BITS_PER_WORD);
+        }
+    }
+
+    g_hash_table_insert (cache, key, bits);
+    return bits;
+}
+
+/*! \brief Find the first rule in the active order that matches a message
+ *
+ * \param scanned        Set to the number of rules looked at
+ * \param direction_miss Set when a rule matches everything but the direction
+ * \return The index of the rule, or -1 if no rule matches
+ */
+static gint rule_set_first_match (RuleSet    *rule_set,
+                                  GQuark      direction,
+                                  GQuark      interface,
+                                  const char *interface_name,
+                                  const char *path,
+                                  GQuark      member,
+                                  const char *member_name,
+                                  guint      *scanned,
+                                  gboolean   *direction_miss)
+{
+    const gulong *direction_bits, *interface_bits, *path_bits, *method_bits;
+    guint         w;
+
+    *scanned        = 0;
+    *direction_miss = FALSE;
+
+    /* Nothing matches a missing header field, and without rules
+       nothing is allowed */
+    if (rule_set == NULL || rule_set->n_rules == 0 ||
+        direction == 0 || interface_name == NULL ||
+        path == NULL || member_name == NULL)
+    {
+        return -1;
+    }
+
+    direction_bits = rule_set_field_bits (rule_set, RULE_FIELD_DIRECTION,   direction, NULL);
+    interface_bits = rule_set_field_bits (rule_set, RULE_FIELD_INTERFACE,   interface, interface_name);
+    path_bits      = rule_set_field_bits (rule_set, RULE_FIELD_OBJECT_PATH, 0,         path);
+    method_bits    = rule_set_field_bits (rule_set, RULE_FIELD_METHOD,      member,    member_name);
+
+    /* The lowest bit set in all four bitsets is the first matching rule in
+       the active order */
+    for (w = 0; w < rule_set->n_words; w++) {
+        gulong others = interface_bits[w] & path_bits[w] & method_bits[w];
+        gulong match  = direction_bits[w] & others;
+
+        if (match != 0) {
+            /* The rules in the words before the match, and in its word */
+            *scanned = MIN ((w + 1) * RULE_BITS_PER_WORD, rule_set->n_rules);
+            return rule_set->order[w * RULE_BITS_PER_WORD +
+                                   g_bit_nth_lsf (match, -1)];
+        }
+
+        if (others != 0) {
+            *direction_miss = TRUE;
+        }
+    }
+
+    *scanned = rule_set->n_rules;
+    return -1;
+}
+
+gboolean rule_set_is_allowed (RuleSet    *rule_set,
+                              GQuark      direction,
+                              GQuark      interface,
+                              const char *interface_name,
+                              const char *path,
+                              GQuark      member,
+                              const char *member_name,
+                              gint       *rule_index)
+{
+    gboolean direction_miss;
+    guint    scanned;
+    gint     index;
+
+    index = rule_set_first_match (rule_set, direction,
+                                  interface, interface_name, path,
+                                  member, member_name,
+                                  &scanned, &direction_miss);
+    if (rule_index != NULL) {
+        *rule_index = index;
+    }
+
+    PROBE3 (rule__evaluated, index, scanned, rule_set_size (rule_set));
+
+    if (index >= 0) {
+        rule_set->hits[index]++;
+        return TRUE;
+    }
+
+    /*
+     * Since direction seems to be a common source of errors, the
+     * following printout is added as a helper to developer
+     */
+    if (direction_miss) {
+        g_message("Direction '%s' does not match but "
+                  "everything else does\n", g_quark_to_string (direction));
+    }
+
+    return FALSE;
+}
+
+gboolean rule_set_would_allow (RuleSet    *rule_set,
+                               GQuark      direction,
+                               GQuark      interface,
+                               const char *interface_name,
+                               const char *path,
+                               GQuark      member,
+                               const char *member_name)
+{
+    gboolean direction_miss;
+    guint    scanned;
+
+    return rule_set_first_match (rule_set, direction,
+                                 interface, interface_name, path,
+                                 member, member_name,
+                                 &scanned, &direction_miss) >= 0;
+}
+
+gboolean rule_set_allows_interface (RuleSet    *rule_set,
+                                    GQuark      interface,
+                                    const char *interface_name,
+                                    const char *path)
+{
+    const gulong *interface_bits, *path_bits;
+    guint         w;
+
+    if (rule_set == NULL || rule_set->n_rules == 0 ||
+        interface_name == NULL || path == NULL)
+    {
+        return FALSE;
+    }
+
+    interface_bits = rule_set_field_bits (rule_set, RULE_FIELD_INTERFACE,   interface, interface_name);
+    path_bits      = rule_set_field_bits (rule_set, RULE_FIELD_OBJECT_PATH, 0,         path);
+
+    for (w = 0; w < rule_set->n_words; w++) {
+        if ((interface_bits[w] & path_bits[w]) != 0) {
+            return TRUE;
+        }
+    }
+
+    return FALSE;
+}
+
+/*! \brief compares if the comparison is contained by string
+ *
+ * \param  comparison The field to compare
+ * \param  string The field in the rule
+ * \return TRUE       if the rule matches the comparison
+ * \return FALSE      if there is no match
+ */
+static gboolean compare_entry (const char *comparison, const gchar *string)
+{
+    return comparison != NULL &&
+           strcmp (string, "") != 0 &&
+           g_pattern_match_simple (string, comparison);
+}
+
+/*! \brief Match a JSON rule against an entry
+ *
+ * \param  rule       The JSON rule
+ * \param  entry      The JSON field to compare against
+ * \param  comparison The field to compare in the rule
+ * \return TRUE       if the rule matches the comparison
+ * \return FALSE      if there is no match
+ */
+static gboolean match_rule (const json_t *rule,
+                            const char   *entry,
+                            const char   *comparison)
+{
+    json_t *json_entry;
+
+    json_entry = json_object_get (rule, entry);
+    if (!json_is_string (json_entry)) {
+        return FALSE;
+    }
+
+    return compare_entry (comparison, json_string_value (json_entry));
+}
+
+/*! \brief Match a JSON method against an entry
+ *
+ * \param  rule       The JSON rule
+ * \param  comparison The field to compare in the rule
+ * \return TRUE       if the rule matches the comparison
+ * \return FALSE      if there is no match
+ */
+static gboolean match_method (const json_t *rule, const char *comparison)
+{
+    json_t *json_entry;
+
+    json_entry = json_object_get (rule, "method");
+    if (json_is_array (json_entry)) {
+        size_t  ix;
+        json_t *val;
+
+        json_array_foreach (json_entry, ix, val) {
+            if (!json_is_string (val)) {
+                return FALSE;
+            }
+
+            if (compare_entry (comparison, json_string_value (val))) {
+                return TRUE;
+            }
+        }
+    } else if (json_is_string (json_entry)) {
+        return compare_entry (comparison, json_string_value (json_entry));
+    }
+
+    return FALSE;
+}
+
+gboolean rules_json_is_allowed (const json_t *rules,
+                                const char   *direction,
+                                const char   *interface,
+                                const char   *path,
+                                const char   *member)
+{
+    size_t  i;
+    json_t *rule;
+
+    /* Check all rules until a match is found. When a match is found we
+       don't check any following rules. This means that a more permissive
+       rule will trump less permissive rules. */
+    for (i = 0; i < json_array_size (rules); i++) {
+        rule = json_array_get (rules, i);
+        if (rule == NULL || !json_is_object (rule)) {
+            break;
+        }
+
+        if (match_rule   (rule, "direction",   direction) &&
+            match_rule   (rule, "interface",   interface) &&
+            match_rule   (rule, "object-path", path)      &&
+            match_method (rule, member))
+        {
+            return TRUE;
+        }
+    }
+
+    return FALSE;
+}
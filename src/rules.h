@@ -0,0 +1,304 @@
+/*
+ * Copyright (C) 2013-2016, Pelagicore AB   <joakim.gross@pelagicore.com>
+ *
+ * This library is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU Lesser General Public
+ * License as published by the Free Software Foundation; either
+ * version 2.1 of the License, or (at your option) any later version.
+ *
+ * This library is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ * Lesser General Public License for more details.
+ *
+ * You should have received a copy of the GNU Lesser General Public
+ * License along with this library; if not, write to the
+ * Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+ * Boston, MA  02110-1301, USA.
+ *
+ * For further information see LICENSE
+ */
+
+#ifndef DBUS_PROXY_RULES_H
+#define DBUS_PROXY_RULES_H
+
+#include <glib.h>
+#include <jansson.h>
+
+#include "ratelimit.h"
+
+/*! The fields of a rule, in the order they are evaluated */
+typedef enum {
+    RULE_FIELD_DIRECTION = 0,
+    RULE_FIELD_INTERFACE,
+    RULE_FIELD_OBJECT_PATH,
+    RULE_FIELD_METHOD,
+    RULE_FIELD_COUNT
+} RuleField;
+
+/*! What a rule set decides for all messages in one direction */
+typedef enum {
+    /*! The rules have to be evaluated for each message */
+    RULE_VERDICT_FILTER = 0,
+    /*! Every message with interface, path and member set is allowed */
+    RULE_VERDICT_ALLOW_ALL,
+    /*! No message is allowed */
+    RULE_VERDICT_DENY_ALL
+} RuleVerdict;
+
+/*! The lanes messages to a client are sent in, see delivery_send() */
+typedef enum {
+    /*! The lane is chosen by the type of the message */
+    RULE_LANE_NONE = -1,
+    /*! Method returns and errors */
+    RULE_LANE_REPLY = 0,
+    /*! Method calls */
+    RULE_LANE_CALL,
+    /*! Signals */
+    RULE_LANE_SIGNAL,
+    RULE_LANE_COUNT
+} RuleLane;
+
+/*! Seconds replies to property reads are cached, if a rule does not say */
+#define RULE_PROPERTY_CACHE_DEFAULT_TTL 1
+
+/*! A compiled, immutable set of filter rules */
+typedef struct _RuleSet RuleSet;
+
+/*! The worst case cost of deciding on one message */
+typedef struct {
+    /*! Wildcard patterns matched when no field value is cached */
+    guint glob_matches;
+    /*! Literal and '*' patterns compared when no field value is cached */
+    guint compares;
+    /*! Bitset words combined for every message */
+    guint bitset_words;
+} RuleSetCost;
+
+/*! \brief Compile a JSON rule array
+ *
+ * The rules are compiled in file order. Evaluation stops at the first entry
+ * that is not a JSON object, so such an entry and everything after it is
+ * left out of the compiled set. The rule set keeps no reference to the JSON,
+ * the pattern texts are copied into a string arena of the set.
+ *
+ * \param rules JSON array of rule objects, may be NULL
+ * \return A new rule set, free with rule_set_unref()
+ */
+RuleSet *rule_set_new (const json_t *rules);
+
+/*! \brief Compile a JSON rule array after the rules of a rule set
+ *
+ * The new set evaluates the rules of the base set first, then the new
+ * rules. When the base set stopped at an entry that is not a JSON object the
+ * new rules are never evaluated, just as if the arrays had been joined. The
+ * base set is not changed and does not have to be kept.
+ *
+ * \param base  The rules to start with, may be NULL
+ * \param rules JSON array of rule objects, may be NULL
+ * \return A new rule set, free with rule_set_unref()
+ */
+RuleSet *rule_set_append (const RuleSet *base, const json_t *rules);
+
+/*! \brief Test if two rule sets have the same rules in the same order */
+gboolean rule_set_equal (const RuleSet *rule_set, const RuleSet *other);
+
+/*! \brief Take a reference on a rule set, so it can be shared
+ *
+ * \return The rule set
+ */
+RuleSet *rule_set_ref (RuleSet *rule_set);
+
+/*! \brief Drop a reference on a rule set, and free it with the last one */
+void rule_set_unref (RuleSet *rule_set);
+
+/*! \brief Number of rules that take part in evaluation */
+guint rule_set_size (const RuleSet *rule_set);
+
+/*! \brief Get the rate limit of a rule
+ *
+ * \param rule_set   The compiled rules
+ * \param rule_index Index of the rule, as returned by rule_set_is_allowed()
+ * \return The limit of the messages allowed by the rule, or NULL if there
+ *         is none
+ */
+const RateLimitSpec *rule_set_rate_limit (const RuleSet *rule_set, gint rule_index);
+
+/*! \brief Get how long a rule caches replies to property reads
+ *
+ * \param rule_set   The compiled rules
+ * \param rule_index Index of the rule, as returned by rule_set_is_allowed()
+ * \return The time to cache replies in microseconds, or 0 if the rule does
+ *         not cache them
+ */
+gint64 rule_set_property_cache_ttl (const RuleSet *rule_set, gint rule_index);
+
+/*! \brief Find out if a rule coalesces the signals it allows
+ *
+ * \param rule_set   The compiled rules
+ * \param rule_index Index of the rule, as returned by rule_set_is_allowed()
+ * \return TRUE if signals held for a slow client are replaced by newer ones,
+ *         see delivery_send()
+ */
+gboolean rule_set_coalesce (const RuleSet *rule_set, gint rule_index);
+
+/*! \brief Get the lane a rule puts the messages it allows in
+ *
+ * \param rule_set   The compiled rules
+ * \param rule_index Index of the rule, as returned by rule_set_is_allowed()
+ * \return The lane, or RULE_LANE_NONE if the rule does not choose one
+ */
+RuleLane rule_set_lane (const RuleSet *rule_set, gint rule_index);
+
+/*! \brief Find out if a rule set decides all messages in a direction
+ *
+ * A direction is allowed all when some rule for it matches any interface,
+ * path and method, i.e. its patterns consist of '*' only. It is denied all
+ * when no rule for it can match anything. Since rule evaluation only
+ * decides whether some rule matches, the order of the rules does not matter
+ * for either case. A direction with rules that limit rates, cache
+ * properties, coalesce signals or choose lanes is never allowed all, since
+ * the matching rule decides which limit applies, what is cached and how a
+ * message is sent.
+ *
+ * \param rule_set  The compiled rules
+ * \param direction The direction to analyze
+ * \return The verdict for all messages in the direction
+ */
+RuleVerdict rule_set_analyze (const RuleSet *rule_set, const char *direction);
+
+/*! \brief Decide if a message is allowed by a compiled rule set
+ *
+ * Each field value is mapped to a bitset of the rules it matches. The bitsets
+ * are cached per value, and the verdict is the lowest bit set in all four of
+ * them, i.e. the first rule that matches in the active order. Each verdict
+ * is counted as a hit of the rule that gave it.
+ *
+ * Interface and member are passed both as names and as quarks, so the
+ * caches can be keyed on integers. Names seen in messages are not a bounded
+ * set and quarks are never freed, so callers look them up with
+ * g_quark_try_string() and pass 0 for a name that is not interned. Such a
+ * name cannot equal a literal in the rules and is only matched against the
+ * wildcard patterns. The object path is always passed as a string. A NULL
+ * name or path is a missing header field, which no rule matches.
+ *
+ * \param rule_set       The compiled rules
+ * \param direction      Direction of the message, as a quark
+ * \param interface      The interface as a quark, or 0 if not interned
+ * \param interface_name The interface the message was sent on
+ * \param path           The object path of the message
+ * \param member         The method as a quark, or 0 if not interned
+ * \param member_name    The method of the message
+ * \param rule_index     Set to the index of the matching rule, or -1. May
+ *                       be NULL
+ * \return TRUE          if the message is allowed
+ * \return FALSE         if the message is not allowed
+ */
+gboolean rule_set_is_allowed (RuleSet    *rule_set,
+                              GQuark      direction,
+                              GQuark      interface,
+                              const char *interface_name,
+                              const char *path,
+                              GQuark      member,
+                              const char *member_name,
+                              gint       *rule_index);
+
+/*! \brief Decide if a message would be allowed, without evaluating it
+ *
+ * Like rule_set_is_allowed(), but the verdict is not counted as a hit and
+ * no probe fires, so rules can be looked at without skewing the statistics
+ * used to reorder them.
+ *
+ * \return TRUE if a rule allows the message
+ */
+gboolean rule_set_would_allow (RuleSet    *rule_set,
+                               GQuark      direction,
+                               GQuark      interface,
+                               const char *interface_name,
+                               const char *path,
+                               GQuark      member,
+                               const char *member_name);
+
+/*! \brief Test if any rule allows some member of an interface on a path
+ *
+ * The direction and member are not looked at. Nothing is counted.
+ *
+ * \param rule_set       The compiled rules
+ * \param interface      The interface as a quark, or 0 if not interned
+ * \param interface_name The interface
+ * \param path           The object path
+ * \return TRUE if a rule matches the interface and the path
+ */
+gboolean rule_set_allows_interface (RuleSet    *rule_set,
+                                    GQuark      interface,
+                                    const char *interface_name,
+                                    const char *path);
+
+/*! \brief Evaluate the rules that give the most verdicts first
+ *
+ * Rules are evaluated in the order of the config, and the first that
+ * matches decides. The rules with the most hits since the last reorder are
+ * moved earlier, as long as that can not change a decision: a rule only
+ * moves before another one when no message matches both, or when both allow
+ * without a rate limit, cache properties for as long, and coalesce and choose
+ * lanes alike. Another rule than
+ * the first in the config may then be reported for a message, but it
+ * decides the same. Rule indices keep referring to the order of the config.
+ *
+ * The hits are halved, so the order follows the traffic when this is called
+ * periodically.
+ *
+ * \return TRUE if the active order changed
+ */
+gboolean rule_set_reorder (RuleSet *rule_set);
+
+/*! \brief Get the index of the rule evaluated at a position of the active
+ *         order
+ *
+ * \param position Less than rule_set_size()
+ */
+guint rule_set_active_rule (const RuleSet *rule_set, guint position);
+
+/*! \brief Number of verdicts a rule gave, halved at each reorder */
+guint64 rule_set_hits (const RuleSet *rule_set, guint index);
+
+/*! \brief Test if a rule can match any message
+ *
+ * A rule cannot match when a field is missing, empty or not a string, or
+ * when its direction is neither "outgoing" nor "incoming".
+ */
+gboolean rule_set_rule_can_match (const RuleSet *rule_set, guint index);
+
+/*! \brief Find an earlier rule that matches everything a rule matches
+ *
+ * \return The index of the earlier rule, or -1 if there is none
+ */
+gint rule_set_shadowing_rule (const RuleSet *rule_set, guint index);
+
+/*! \brief Estimate the worst case cost of deciding on one message
+ *
+ * The worst case is a message none of whose field values are cached, so
+ * every pattern of every rule is evaluated once.
+ */
+void rule_set_cost (const RuleSet *rule_set, RuleSetCost *cost);
+
+/*! \brief Describe the compiled rules and where they are in the bitsets
+ *
+ * \param rule_set The compiled rules
+ * \param out      The description is appended to this string
+ */
+void rule_set_describe (const RuleSet *rule_set, GString *out);
+
+/*! \brief Decide if a message is allowed by walking the JSON rules
+ *
+ * This is the reference evaluation that the compiled rule set must agree
+ * with. It walks the JSON array on every call and is not used on the
+ * message path.
+ */
+gboolean rules_json_is_allowed (const json_t *rules,
+                                const char   *direction,
+                                const char   *interface,
+                                const char   *path,
+                                const char   *member);
+
+#endif /* DBUS_PROXY_RULES_H */
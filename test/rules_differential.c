@@ -0,0 +1,493 @@
+/*
+ * Copyright (C) 2013-2016, Pelagicore AB   <joakim.gross@pelagicore.com>
+ *
+ * This library is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU Lesser General Public
+ * License as published by the Free Software Foundation; either
+ * version 2.1 of the License, or (at your option) any later version.
+ *
+ * This library is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ * Lesser General Public License for more details.
+ *
+ * You should have received a copy of the GNU Lesser General Public
+ * License along with this library; if not, write to the
+ * Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+ * Boston, MA  02110-1301, USA.
+ *
+ * For further information see LICENSE
+ */
+
+/*
+ * Differential test of the rule engine.
+ *
+ * Random configs and random messages are evaluated with the reference
+ * implementation, rules_json_is_allowed(), which walks the JSON rules, and
+ * with the compiled rule set. Every verdict must be the same, and the rule
+ * the compiled set reports must be the first rule that allows the message.
+ * The values are drawn from small pools, so that patterns and messages
+ * match often and the quirks of the rules are hit: empty strings, missing
+ * fields, fields that are not strings, method arrays with entries that are
+ * not strings, and entries of the rule array that are not objects.
+ *
+ * The compiled set is then reordered by the hits of the first messages, and
+ * must still decide every message as the first matching rule does: another
+ * rule may be reported only if both allow without a rate limit and cache
+ * properties for as long.
+ *
+ * The throughput of both implementations is reported from the same run.
+ */
+
+#include "rules.h"
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+
+
+/*! A rule field value, NULL for a missing field and "#" for a field that is
+    not a string */
+static const char *directions[] = {
+    "outgoing", "incoming", "*", "out*", "?ncoming", "", "sideways", NULL, "#"
+};
+
+static const char *interfaces[] = {
+    "com.example.Foo", "com.example.Bar", "com.example.*", "com.*.Foo",
+    "com.example.Fo?", "*", "**", "", NULL, "#"
+};
+
+static const char *paths[] = {
+    "/com/example", "/com/example/a", "/com/example/*", "/com/*", "/*",
+    "*", "/com/example/?", "", NULL, "#"
+};
+
+static const char *methods[] = {
+    "Get", "GetAll", "Set", "Get*", "*Set", "G?t", "*", "", NULL, "#"
+};
+
+/*! Message field values, NULL for a missing field */
+static const char *message_directions[] = { "outgoing", "incoming" };
+
+static const char *message_interfaces[] = {
+    "com.example.Foo", "com.example.Bar", "com.example.Fo", "com.other.Foo",
+    "com.example.Foo.Sub", NULL
+};
+
+static const char *message_paths[] = {
+    "/com/example", "/com/example/a", "/com/example/ab", "/com", "/other", NULL
+};
+
+static const char *message_members[] = {
+    "Get", "GetAll", "Set", "Got", "Reset", "Notify", NULL
+};
+
+#define POOL_SIZE(pool) (G_N_ELEMENTS (pool))
+#define PICK(rand, pool) ((pool)[g_rand_int_range ((rand), 0, POOL_SIZE (pool))])
+
+
+/*! A message with its field values interned for the compiled set */
+typedef struct {
+    const char *direction;
+    const char *interface;
+    const char *path;
+    const char *member;
+    GQuark      direction_quark;
+    GQuark      interface_quark;
+    GQuark      member_quark;
+} Message;
+
+
+static json_t *field_value (const char *value)
+{
+    return strcmp (value, "#") == 0 ? json_integer (42) : json_string (value);
+}
+
+static void set_field (GRand *rand, json_t *rule, const char *name, const char **pool, guint size)
+{
+    const char *value = pool[g_rand_int_range (rand, 0, size)];
+
+    if (value != NULL) {
+        json_object_set_new (rule, name, field_value (value));
+    }
+}
+
+static json_t *random_rule (GRand *rand)
+{
+    json_t *rule;
+    json_t *array;
+    gint    i, n;
+
+    /* Evaluation stops at an entry that is not an object */
+    if (g_rand_int_range (rand, 0, 25) == 0) {
+        return json_string ("not a rule");
+    }
+
+    rule = json_object ();
+    set_field (rand, rule, "direction",   directions, POOL_SIZE (directions));
+    set_field (rand, rule, "interface",   interfaces, POOL_SIZE (interfaces));
+    set_field (rand, rule, "object-path", paths,      POOL_SIZE (paths));
+
+    if (g_rand_boolean (rand)) {
+        set_field (rand, rule, "method", methods, POOL_SIZE (methods));
+    } else {
+        array = json_array ();
+        n = g_rand_int_range (rand, 0, 4);
+        for (i = 0; i < n; i++) {
+            const char *value = PICK (rand, methods);
+            json_array_append_new (array, value != NULL ? field_value (value)
+                                                        : json_null ());
+        }
+        json_object_set_new (rule, "method", array);
+    }
+
+    /* None of these changes the verdict */
+    if (g_rand_int_range (rand, 0, 8) == 0) {
+        json_object_set_new (rule, "property-cache", json_object ());
+    }
+    if (g_rand_int_range (rand, 0, 8) == 0) {
+        json_object_set_new (rule, "coalesce", json_true ());
+    }
+    if (g_rand_int_range (rand, 0, 8) == 0) {
+        json_object_set_new (rule, "lane", json_string ("call"));
+    }
+    if (g_rand_int_range (rand, 0, 8) == 0) {
+        json_t *limit = json_object ();
+
+        json_object_set_new (limit, "messages-per-second", json_integer (10));
+        json_object_set_new (rule, "rate-limit", limit);
+    }
+
+    return rule;
+}
+
+static json_t *random_rules (GRand *rand, gint max_rules)
+{
+    json_t *rules = json_array ();
+    gint    i, n;
+
+    n = g_rand_int_range (rand, 0, max_rules + 1);
+    for (i = 0; i < n; i++) {
+        json_array_append_new (rules, random_rule (rand));
+    }
+
+    return rules;
+}
+
+static void random_message (GRand *rand, Message *message)
+{
+    message->direction = PICK (rand, message_directions);
+    message->interface = PICK (rand, message_interfaces);
+    message->path      = PICK (rand, message_paths);
+    message->member    = PICK (rand, message_members);
+
+    message->direction_quark = g_quark_from_string (message->direction);
+    message->interface_quark = g_quark_try_string (message->interface);
+    message->member_quark    = g_quark_try_string (message->member);
+}
+
+/*! \brief The first rule that allows a message, by the reference walker */
+static gint reference_first_match (const json_t *rules, const Message *message)
+{
+    json_t *single;
+    size_t  i;
+    gint    index = -1;
+
+    for (i = 0; i < json_array_size (rules) && index < 0; i++) {
+        if (!json_is_object (json_array_get (rules, i))) {
+            break;
+        }
+
+        single = json_array ();
+        json_array_append (single, json_array_get (rules, i));
+        if (rules_json_is_allowed (single, message->direction, message->interface,
+                                   message->path, message->member)) {
+            index = i;
+        }
+        json_decref (single);
+    }
+
+    return index;
+}
+
+static json_t *array_slice (const json_t *rules, size_t start, size_t end)
+{
+    json_t *slice = json_array ();
+    size_t  i;
+
+    for (i = start; i < end; i++) {
+        json_array_append (slice, json_array_get (rules, i));
+    }
+
+    return slice;
+}
+
+static void report_mismatch (const char *engine, const json_t *rules,
+                             const Message *message, gint expected, gint got)
+{
+    char *dump = json_dumps (rules, JSON_INDENT (4));
+
+    g_printerr ("MISMATCH in %s: expected rule %d, got rule %d\n"
+                "message: direction %s, interface %s, path %s, member %s\n"
+                "rules: %s\n",
+                engine, expected, got,
+                message->direction,
+                message->interface != NULL ? message->interface : "(none)",
+                message->path      != NULL ? message->path      : "(none)",
+                message->member    != NULL ? message->member    : "(none)",
+                dump);
+    free (dump);
+}
+
+/*! \brief Test if two rules, or no rule, decide the same on a message */
+static gboolean same_decision (const RuleSet *rule_set, gint index, gint other)
+{
+    if (index == other) {
+        return TRUE;
+    }
+
+    return index >= 0 && other >= 0                          &&
+           rule_set_rate_limit (rule_set, index) == NULL     &&
+           rule_set_rate_limit (rule_set, other) == NULL     &&
+           rule_set_property_cache_ttl (rule_set, index) ==
+               rule_set_property_cache_ttl (rule_set, other)  &&
+           rule_set_coalesce (rule_set, index) ==
+               rule_set_coalesce (rule_set, other)            &&
+           rule_set_lane (rule_set, index) ==
+               rule_set_lane (rule_set, other);
+}
+
+/*! \brief Compare the engines on one config
+ *
+ * \param reordered Incremented if reordering changed the compiled rules
+ * \return The number of mismatches
+ */
+static guint check_config (GRand        *rand,
+                           const json_t *rules,
+                           guint         n_messages,
+                           guint        *reordered)
+{
+    RuleSet *compiled;
+    RuleSet *first_half;
+    RuleSet *appended;
+    json_t  *head;
+    json_t  *tail;
+    Message  message;
+    size_t   split;
+    gboolean expected;
+    gint     expected_index;
+    gint     index;
+    guint    mismatches = 0;
+    guint    i;
+
+    compiled = rule_set_new (rules);
+
+    /* A set appended to another must behave as if compiled in one go */
+    split      = g_rand_int_range (rand, 0, json_array_size (rules) + 1);
+    head       = array_slice (rules, 0, split);
+    tail       = array_slice (rules, split, json_array_size (rules));
+    first_half = rule_set_new (head);
+    appended   = rule_set_append (first_half, tail);
+    rule_set_unref (first_half);
+    json_decref (head);
+    json_decref (tail);
+
+    for (i = 0; i < n_messages; i++) {
+        random_message (rand, &message);
+
+        expected = rules_json_is_allowed (rules, message.direction,
+                                          message.interface, message.path,
+                                          message.member);
+        expected_index = expected ? reference_first_match (rules, &message) : -1;
+
+        if (rule_set_is_allowed (compiled, message.direction_quark,
+                                 message.interface_quark, message.interface,
+                                 message.path,
+                                 message.member_quark, message.member, &index) != expected ||
+            index != expected_index)
+        {
+            report_mismatch ("compiled rules", rules, &message, expected_index, index);
+            mismatches++;
+        }
+
+        if (rule_set_is_allowed (appended, message.direction_quark,
+                                 message.interface_quark, message.interface,
+                                 message.path,
+                                 message.member_quark, message.member, &index) != expected ||
+            index != expected_index)
+        {
+            report_mismatch ("appended rules", rules, &message, expected_index, index);
+            mismatches++;
+        }
+    }
+
+    /* The messages above are the hits the rules are reordered by */
+    if (rule_set_reorder (compiled)) {
+        (*reordered)++;
+    }
+
+    for (i = 0; i < n_messages; i++) {
+        random_message (rand, &message);
+
+        expected = rules_json_is_allowed (rules, message.direction,
+                                          message.interface, message.path,
+                                          message.member);
+        expected_index = expected ? reference_first_match (rules, &message) : -1;
+
+        if (rule_set_is_allowed (compiled, message.direction_quark,
+                                 message.interface_quark, message.interface,
+                                 message.path,
+                                 message.member_quark, message.member, &index) != expected ||
+            !same_decision (compiled, index, expected_index))
+        {
+            report_mismatch ("reordered rules", rules, &message, expected_index, index);
+            mismatches++;
+        }
+    }
+
+    rule_set_unref (compiled);
+    rule_set_unref (appended);
+
+    return mismatches;
+}
+
+/*! \brief Time both engines on the same config and messages
+ *
+ * \return Messages per second of the reference and of the compiled rules
+ */
+static void measure_throughput (GRand *rand, gint max_rules, guint n_messages,
+                                gdouble *reference_rate, gdouble *compiled_rate)
+{
+    json_t  *rules;
+    RuleSet *compiled;
+    Message *messages;
+    gint64   start;
+    guint    i, allowed = 0;
+
+    rules = json_array ();
+    while ((gint) json_array_size (rules) < max_rules) {
+        json_t *rule = random_rule (rand);
+
+        /* Keep all rules in evaluation */
+        if (json_is_object (rule)) {
+            json_array_append (rules, rule);
+        }
+        json_decref (rule);
+    }
+    compiled = rule_set_new (rules);
+
+    messages = g_new0 (Message, n_messages);
+    for (i = 0; i < n_messages; i++) {
+        random_message (rand, &messages[i]);
+    }
+
+    start = g_get_monotonic_time ();
+    for (i = 0; i < n_messages; i++) {
+        allowed += rules_json_is_allowed (rules, messages[i].direction,
+                                          messages[i].interface, messages[i].path,
+                                          messages[i].member);
+    }
+    *reference_rate = n_messages * (gdouble) G_USEC_PER_SEC /
+                      MAX (g_get_monotonic_time () - start, 1);
+
+    start = g_get_monotonic_time ();
+    for (i = 0; i < n_messages; i++) {
+        allowed -= rule_set_is_allowed (compiled, messages[i].direction_quark,
+                                        messages[i].interface_quark,
+                                        messages[i].interface, messages[i].path,
+                                        messages[i].member_quark,
+                                        messages[i].member, NULL);
+    }
+    *compiled_rate = n_messages * (gdouble) G_USEC_PER_SEC /
+                     MAX (g_get_monotonic_time () - start, 1);
+
+    if (allowed != 0) {
+        g_printerr ("MISMATCH in throughput run: %d verdicts differ\n", (gint) allowed);
+    }
+
+    g_free (messages);
+    rule_set_unref (compiled);
+    json_decref (rules);
+}
+
+static void log_handler_silent (const gchar   *log_domain,
+                                GLogLevelFlags log_level,
+                                const gchar   *message,
+                                gpointer       user_data)
+{
+}
+
+int main (int argc, char **argv)
+{
+    gint     configs = 2000;
+    gint     messages = 200;
+    gint     max_rules = 12;
+    gint     bench_rules = 300;
+    gint     bench_messages = 20000;
+    gint64   seed = 0;
+    GError  *error = NULL;
+    GRand   *rand;
+    guint    mismatches = 0;
+    guint    reordered = 0;
+    gdouble  reference_rate, compiled_rate;
+    gint     i;
+    GOptionEntry entries[] = {
+        { "configs", 0, 0, G_OPTION_ARG_INT, &configs,
+          "Random configs to test (default 2000)", "N" },
+        { "messages", 0, 0, G_OPTION_ARG_INT, &messages,
+          "Random messages per config (default 200)", "N" },
+        { "max-rules", 0, 0, G_OPTION_ARG_INT, &max_rules,
+          "Rules per config at most (default 12)", "N" },
+        { "bench-rules", 0, 0, G_OPTION_ARG_INT, &bench_rules,
+          "Rules of the throughput config (default 300)", "N" },
+        { "bench-messages", 0, 0, G_OPTION_ARG_INT, &bench_messages,
+          "Messages of the throughput run (default 20000)", "N" },
+        { "seed", 0, 0, G_OPTION_ARG_INT64, &seed,
+          "Seed of the random generator, 0 picks one (default 0)", "N" },
+        { NULL }
+    };
+    GOptionContext *context;
+
+    context = g_option_context_new ("- compare the compiled rules with the "
+                                    "reference implementation");
+    g_option_context_add_main_entries (context, entries, NULL);
+    if (!g_option_context_parse (context, &argc, &argv, &error)) {
+        g_printerr ("%s\n", error->message);
+        return 2;
+    }
+    g_option_context_free (context);
+
+    if (configs < 0 || messages < 0 || max_rules < 0 ||
+        bench_rules < 0 || bench_messages < 0) {
+        g_printerr ("Counts must not be negative\n");
+        return 2;
+    }
+
+    /* The rule engine logs direction misses */
+    g_log_set_handler (NULL, G_LOG_LEVEL_MASK, log_handler_silent, NULL);
+
+    if (seed == 0) {
+        seed = g_get_real_time ();
+    }
+    rand = g_rand_new_with_seed ((guint32) seed);
+    g_print ("seed %" G_GINT64_FORMAT "\n", seed);
+
+    for (i = 0; i < configs; i++) {
+        json_t *rules = random_rules (rand, max_rules);
+
+        mismatches += check_config (rand, rules, messages, &reordered);
+        json_decref (rules);
+    }
+    g_print ("%d configs, %d messages each, %u reordered, %u mismatches\n",
+             configs, messages, reordered, mismatches);
+
+    measure_throughput (rand, bench_rules, bench_messages,
+                        &reference_rate, &compiled_rate);
+    g_print ("throughput with %d rules: reference %.0f messages/s, "
+             "compiled %.0f messages/s\n",
+             bench_rules, reference_rate, compiled_rate);
+
+    g_rand_free (rand);
+
+    return mismatches == 0 ? 0 : 1;
+}